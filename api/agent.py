@@ -1,35 +1,49 @@
 from dataclasses import dataclass, asdict
 
-from .schemas import PersonSchema, BaseModel
+from .backends import get_backend, record_response
+from .context import PromptContext, build_context
+from .gateway import ModelGateway, request_key
+from .metrics import CONTEXT_TOKENS, MODEL_TOKENS, MODEL_TURNS, RECOMMENDATION_REPAIRS, log_event, span
+from .repair import RecommendationRepairer, RepairReport, repair_recommendation
+from .schemas import PersonSchema, Rec, RecommendationOutput
 
 from typing import List, Optional
 
-from pydantic import Field
+from pydantic import Field, ValidationError
 
 from pydantic_ai import Agent, RunContext
 
-from pydantic_ai.models.vertexai import VertexAIModel
+from django.conf import settings
+from django.utils import timezone
 
-from datetime import datetime
+import asyncio
+import logging
+import threading
 
-@dataclass
-class UserInformation:
-    user : PersonSchema
+import httpx
 
-@dataclass
-class Rec:
-    start_time : str
-    end_time : str
-    title : str
+logger = logging.getLogger(__name__)
 
+#Connection pool shared by every model request made from this process
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+HTTP_TIMEOUT = httpx.Timeout(timeout=60, connect=5)
 
-class RecommendationOutput(BaseModel):
-    recs : List[Rec] = Field(description = "A list of recommendations for what the user should be completing at what time.")
+@dataclass
+class UserInformation:
+    user : PersonSchema
+    context : PromptContext = None
 
 class RecommendationAgent:
-    def __init__(self):
+    def __init__(self, http_client = None, inline_context = None, gateway = None, backend = None):
+        #The model comes from the backend chosen in settings, such as Vertex AI or the offline rules
+        self.backend = backend or get_backend()
+        #Every model call goes through the gateway, which limits, coalesces and retries them
+        self.gateway = gateway or ModelGateway(timeout=self.backend.timeout, backend=self.backend.name, latency_budget=self.backend.latency_budget)
+        #Without the context in the prompt the model has to spend a turn calling getTasks and getAvailabilities
+        self.inline_context = settings.RECOMMENDATION_INLINE_CONTEXT if inline_context is None else inline_context
+        self.model = self.backend.build(http_client)
         self.agent = Agent(
-            VertexAIModel('gemini-1.5-flash', project_id = 'tempora-447602'),
+            self.model,
             deps_type=UserInformation,
             result_type=RecommendationOutput,
             system_prompt=(
@@ -39,33 +53,308 @@ class RecommendationAgent:
 
         @self.agent.tool
         async def getTasks(ctx: RunContext[UserInformation]) -> str:
-            message = ""
-
-            tasks = ctx.deps.user.tasks
-
-            for task in tasks:
-                message += f"{task.name} due at {task.due_date} with {task.priority} priority ({"COMPLETED" if task.is_completed else "NOT COMPLETED"}). \n\n"
-
-            return message
+            """
+            Returns the user's open tasks as `id|name|due|priority` rows, most important first.
+            """
+            context = ctx.deps.context
+            if context.omitted:
+                return f"{context.tasks}\n({context.omitted} less important tasks left out)"
+            return context.tasks
         
         @self.agent.tool
         async def getAvailabilities(ctx: RunContext[UserInformation]) -> str:
-            message = ""
-            availabilities = ctx.deps.user.availabilities
+            """
+            Returns the user's weekly available time slots, one `Day HH:MM-HH:MM` row each, optionally followed by
+            `every Nw` (every N weeks), `from YYYY-MM-DD`, `to YYYY-MM-DD` and `tz Zone`. Then one row per date
+            that differs: `YYYY-MM-DD only HH:MM-HH:MM` replaces that date's weekly slots, `YYYY-MM-DD off HH:MM-HH:MM`
+            takes that time out and `YYYY-MM-DD off` takes out the whole day.
+            """
+            return ctx.deps.context.availabilities
+
+    def userInformation(self, user:PersonSchema):
+        """
+        Builds the run's deps with the user's compact context, logging its size.
+
+        Args:
+            user (PersonSchema): The user to make the recommendation for
+        """
+        context = build_context(user)
+        CONTEXT_TOKENS.observe(context.tokens)
+        log_event("context", username=user.username, tokens=context.tokens, omitted=context.omitted)
+        return UserInformation(user=user, context=context)
+
+    def logUsage(self, user:PersonSchema, result, operation):
+        """
+        Records the model turns and tokens a run used.
+
+        Args:
+            user (PersonSchema): The user the run was for
+            result: The pydantic_ai run or stream result
+            operation (str): "schedule" or "phrase"
+        """
+        usage = result.usage()
+        MODEL_TURNS.inc(usage.requests, operation=operation)
+        MODEL_TOKENS.inc(usage.request_tokens or 0, operation=operation, kind="request")
+        MODEL_TOKENS.inc(usage.response_tokens or 0, operation=operation, kind="response")
+        log_event("model_usage", username=user.username, operation=operation, turns=usage.requests, request_tokens=usage.request_tokens, response_tokens=usage.response_tokens)
 
-            for avail in availabilities:
-                message += f"Available on {avail.day_of_week}s from {avail.start_time} to {avail.end_time} \n\n"
+    def now(self):
+        """
+        Returns the current time as the model is told it, in the time zone its answers are read in.
+        """
+        return timezone.localtime().replace(tzinfo=None)
 
-            return message
+    def schedulePrompt(self, deps:UserInformation):
+        """
+        Builds the prompt asking the model to schedule the user's tasks.
 
-    
+        With inline_context the tasks and availabilities are part of the prompt, so the model can answer
+        in its first turn. The tools stay available in case it wants them again.
+
+        Args:
+            deps (UserInformation): The run's deps holding the user's compact context
+        """
+        prompt = f"The time is {self.now()}."
+        if not self.inline_context:
+            return prompt
+
+        context = deps.context
+        omitted = f"\n({context.omitted} less important tasks left out)" if context.omitted else ""
+        return f"{prompt}\n\nTasks:\n{context.tasks}{omitted}\n\nAvailabilities:\n{context.availabilities}"
 
     async def makeRecommendations(self, user:PersonSchema):
-        deps = UserInformation(user=user)
-        result = await self.agent.run(user_prompt=f"The time is {datetime.now()}.", deps = deps)
+        deps = self.userInformation(user)
+
+        async def call():
+            prompt = self.schedulePrompt(deps)
+            with span("model", operation="schedule"):
+                result = await self.agent.run(user_prompt=prompt, deps = deps)
+            self.logUsage(user, result, "schedule")
+            record_response(prompt, result.data.model_dump())
+            return result
+
+        key = request_key("schedule", user.model_dump_json())
+        result = await self.gateway.run(key, user.username, call)
+        return await self.repairRecommendations(user, deps, result, key, "schedule")
+
+    def repairPrompt(self, report:RepairReport):
+        """
+        Builds the prompt asking the model to redo a recommendation that could not be repaired locally.
+
+        Args:
+            report (RepairReport): What was wrong with the recommendation
+        """
+        return f"The time is {self.now()}. Your schedule broke the rules ({report.describe()}). Schedule again, using only the user's available time slots from now on, without overlapping activities and finishing every task before its due date."
+
+    async def repairRecommendations(self, user:PersonSchema, deps:UserInformation, result, key, operation):
+        """
+        Repairs the model's recommendation locally, asking the model again only when too much of it had to be dropped.
+
+        Args:
+            user (PersonSchema): The user the recommendation is for
+            deps (UserInformation): The run's deps
+            result: The pydantic_ai run result to repair
+            key (str): The run's request_key
+            operation (str): "schedule" or "phrase"
+
+        Returns:
+            dict: The dumped, repaired RecommendationOutput
+        """
+        reprompts = settings.RECOMMENDATION_REPAIR_REPROMPTS
+        for attempt in range(reprompts + 1):
+            with span("validate"):
+                report = repair_recommendation(user, result.data, task_ids=deps.context.task_ids)
+            if not report.unrecoverable or attempt == reprompts:
+                return report.output.model_dump()
+
+            RECOMMENDATION_REPAIRS.inc(action="reprompt")
+            log_event("reprompt", username=user.username, operation=operation, violations=dict(report.violations))
+            history = result.all_messages()
+
+            async def call():
+                with span("model", operation=operation, reprompt=True):
+                    again = await self.agent.run(user_prompt=self.repairPrompt(report), deps = deps, message_history = history)
+                self.logUsage(user, again, operation)
+                return again
+
+            result = await self.gateway.run(request_key(key, "repair", str(attempt)), user.username, call)
+
+    def phrasePrompt(self, plan:RecommendationOutput):
+        """
+        Builds the prompt asking the model to reword an already scheduled plan.
+
+        Args:
+            plan (RecommendationOutput): The scheduled plan to reword
+        """
+        schedule = "\n".join(f"- {rec.title} from {rec.start_time} to {rec.end_time}" for rec in plan.recs)
+        return f"The time is {self.now()}. The following schedule has already been made:\n{schedule}\nKeep every start_time and end_time exactly as given and only rewrite each title as a short suggestion for the user."
+
+    async def phraseRecommendations(self, user:PersonSchema, plan:RecommendationOutput):
+        """
+        Rewrites an already scheduled plan into natural-language suggestions.
+
+        The time slots come from the local scheduler, the model is only asked to reword the titles.
+
+        Args:
+            user (PersonSchema): The user the plan was made for
+            plan (RecommendationOutput): The scheduled plan to reword
+        """
+        deps = self.userInformation(user)
+
+        async def call():
+            prompt = self.phrasePrompt(plan)
+            with span("model", operation="phrase"):
+                result = await self.agent.run(user_prompt=prompt, deps = deps)
+            self.logUsage(user, result, "phrase")
+            record_response(prompt, result.data.model_dump())
+            return result
+
+        key = request_key("phrase", user.model_dump_json(), plan.model_dump_json())
+        result = await self.gateway.run(key, user.username, call)
+        return await self.repairRecommendations(user, deps, result, key, "phrase")
+
+    async def streamRecommendations(self, user:PersonSchema, plan:RecommendationOutput = None):
+        """
+        Yields each Rec as soon as the model has finished writing it, repaired against the user's availabilities.
+
+        Args:
+            user (PersonSchema): The user to make the recommendation for
+            plan (RecommendationOutput): A scheduled plan to reword instead of scheduling from scratch
+        """
+        deps = self.userInformation(user)
+        prompt = self.phrasePrompt(plan) if plan is not None else self.schedulePrompt(deps)
+        operation = "phrase" if plan is not None else "schedule"
+
+        repairer = RecommendationRepairer(user, task_ids=deps.context.task_ids)
+        kept = []
+
+        async with self.gateway.stream(user.username):
+            with span("model", operation=operation, stream=True):
+                async with self.agent.run_stream(user_prompt=prompt, deps = deps) as result:
+                    sent = 0
+                    output = None
+                    async for message, last in result.stream_structured(debounce_by=None):
+                        try:
+                            output = await result.validate_structured_result(message, allow_partial=not last)
+                        except ValidationError:
+                            continue
+
+                        # Until the stream ends the last Rec may still be missing fields
+                        ready = output.recs if last else output.recs[:-1]
+                        # Repaired as they arrive, there is no asking again once Recs have been sent
+                        for rec in ready[sent:]:
+                            repaired = repairer.repair_rec(rec)
+                            if repaired is not None:
+                                kept.append(repaired)
+                                yield repaired
+                        sent = max(sent, len(ready))
+
+                    self.logUsage(user, result, operation)
+                    if output is not None:
+                        record_response(prompt, output.model_dump())
+                        repairer.report(kept, len(output.recs))
+
+
+class AgentRegistry:
+    """
+    Per-process home of the RecommendationAgent.
+
+    The agent, its model client and the Vertex AI token are built once and reused by every request.
+    The pooled HTTP client is bound to the event loop it first runs on, so all agent calls are
+    made on one long-lived loop in a background thread instead of a new loop per request.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._agent = None
+        self._loop = None
+
+    def loop(self):
+        """
+        Returns the registry's event loop, starting its thread on first use.
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="recommendation-agent", daemon=True).start()
+            return self._loop
+
+    def get(self):
+        """
+        Returns the shared RecommendationAgent, building it on first use.
+        """
+        with self._lock:
+            if self._agent is None:
+                with span("agent_build"):
+                    self._agent = RecommendationAgent(http_client=httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT))
+            return self._agent
+
+    def submit(self, coro):
+        """
+        Schedules a coroutine on the registry's loop.
+
+        Returns:
+            concurrent.futures.Future: The future holding the coroutine's result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop())
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the registry's loop and blocks until it is done.
+        """
+        return self.submit(coro).result()
+
+    async def arun(self, coro):
+        """
+        Awaits a coroutine run on the registry's loop from another event loop, such as an ASGI server's.
+        """
+        return await asyncio.wrap_future(self.submit(coro))
+
+    async def astream(self, agen):
+        """
+        Iterates an async generator running on the registry's loop from another event loop.
+
+        Stops the generator if the caller stops iterating, such as when a streaming client disconnects.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            except Exception as error:
+                loop.call_soon_threadsafe(queue.put_nowait, (finished, error))
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, (finished, None))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item, error = await queue.get()
+                if item is finished:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+    def warm_up(self):
+        """
+        Builds the agent and starts authenticating its model in the background.
+
+        Does not block, a failed warm-up is logged and authentication is retried on the first request.
+        """
+        agent = self.get()
+        future = self.submit(agent.backend.warm_up(agent.model))
+
+        def report(done):
+            if done.exception() is not None:
+                logger.warning("Recommendation agent warm-up failed: %s", done.exception())
+
+        future.add_done_callback(report)
+        return future
 
-        return result.data.model_dump()
-        
-        
 
-    
\ No newline at end of file
+registry = AgentRegistry()
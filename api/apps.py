@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Lets PerformanceMiddleware count the queries of each request on every database connection
+        from django.db.backends.signals import connection_created
+        from .middleware import install_query_recorder
+        connection_created.connect(install_query_recorder)
+
+        # Connects the receivers that change a user's snapshot version when their data is written
+        from . import signals
+
+        # Builds the recommendation agent and fetches its token before the first request needs them
+        if settings.RECOMMENDATION_AGENT_WARMUP:
+            from .agent import registry
+            registry.warm_up()
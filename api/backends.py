@@ -0,0 +1,305 @@
+import asyncio
+import json
+import logging
+import re
+import threading
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from pydantic_ai.messages import ModelResponse, ToolCallPart, ToolReturnPart, UserPromptPart
+from pydantic_ai.models.function import DeltaToolCall, FunctionModel
+
+from .context import TASK_HEADER
+from .freetime import DAYS_OF_WEEK, EXCEPTION, OVERRIDE, FreeTimeIndex
+from .gateway import request_key
+from .scheduler import place_tasks
+
+logger = logging.getLogger(__name__)
+
+#The time the agent puts at the start of every prompt, left out when matching recordings
+TIME_PREFIX = re.compile(r"^The time is (\d{4}-\d\d-\d\d[ T][\d:.]+)\.")
+
+#Rows of the compact context and of a schedule given to the phrasing prompt
+TASK_ROW = re.compile(r"^(\d+)\|([^|]*)\|([^|]*)\|(\w*)$")
+AVAILABILITY_ROW = re.compile(r"^(\w{3}) (\d\d:\d\d)-(\d\d:\d\d)(?: every (\d+)w)?(?: from (\S+))?(?: to (\S+))?(?: tz (\S+))?$")
+DATED_ROW = re.compile(r"^(\d{4}-\d\d-\d\d) (only|off)(?: (\d\d:\d\d)-(\d\d:\d\d))?(?: tz (\S+))?$")
+PLAN_ROW = re.compile(r"^- (.*) from (\S+) to (\S+)$")
+
+#How far ahead the rule-based backend schedules
+RULES_HORIZON_DAYS = 7
+
+
+def prompt_text(messages):
+    """
+    Returns the user prompt and every tool result of a run so far, one after the other.
+    """
+    return "\n".join(
+        part.content if isinstance(part.content, str) else json.dumps(part.content, default=str)
+        for message in messages
+        for part in message.parts
+        if isinstance(part, (UserPromptPart, ToolReturnPart))
+    )
+
+
+def prompt_key(prompt):
+    """
+    Fingerprints a prompt without its time, so a recording is replayed whenever the same prompt is asked.
+    """
+    return request_key(TIME_PREFIX.sub("", prompt.strip()))
+
+
+def rule_based_recommendation(prompt):
+    """
+    Answers a recommendation prompt without a model, the same way every time.
+
+    A phrasing prompt gets its schedule back unchanged. A scheduling prompt gets its task rows,
+    in the order given, placed into the availability rows over the next week like the local scheduler does.
+
+    Args:
+        prompt (str): The prompt and tool results the agent sent
+
+    Returns:
+        dict: The arguments of the result tool
+    """
+    lines = [line.strip() for line in prompt.splitlines()]
+
+    plan = [PLAN_ROW.match(line) for line in lines]
+    if any(plan):
+        return {"recs": [{"title": match[1], "start_time": match[2], "end_time": match[3]} for match in plan if match]}
+
+    now = TIME_PREFIX.match(prompt.strip())
+    now = datetime.fromisoformat(now[1]) if now else datetime.now()
+    days = {day[:3]: day for day in DAYS_OF_WEEK}
+    availabilities = [
+        SimpleNamespace(
+            day_of_week=days[match[1]], start_time=time.fromisoformat(match[2]), end_time=time.fromisoformat(match[3]),
+            interval_weeks=int(match[4] or 1), starts_on=match[5] and date.fromisoformat(match[5]),
+            ends_on=match[6] and date.fromisoformat(match[6]), timezone=match[7] or "",
+        )
+        for match in map(AVAILABILITY_ROW.match, lines) if match and match[1] in days
+    ] + [
+        SimpleNamespace(
+            kind=OVERRIDE if match[2] == "only" else EXCEPTION, date=date.fromisoformat(match[1]),
+            start_time=time.fromisoformat(match[3]) if match[3] else time.min, end_time=time.fromisoformat(match[4]) if match[4] else time.max,
+            timezone=match[5] or "",
+        )
+        for match in map(DATED_ROW.match, lines) if match
+    ]
+    tasks = [
+        SimpleNamespace(name=match[2], priority=match[4])
+        for match in map(TASK_ROW.match, lines) if match
+    ]
+
+    free = FreeTimeIndex.from_availabilities(availabilities, now, now + timedelta(days=RULES_HORIZON_DAYS))
+    return {"recs": [
+        {"title": f"Work on {task.name}", "start_time": start.isoformat(), "end_time": end.isoformat()}
+        for task, start, end in place_tasks(tasks, free)
+    ]}
+
+
+def answering_model(answer, latency = 0.0):
+    """
+    Builds a local pydantic_ai model that answers every run from a function of its prompt.
+
+    When the prompt holds no context rows, because the agent does not inline it, the model first
+    calls the agent's getTasks and getAvailabilities tools like a real model would.
+
+    Args:
+        answer (Callable[[str], dict]): Returns the result tool's arguments for the prompt and tool results
+        latency (float): Seconds each model turn waits before answering, to stand in for a real model
+    """
+    def needs_context(messages, info):
+        called = any(isinstance(part, ToolReturnPart) for message in messages for part in message.parts)
+        tools = {tool.name for tool in info.function_tools}
+        text = prompt_text(messages)
+        return not called and {"getTasks", "getAvailabilities"} <= tools and TASK_HEADER not in text and not any(map(PLAN_ROW.match, text.splitlines()))
+
+    async def respond(messages, info):
+        await asyncio.sleep(latency)
+        if needs_context(messages, info):
+            return ModelResponse(parts=[ToolCallPart.from_raw_args("getTasks", {}), ToolCallPart.from_raw_args("getAvailabilities", {})])
+        return ModelResponse(parts=[ToolCallPart.from_raw_args(info.result_tools[0].name, answer(prompt_text(messages)))])
+
+    async def stream(messages, info):
+        await asyncio.sleep(latency)
+        if needs_context(messages, info):
+            yield {0: DeltaToolCall(name="getTasks", json_args="{}"), 1: DeltaToolCall(name="getAvailabilities", json_args="{}")}
+            return
+        payload = json.dumps(answer(prompt_text(messages)))
+        for i in range(0, len(payload), 64):
+            yield {0: DeltaToolCall(name=info.result_tools[0].name if i == 0 else None, json_args=payload[i:i + 64])}
+
+    return FunctionModel(respond, stream_function=stream)
+
+
+class ModelBackend:
+    """
+    A configured way of answering the recommendation agent, built from an entry of RECOMMENDATION_BACKENDS.
+
+    Attributes:
+        name (str): The entry's name
+        timeout (float): Seconds a model call may take before the gateway gives up on it
+        latency_budget (float): Seconds a call is expected to take, slower calls are counted as overruns
+        cost (float): Relative cost of a call, None keeps the backend out of automatic selection
+    """
+    def __init__(self, name, timeout = None, latency_budget = None, cost = None):
+        self.name = name
+        self.timeout = timeout or settings.RECOMMENDATION_MODEL_TIMEOUT_SECONDS
+        self.latency_budget = latency_budget
+        self.cost = cost
+
+    def build(self, http_client = None):
+        """
+        Returns the pydantic_ai model the agent runs on.
+
+        Args:
+            http_client (httpx.AsyncClient): The process's pooled client, for backends calling a provider
+        """
+        raise NotImplementedError
+
+    async def warm_up(self, model):
+        """
+        Prepares a built model before its first request, such as by authenticating.
+        """
+
+
+class VertexBackend(ModelBackend):
+    """
+    Gemini on Vertex AI. Needs the network and credentials for the GCP project.
+    """
+    def __init__(self, name, model = "gemini-1.5-flash", project_id = None, region = "us-central1", **kwargs):
+        super().__init__(name, **kwargs)
+        self.model = model
+        self.project_id = project_id
+        self.region = region
+
+    def build(self, http_client = None):
+        # Imported here so the offline backends work without the Vertex AI dependencies
+        from pydantic_ai.models.vertexai import VertexAIModel
+        return VertexAIModel(self.model, project_id = self.project_id, region = self.region, http_client = http_client)
+
+    async def warm_up(self, model):
+        await model.ainit()
+
+
+class RuleBasedBackend(ModelBackend):
+    """
+    A local model scheduling the prompt's tasks into its availabilities with fixed rules.
+
+    Needs no network and answers in microseconds, for degraded operation, development and benchmarks.
+    """
+    def __init__(self, name, latency = 0.0, **kwargs):
+        super().__init__(name, **kwargs)
+        self.latency = latency
+
+    def build(self, http_client = None):
+        return answering_model(rule_based_recommendation, self.latency)
+
+
+class ReplayBackend(ModelBackend):
+    """
+    Replays responses recorded from another backend, for deterministic tests and benchmarks.
+
+    Recordings are the JSON lines written when RECOMMENDATION_RECORD_FILE is set, matched on the prompt
+    without its time. A prompt that was never recorded is answered by the rules of RuleBasedBackend,
+    or fails the run when `strict` is set.
+    """
+    def __init__(self, name, path = None, strict = False, **kwargs):
+        super().__init__(name, **kwargs)
+        self.path = Path(path or settings.RECOMMENDATION_RECORD_FILE or "")
+        self.strict = strict
+        self._recordings = None
+        self._lock = threading.Lock()
+
+    def recordings(self):
+        with self._lock:
+            if self._recordings is None:
+                self._recordings = {}
+                if self.path.is_file():
+                    with self.path.open() as lines:
+                        for line in lines:
+                            if line.strip():
+                                recording = json.loads(line)
+                                self._recordings[recording["key"]] = recording["result"]
+            return self._recordings
+
+    def answer(self, prompt):
+        result = self.recordings().get(prompt_key(prompt))
+        if result is not None:
+            return result
+        if self.strict:
+            raise LookupError(f"No recorded response in {self.path} for the prompt {prompt[:80]!r}")
+        logger.info("No recorded response for the prompt, answering it with rules")
+        return rule_based_recommendation(prompt)
+
+    def build(self, http_client = None):
+        return answering_model(self.answer)
+
+
+def record_response(prompt, result):
+    """
+    Appends a model's answer to RECOMMENDATION_RECORD_FILE, if set, for ReplayBackend to replay.
+
+    Args:
+        prompt (str): The prompt the agent sent
+        result (dict): The dumped RecommendationOutput the model answered with
+    """
+    path = settings.RECOMMENDATION_RECORD_FILE
+    if not path:
+        return
+    with open(path, "a") as recordings:
+        recordings.write(json.dumps({"key": prompt_key(prompt), "result": result}, default=str) + "\n")
+
+
+def load_backend(name):
+    """
+    Builds the backend configured under a name in RECOMMENDATION_BACKENDS.
+
+    Raises:
+        ImproperlyConfigured: No backend has that name
+    """
+    try:
+        config = settings.RECOMMENDATION_BACKENDS[name]
+    except KeyError:
+        raise ImproperlyConfigured(f"No recommendation backend named {name!r}, expected one of {', '.join(settings.RECOMMENDATION_BACKENDS)}")
+    options = {key.lower(): value for key, value in config.get("OPTIONS", {}).items()}
+    return import_string(config["BACKEND"])(
+        name, timeout=config.get("TIMEOUT"), latency_budget=config.get("LATENCY_BUDGET"), cost=config.get("COST"), **options
+    )
+
+
+def select_backend(sla):
+    """
+    Picks the cheapest backend whose latency budget is within an SLA.
+
+    Only backends with both a COST and a LATENCY_BUDGET are considered.
+
+    Args:
+        sla (float): Seconds a model call may take
+
+    Raises:
+        ImproperlyConfigured: No backend meets the SLA
+    """
+    backends = [load_backend(name) for name in settings.RECOMMENDATION_BACKENDS]
+    eligible = [backend for backend in backends if backend.cost is not None and backend.latency_budget is not None and backend.latency_budget <= sla]
+    if not eligible:
+        raise ImproperlyConfigured(f"No recommendation backend has a latency budget within {sla}s")
+    return min(eligible, key=lambda backend: (backend.cost, backend.latency_budget))
+
+
+def get_backend(name = None):
+    """
+    Returns the backend named by RECOMMENDATION_BACKEND, or the one select_backend picks when it is "auto".
+
+    Args:
+        name (str): A backend to use instead of RECOMMENDATION_BACKEND
+    """
+    name = name or settings.RECOMMENDATION_BACKEND
+    if name == "auto":
+        return select_backend(settings.RECOMMENDATION_LATENCY_SLA_SECONDS)
+    return load_backend(name)
@@ -0,0 +1,292 @@
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import time as clock, timedelta
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.test import Client
+from django.utils import timezone
+
+from .freetime import DAYS_OF_WEEK
+from .jobs import enqueue
+from .models import CustomUser, Person, Task, Availability
+
+BENCHMARK_PASSWORD = "benchmark-password"
+
+#Rows handed to bulk_create at once while seeding
+SEED_BATCH_SIZE = 5000
+
+
+@dataclass
+class SeededData:
+    """
+    The synthetic people a benchmark runs against.
+
+    Attributes:
+        user_ids (List[int]): The ids of the seeded CustomUsers
+        person_ids (List[int]): The ids of their Persons, in the same order
+        seconds (float): How long seeding took
+    """
+    user_ids : list
+    person_ids : list
+    seconds : float
+
+
+def seed(users, tasks_per_user, seed = 0):
+    """
+    Fills the database with synthetic users, each with tasks and a week of availabilities.
+
+    Tasks are due from 3 days ago to 30 days ahead, a fifth are completed and a tenth have no due date.
+    Every password is BENCHMARK_PASSWORD, hashed once for all users.
+
+    Args:
+        users (int): How many users to create
+        tasks_per_user (int): How many tasks each user gets
+        seed (int): Seed of the random data, the same seed gives the same data
+
+    Returns:
+        SeededData: The seeded ids
+    """
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    now = timezone.now()
+    password = make_password(BENCHMARK_PASSWORD)
+
+    user_ids = []
+    person_ids = []
+    for batch_start in range(0, users, SEED_BATCH_SIZE):
+        batch = range(batch_start, min(batch_start + SEED_BATCH_SIZE, users))
+        created = CustomUser.objects.bulk_create(
+            CustomUser(username=f"bench-{i}", email=f"bench-{i}@example.com", password=password) for i in batch
+        )
+        people = Person.objects.bulk_create(Person(user=user) for user in created)
+        user_ids += [user.id for user in created]
+        person_ids += [person.id for person in people]
+
+        Availability.objects.bulk_create(
+            (
+                Availability(person=person, day_of_week=day, start_time=clock(start_hour), end_time=clock(start_hour + length))
+                for person in people
+                for day in DAYS_OF_WEEK
+                for start_hour, length in ((rng.choice((8, 9, 10)), 3), (rng.choice((13, 14)), rng.choice((2, 3, 4))))
+            ),
+            batch_size=SEED_BATCH_SIZE,
+        )
+
+        def tasks():
+            for person in people:
+                for i in range(tasks_per_user):
+                    yield Task(
+                        person=person,
+                        name=f"Task {i} of {person.id}",
+                        is_completed=rng.random() < 0.2,
+                        due_date=None if rng.random() < 0.1 else now + timedelta(hours=rng.randint(-72, 720)),
+                        priority=rng.choice(("high", "medium", "low")),
+                    )
+
+        tasks = tasks()
+        while chunk := list(itertools.islice(tasks, SEED_BATCH_SIZE)):
+            Task.objects.bulk_create(chunk)
+
+    return SeededData(user_ids=user_ids, person_ids=person_ids, seconds=time.perf_counter() - start)
+
+
+@dataclass
+class Endpoint:
+    """
+    One request the benchmark drives.
+
+    Attributes:
+        name (str): The name results are reported under
+        method (str): "get" or "post"
+        path (str): The url path
+        prepare (Callable): Given the client, the user id and the person id, returns the
+            path and data for one request, run before the request is timed
+    """
+    name : str
+    method : str
+    path : str
+    prepare : object = None
+
+    def request(self, client, user_id, person_id):
+        path, data = self.path, None
+        if self.prepare is not None:
+            path, data = self.prepare(client, user_id, person_id)
+
+        if self.method == "post":
+            return lambda: client.post(path, data, content_type="application/json")
+        return lambda: client.get(path, data)
+
+
+_unique = itertools.count()
+
+
+def _new_task(person_id):
+    return Task.objects.create(person_id=person_id, name="Benchmark task", priority="medium").id
+
+
+def _open_task(person_id):
+    return Task.objects.filter(person_id=person_id, is_completed=False).values_list('id', flat=True).first() or _new_task(person_id)
+
+
+def _availabilities(client, user_id, person_id):
+    hour = random.choice((8, 9, 10))
+    return "/api/save-availabilities", {"availabilities": [
+        {"day_of_week": day, "start_time": f"{hour:02}:00", "end_time": f"{hour + 3:02}:00"} for day in DAYS_OF_WEEK
+    ]}
+
+
+def _batch(client, user_id, person_id):
+    return "/api/batch-events", {"operations": [
+        {"op": "create", "task": {"name": "Batch task", "is_completed": False, "priority": "low"}},
+        {"op": "create", "task": {"name": "Batch task", "is_completed": False, "priority": "high", "due_date": (timezone.now() + timedelta(days=2)).isoformat()}},
+        {"op": "update", "task_id": _open_task(person_id), "task": {"priority": "high"}},
+        {"op": "complete", "task_id": _new_task(person_id)},
+        {"op": "delete", "task_id": _new_task(person_id)},
+    ]}
+
+
+def _logout(client, user_id, person_id):
+    #The client logs out with every request, so it is logged in again first
+    client.force_login(CustomUser.objects.get(id=user_id))
+    return "/api/logout", {}
+
+
+def _job(client, user_id, person_id):
+    return f"/api/recommendations/{enqueue(Person.objects.get(id=person_id), 'local').id}", None
+
+
+ENDPOINTS = [
+    Endpoint("create-user", "post", "", lambda client, user_id, person_id: ("/api/create-user", {"username": f"new-{next(_unique)}-{user_id}", "email": f"new-{next(_unique)}-{user_id}@example.com", "password": BENCHMARK_PASSWORD})),
+    Endpoint("verify-user", "get", "", lambda client, user_id, person_id: ("/api/verify-user/", {"username": f"free-{next(_unique)}", "email": f"free-{next(_unique)}@example.com"})),
+    Endpoint("login", "get", "", lambda client, user_id, person_id: ("/api/login/", {"username": CustomUser.objects.get(id=user_id).username, "password": BENCHMARK_PASSWORD})),
+    Endpoint("loggedin", "get", "/api/loggedin"),
+    Endpoint("logout", "post", "", _logout),
+    Endpoint("get-events", "get", "/api/get-events"),
+    Endpoint("get-events-open-page", "get", "", lambda client, user_id, person_id: ("/api/get-events", {"completed": "false", "limit": 50, "fields": "task_id,name,due_date,priority"})),
+    Endpoint("add-event", "post", "", lambda client, user_id, person_id: ("/api/add-event", {"name": "Added task", "is_completed": False, "priority": "medium", "due_date": (timezone.now() + timedelta(days=3)).isoformat()})),
+    Endpoint("remove-event", "post", "", lambda client, user_id, person_id: ("/api/remove-event", {"task_id": _new_task(person_id)})),
+    Endpoint("batch-events", "post", "", _batch),
+    Endpoint("get-availabilities", "get", "/api/get-availabilities"),
+    Endpoint("save-availabilities", "post", "", _availabilities),
+    Endpoint("get-recommendation-local", "get", "/api/get-recommendation?engine=local"),
+    Endpoint("get-recommendation-agent", "get", "/api/get-recommendation?engine=agent"),
+    Endpoint("get-recommendation-hybrid", "get", "/api/get-recommendation?engine=hybrid"),
+    Endpoint("stream-recommendation-local", "get", "/api/stream-recommendation?engine=local"),
+    Endpoint("stream-recommendation-agent", "get", "/api/stream-recommendation?engine=agent"),
+    Endpoint("create-recommendation-job", "post", "", lambda client, user_id, person_id: ("/api/recommendations", {"engine": "local"})),
+    Endpoint("get-recommendation-job", "get", "", _job),
+    Endpoint("metrics", "get", "/api/metrics"),
+]
+
+
+def percentile(values, share):
+    """
+    Returns the value below which `share` of the sorted values fall, by the nearest-rank method.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(share * len(values)) - 1))]
+
+
+@dataclass
+class EndpointResult:
+    latencies : list = field(default_factory=list)
+    queries : list = field(default_factory=list)
+    statuses : dict = field(default_factory=dict)
+    errors : int = 0
+    exceptions : dict = field(default_factory=dict)
+    seconds : float = 0.0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "exceptions": self.exceptions,
+            "statuses": self.statuses,
+            "throughput_rps": round(count / self.seconds, 2) if self.seconds else None,
+            "latency_ms": {
+                "mean": round(sum(latencies) / count * 1000, 3) if count else None,
+                **{name: round(percentile(latencies, share) * 1000, 3) if count else None for name, share in (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99))},
+                "max": round(latencies[-1] * 1000, 3) if count else None,
+            },
+            "queries": {
+                "mean": round(sum(self.queries) / len(self.queries), 2) if self.queries else None,
+                "max": max(self.queries) if self.queries else None,
+            },
+        }
+
+
+def consume(response):
+    """
+    Reads a streamed response to its end, the way a client would.
+    """
+    if response.is_async:
+        async def read():
+            return b"".join([chunk async for chunk in response.streaming_content])
+        return async_to_sync(read)()
+    return b"".join(response.streaming_content)
+
+
+def drive(endpoint, data, requests, concurrency, rng):
+    """
+    Sends `requests` requests to an endpoint from `concurrency` threads at once.
+
+    Each thread has its own logged in client for one of the seeded users.
+
+    Args:
+        endpoint (Endpoint): The endpoint to drive
+        data (SeededData): The seeded users to send the requests as
+        requests (int): How many requests to send in total
+        concurrency (int): How many requests are in flight at once
+        rng (random.Random): Picks the users
+
+    Returns:
+        EndpointResult: The latency, queries and status of every request
+    """
+    result = EndpointResult()
+    lock = threading.Lock()
+    users = [rng.randrange(len(data.user_ids)) for _ in range(concurrency)]
+
+    def worker(slot, count):
+        client = Client()
+        user_id, person_id = data.user_ids[users[slot]], data.person_ids[users[slot]]
+        client.force_login(CustomUser.objects.get(id=user_id))
+
+        for _ in range(count):
+            try:
+                send = endpoint.request(client, user_id, person_id)
+                start = time.perf_counter()
+                response = send()
+                if response.streaming:
+                    consume(response)
+            except Exception as error:
+                with lock:
+                    result.errors += 1
+                    name = f"{type(error).__name__}: {error}"
+                    result.exceptions[name] = result.exceptions.get(name, 0) + 1
+                continue
+            seconds = time.perf_counter() - start
+
+            with lock:
+                result.latencies.append(seconds)
+                result.statuses[response.status_code] = result.statuses.get(response.status_code, 0) + 1
+                if response.status_code >= 500:
+                    result.errors += 1
+                stats = getattr(response, "perf_stats", None)
+                if stats is not None:
+                    result.queries.append(stats.queries)
+
+    shares = [requests // concurrency + (1 if slot < requests % concurrency else 0) for slot in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, slot, count) for slot, count in enumerate(shares) if count]:
+            future.result()
+    result.seconds = time.perf_counter() - start
+    return result
@@ -0,0 +1,127 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .schemas import PersonSchema
+
+RECOMMENDATION_CACHE_ALIAS = "recommendations"
+
+
+def time_bucket(now = None):
+    """
+    Floors a time to the recommendation time bucket.
+
+    The agent is told the current time, so recommendations are only reusable within the same bucket.
+
+    Args:
+        now (datetime): The time to floor, defaults to the current time
+    """
+    now = now or timezone.now()
+    minutes = settings.RECOMMENDATION_TIME_BUCKET_MINUTES
+    return now.replace(minute=now.minute - now.minute % minutes, second=0, microsecond=0)
+
+
+def snapshot_key(user:PersonSchema, engine, now = None):
+    """
+    Builds a content-addressed cache key for a user's tasks and availabilities.
+
+    Args:
+        user (PersonSchema): The snapshot of the user the recommendation is made from
+        engine (str): The engine that makes the recommendation
+        now (datetime): The time the recommendation is made at
+    """
+    digest = hashlib.sha256()
+    digest.update(user.model_dump_json().encode())
+    digest.update(engine.encode())
+    digest.update(time_bucket(now).isoformat().encode())
+    return f"recommendation:{digest.hexdigest()}"
+
+
+def data_digest(user:PersonSchema, engine):
+    """
+    Fingerprints a user's tasks and availabilities for an engine, without the time bucket.
+
+    Stored recommendations keep it to tell whether the data they were made from has changed since.
+
+    Args:
+        user (PersonSchema): The snapshot of the user the recommendation is made from
+        engine (str): The engine that makes the recommendation
+    """
+    digest = hashlib.sha256()
+    digest.update(user.model_dump_json().encode())
+    digest.update(engine.encode())
+    return digest.hexdigest()
+
+
+class RecommendationCache:
+    """
+    Stores recommendations keyed on the snapshot they were made from.
+
+    The storage is the Django cache configured under the "recommendations" alias, so the
+    backend (local memory, file or database), the TTL and the eviction are set in settings.
+    Entries are stored under a version token of their person, so a save drops all of their
+    entries by starting a new version, and the old ones simply expire.
+    """
+    def __init__(self, alias = RECOMMENDATION_CACHE_ALIAS):
+        self.cache = caches[alias]
+
+    def _version_key(self, person_id):
+        return f"recommendation-version:{person_id}"
+
+    def version(self, person_id):
+        """
+        Returns the person's current version token, starting a new one if none is stored.
+        """
+        key = self._version_key(person_id)
+        version = self.cache.get(key)
+        if version is None:
+            # add keeps a token another request stored first
+            self.cache.add(key, uuid.uuid4().hex, None)
+            version = self.cache.get(key)
+        return version
+
+    async def aversion(self, person_id):
+        """
+        Async version of version for views running on the event loop.
+        """
+        key = self._version_key(person_id)
+        version = await self.cache.aget(key)
+        if version is None:
+            await self.cache.aadd(key, uuid.uuid4().hex, None)
+            version = await self.cache.aget(key)
+        return version
+
+    def get(self, person_id, key):
+        return self.cache.get(f"{key}:{self.version(person_id)}")
+
+    def set(self, person_id, key, recommendation):
+        """
+        Stores a recommendation under the person's current version.
+
+        Args:
+            person_id (int): The id of the Person the recommendation belongs to
+            key (str): The snapshot key from snapshot_key
+            recommendation (dict): The dumped RecommendationOutput
+        """
+        self.cache.set(f"{key}:{self.version(person_id)}", recommendation)
+
+    async def aget(self, person_id, key):
+        return await self.cache.aget(f"{key}:{await self.aversion(person_id)}")
+
+    async def aset(self, person_id, key, recommendation):
+        """
+        Async version of set for views running on the event loop.
+        """
+        await self.cache.aset(f"{key}:{await self.aversion(person_id)}", recommendation)
+
+    def invalidate(self, person_id):
+        """
+        Drops every cached recommendation of a person.
+
+        Args:
+            person_id (int): The id of the Person whose tasks or availabilities changed
+        """
+        self.cache.set(self._version_key(person_id), uuid.uuid4().hex, None)
@@ -0,0 +1,145 @@
+import math
+from dataclasses import dataclass, field
+from datetime import time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .freetime import DAYS_OF_WEEK, EXCEPTION, OVERRIDE, WEEKLY
+from .schemas import PersonSchema
+from .scheduler import PRIORITY_RANK
+
+#Characters per token of the model's tokenizer, close enough for budgeting English text
+CHARS_PER_TOKEN = 4
+
+#Task names longer than this are cut, a few words are enough to schedule by
+MAX_NAME_LENGTH = 60
+
+TASK_HEADER = "id|name|due|priority"
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+@dataclass
+class PromptContext:
+    """
+    The tasks and availabilities of a user, written compactly for the model.
+
+    Attributes:
+        tasks (str): One `id|name|due|priority` row per task, most important first
+        availabilities (str): One `Day HH:MM-HH:MM` row per weekly slot, then one row per dated override or exception
+        tokens (int): Estimated tokens of both texts together
+        omitted (int): Open tasks left out to stay within the budget
+        task_ids (Set[int]): The ids of the tasks written
+    """
+    tasks : str
+    availabilities : str
+    tokens : int
+    omitted : int
+    task_ids : set = field(default_factory=set)
+
+
+def context_rank(task, now):
+    """
+    Sort key deciding which tasks are kept when the budget runs out.
+
+    Overdue tasks come first, then higher priorities, then earlier due dates, then undated tasks.
+    """
+    overdue = task.due_date is not None and task.due_date < now
+    return (
+        not overdue,
+        PRIORITY_RANK.get(task.priority, len(PRIORITY_RANK)),
+        task.due_date is None,
+        task.due_date or now,
+        task.task_id,
+    )
+
+
+def task_row(task, tz):
+    name = " ".join(task.name.replace("|", "/").split())
+    if len(name) > MAX_NAME_LENGTH:
+        name = name[:MAX_NAME_LENGTH - 1] + "…"
+    due = task.due_date.astimezone(tz).strftime("%Y-%m-%d %H:%M") if task.due_date is not None else "-"
+    return f"{task.task_id}|{name}|{due}|{task.priority}"
+
+
+def availability_rows(availabilities, today = None):
+    """
+    Writes a user's availabilities as rows, the weekly rules by day and then the dated overrides and exceptions by date.
+
+    Args:
+        availabilities (List[AvailabilitySchema]): The user's availability rules, overrides and exceptions
+        today (date): Rules that ended and dates before it are left out
+    """
+    weekly = []
+    dated = []
+    for avail in availabilities:
+        kind = getattr(avail, "kind", WEEKLY)
+        if avail.start_time >= avail.end_time and avail.end_time != time.max:
+            continue
+        suffix = f" tz {avail.timezone}" if getattr(avail, "timezone", "") else ""
+        if kind == WEEKLY:
+            if avail.day_of_week not in DAYS_OF_WEEK or (today and avail.ends_on and avail.ends_on < today):
+                continue
+            recurrence = f" every {avail.interval_weeks}w" if avail.interval_weeks > 1 else ""
+            recurrence += f" from {avail.starts_on}" if avail.starts_on else ""
+            recurrence += f" to {avail.ends_on}" if avail.ends_on else ""
+            weekly.append((DAYS_OF_WEEK.index(avail.day_of_week), avail.start_time, avail.end_time, recurrence + suffix))
+        elif avail.date is not None and not (today and avail.date < today):
+            whole_day = kind == EXCEPTION and avail.start_time == time.min and avail.end_time == time.max
+            times = "" if whole_day else f" {avail.start_time:%H:%M}-{avail.end_time:%H:%M}"
+            dated.append((avail.date, kind != EXCEPTION, avail.start_time, f"{avail.date} {'only' if kind == OVERRIDE else 'off'}{times}{suffix}"))
+
+    return [f"{DAYS_OF_WEEK[day][:3]} {start:%H:%M}-{end:%H:%M}{suffix}" for day, start, end, suffix in sorted(weekly)] + [row for *_, row in sorted(dated)]
+
+
+def build_context(user:PersonSchema, now = None, budget = None, horizon_days = None):
+    """
+    Writes the part of a user's tasks and availabilities the model needs within a token budget.
+
+    Completed tasks and tasks due past the horizon are left out. The availabilities are always
+    kept, the tasks are then added in order of context_rank until the budget is used up.
+
+    Args:
+        user (PersonSchema): The user's tasks and availabilities
+        now (datetime): The current time, defaults to the current local time
+        budget (int): Most tokens to use, defaults to RECOMMENDATION_CONTEXT_TOKEN_BUDGET
+        horizon_days (int): How far ahead due dates are kept, defaults to RECOMMENDATION_CONTEXT_HORIZON_DAYS
+
+    Returns:
+        PromptContext: The compact tasks and availabilities
+    """
+    now = now or timezone.localtime()
+    budget = budget if budget is not None else settings.RECOMMENDATION_CONTEXT_TOKEN_BUDGET
+    horizon = now + timedelta(days=horizon_days if horizon_days is not None else settings.RECOMMENDATION_CONTEXT_HORIZON_DAYS)
+    tz = timezone.get_current_timezone()
+
+    availabilities = "\n".join(availability_rows(user.availabilities, now.date())) or "none"
+    tokens = estimate_tokens(availabilities) + estimate_tokens(TASK_HEADER)
+
+    tasks = sorted(
+        (task for task in user.tasks if not task.is_completed and (task.due_date is None or task.due_date <= horizon)),
+        key=lambda task: context_rank(task, now),
+    )
+
+    rows = [TASK_HEADER]
+    task_ids = set()
+    for task in tasks:
+        row = task_row(task, tz)
+        # Each row also costs its newline
+        cost = estimate_tokens(row + "\n")
+        if tokens + cost > budget:
+            break
+        rows.append(row)
+        task_ids.add(task.task_id)
+        tokens += cost
+
+    return PromptContext(
+        tasks="\n".join(rows),
+        availabilities=availabilities,
+        tokens=tokens,
+        omitted=len(tasks) - (len(rows) - 1),
+        task_ids=task_ids,
+    )
@@ -0,0 +1,463 @@
+import hashlib
+import heapq
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from django.core.cache import cache
+from django.utils import timezone
+
+DAYS_OF_WEEK = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+#Availability kinds, as stored in Availability.kind
+WEEKLY = "weekly"
+OVERRIDE = "override"
+EXCEPTION = "exception"
+
+#The Monday weeks of rules repeating every few weeks count from when they have no starts_on
+EPOCH_MONDAY = date(2001, 1, 1)
+
+#Weeks of expanded windows cached per person
+WEEK_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def _zone(avail, default):
+    name = getattr(avail, "timezone", "")
+    return ZoneInfo(name) if name else default
+
+
+def _window(day, avail, zone, tz):
+    """
+    Returns a slot's window on a date in its own time zone, converted to `tz`.
+
+    A slot ending at time.max ends at midnight, so a whole day is covered.
+    """
+    start = datetime.combine(day, avail.start_time, tzinfo=zone)
+    if avail.end_time == time.max:
+        end = datetime.combine(day + timedelta(days=1), time.min, tzinfo=zone)
+    else:
+        end = datetime.combine(day, avail.end_time, tzinfo=zone)
+    if zone is tz:
+        return start, end
+    if tz is None:
+        # Naive ranges are read in the current time zone
+        return timezone.make_naive(start), timezone.make_naive(end)
+    return start.astimezone(tz), end.astimezone(tz)
+
+
+def _local_date(value, zone):
+    if value.tzinfo is zone:
+        return value.date()
+    return (timezone.make_aware(value) if value.tzinfo is None else value).astimezone(zone).date()
+
+
+def _occurrences(avail, zone, first, last, skipped, tz):
+    """
+    Yields the windows of a weekly rule on the dates from `first` to `last` it recurs on, in order.
+
+    Args:
+        skipped (Set[date]): Dates whose weekly slots are replaced by overrides
+    """
+    starts_on = getattr(avail, "starts_on", None)
+    ends_on = getattr(avail, "ends_on", None)
+    interval = max(getattr(avail, "interval_weeks", 1) or 1, 1)
+    first = max(first, starts_on) if starts_on else first
+    last = min(last, ends_on) if ends_on else last
+
+    day = first + timedelta(days=(DAYS_OF_WEEK.index(avail.day_of_week) - first.weekday()) % 7)
+    if interval > 1:
+        anchor = starts_on or EPOCH_MONDAY
+        behind = (day - (anchor - timedelta(days=anchor.weekday()))).days // 7 % interval
+        if behind:
+            day += timedelta(weeks=interval - behind)
+
+    while day <= last:
+        if day not in skipped:
+            yield _window(day, avail, zone, tz)
+        day += timedelta(weeks=interval)
+
+
+def _merge(windows):
+    #Overlapping and touching windows are merged so the same time is never handed out twice
+    current = None
+    for window_start, window_end in windows:
+        if current is not None and window_start <= current[1]:
+            current = (current[0], max(current[1], window_end))
+            continue
+        if current is not None:
+            yield current
+        current = (window_start, window_end)
+    if current is not None:
+        yield current
+
+
+def _free(windows, busy):
+    """
+    Yields the parts of windows outside busy blocks.
+
+    Args:
+        windows (Iterable[Tuple[datetime, datetime]]): Non-overlapping windows sorted by start time
+        busy (List[Tuple[datetime, datetime]]): Blocks sorted by start time
+    """
+    i = 0
+    for window_start, window_end in windows:
+        #Blocks ending before this window cannot overlap it or any later one
+        while i < len(busy) and busy[i][1] <= window_start:
+            i += 1
+
+        start = window_start
+        j = i
+        while j < len(busy) and busy[j][0] < window_end:
+            if busy[j][0] > start:
+                yield (start, busy[j][0])
+            start = max(start, busy[j][1])
+            j += 1
+        if start < window_end:
+            yield (start, window_end)
+
+
+def iter_windows(availabilities, start, end):
+    """
+    Lazily expands availabilities into concrete datetime windows between two datetimes.
+
+    Weekly rules recur on their day every `interval_weeks` weeks between `starts_on` and `ends_on`.
+    An override replaces the weekly slots of its date with its own, and an exception takes its time
+    out of whatever is left. Each slot is read in its own time zone, or in the zone of `start`.
+
+    Every weekly rule is its own generator of occurrences and they are merged by start time, so
+    windows are produced one at a time and a consumer that stops early expands nothing more.
+
+    Args:
+        availabilities (List[AvailabilitySchema]): The user's availability rules, overrides and exceptions
+        start (datetime): Aware datetime where the expansion begins, windows are clipped to it
+        end (datetime): Aware datetime where the expansion stops
+
+    Yields:
+        Tuple[datetime, datetime]: The non-overlapping windows in order of start time, in the zone of `start`
+    """
+    tz = start.tzinfo
+    rules = []
+    overrides = []
+    exceptions = []
+    for avail in availabilities:
+        kind = getattr(avail, "kind", WEEKLY)
+        #Slots that do not end after they start cannot hold any work, unless they run to midnight
+        if avail.end_time <= avail.start_time and avail.end_time != time.max:
+            continue
+        if kind == WEEKLY:
+            if avail.day_of_week in DAYS_OF_WEEK:
+                rules.append(avail)
+        elif avail.date is not None:
+            (overrides if kind == OVERRIDE else exceptions).append(avail)
+
+    # A dated slot in another zone can fall on the day either side of the range in the zone of `start`
+    first = start.date() - timedelta(days=1)
+    last = end.date() + timedelta(days=1)
+    skipped = {avail.date for avail in overrides if first <= avail.date <= last}
+
+    def dated(records):
+        return sorted(
+            window for window in (_window(avail.date, avail, _zone(avail, tz), tz) for avail in records if first <= avail.date <= last)
+            if window[0] < end and window[1] > start
+        )
+
+    occurrences = []
+    for avail in rules:
+        zone = _zone(avail, tz)
+        occurrences.append(_occurrences(
+            avail, zone, _local_date(start, zone), _local_date(end, zone), skipped, tz
+        ))
+
+    windows = heapq.merge(*occurrences, dated(overrides))
+    for window_start, window_end in _free(_merge(windows), list(_merge(dated(exceptions)))):
+        if window_start >= end:
+            return
+        window_start, window_end = max(window_start, start), min(window_end, end)
+        if window_start < window_end:
+            yield window_start, window_end
+
+
+def expand_availabilities(availabilities, start, end):
+    """
+    Expands availabilities into concrete datetime windows, see iter_windows.
+
+    Returns:
+        List[Tuple[datetime, datetime]]: The non-overlapping windows sorted by start time
+    """
+    return list(iter_windows(availabilities, start, end))
+
+
+def subtract_busy(windows, busy):
+    """
+    Removes already scheduled blocks from free windows.
+
+    Args:
+        windows (List[Tuple[datetime, datetime]]): Non-overlapping windows sorted by start time
+        busy (List[Tuple[datetime, datetime]]): Blocks that are already taken, in any order
+
+    Returns:
+        List[Tuple[datetime, datetime]]: The free parts of the windows, sorted by start time
+    """
+    return list(_free(windows, sorted(busy)))
+
+
+class FreeTimeIndex:
+    """
+    Sorted index of free time windows answering fit and capacity queries in logarithmic time.
+
+    A segment tree over window lengths finds the earliest window long enough for a block, and a
+    Fenwick tree over the same lengths sums the free time in a range. Taking time from the front
+    of a window updates both trees, so a whole schedule can be placed without rescanning the windows.
+
+    Attributes:
+        starts (List[datetime]): The start of each window, shrinking forward as time is taken
+        ends (List[datetime]): The end of each window
+    """
+    def __init__(self, windows):
+        self.starts = [start for start, _ in windows]
+        self.ends = [end for _, end in windows]
+
+        self._size = 1
+        while self._size < len(windows):
+            self._size *= 2
+        self._longest = [0.0] * (2 * self._size)
+        self._sums = [0.0] * (len(windows) + 1)
+
+        for i in range(len(windows)):
+            self._longest[self._size + i] = self._seconds(i)
+            self._add(i, self._seconds(i))
+        for node in range(self._size - 1, 0, -1):
+            self._longest[node] = max(self._longest[2 * node], self._longest[2 * node + 1])
+
+    @classmethod
+    def from_availabilities(cls, availabilities, start, end, busy = ()):
+        """
+        Builds the index of a person's free time between two datetimes.
+
+        Args:
+            availabilities (List[AvailabilitySchema]): The person's availability rules, overrides and exceptions
+            start (datetime): Aware datetime the free time starts at
+            end (datetime): Aware datetime the free time ends at
+            busy (List[Tuple[datetime, datetime]]): Already scheduled blocks to leave out
+        """
+        return cls(subtract_busy(expand_availabilities(availabilities, start, end), busy))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _seconds(self, i):
+        return max((self.ends[i] - self.starts[i]).total_seconds(), 0.0)
+
+    def _add(self, i, seconds):
+        i += 1
+        while i < len(self._sums):
+            self._sums[i] += seconds
+            i += i & -i
+
+    def _prefix(self, i):
+        #Free seconds in windows [0, i)
+        total = 0.0
+        while i > 0:
+            total += self._sums[i]
+            i -= i & -i
+        return total
+
+    def _first_at_least(self, i, seconds):
+        """
+        Finds the first window at or after position i with at least `seconds` free.
+        """
+        def descend(node, low, high):
+            if high <= i or self._longest[node] < seconds:
+                return None
+            if high - low == 1:
+                return low
+            middle = (low + high) // 2
+            found = descend(2 * node, low, middle)
+            return found if found is not None else descend(2 * node + 1, middle, high)
+
+        found = descend(1, 0, self._size)
+        return found if found is not None and found < len(self) else None
+
+    def windows(self):
+        """
+        Returns the windows that still have free time.
+
+        Returns:
+            List[Tuple[datetime, datetime]]: The free windows sorted by start time
+        """
+        return [(start, end) for start, end in zip(self.starts, self.ends) if start < end]
+
+    def subtract(self, busy):
+        """
+        Returns a new index without the given blocks.
+
+        Args:
+            busy (List[Tuple[datetime, datetime]]): Blocks that are already taken
+        """
+        return FreeTimeIndex(subtract_busy(self.windows(), busy))
+
+    def earliest_fit(self, duration, after = None, before = None):
+        """
+        Finds the earliest free stretch of at least `duration`.
+
+        Args:
+            duration (timedelta): How much uninterrupted free time is needed
+            after (datetime): The stretch may not start before this
+            before (datetime): The stretch must end by this
+
+        Returns:
+            datetime: The start of the stretch, or None if nothing fits
+        """
+        seconds = duration.total_seconds()
+        i = 0
+        if after is not None:
+            i = bisect_right(self.ends, after)
+            #The window around `after` only has its remainder free
+            if i < len(self) and self.starts[i] < after:
+                if (self.ends[i] - after).total_seconds() >= seconds:
+                    start = after
+                    return start if before is None or start + duration <= before else None
+                i += 1
+
+        found = self._first_at_least(i, seconds)
+        if found is None:
+            return None
+
+        start = self.starts[found]
+        return start if before is None or start + duration <= before else None
+
+    def take(self, start, duration):
+        """
+        Marks time as used from `start` in the window containing it.
+
+        Any free time in that window before `start` is given up too, so time should be taken
+        in order, as the scheduler does.
+
+        Args:
+            start (datetime): Where the used time starts, inside a free window
+            duration (timedelta): How much time is used, trimmed to the window
+
+        Returns:
+            datetime: Where the used time ends
+        """
+        i = bisect_right(self.starts, start) - 1
+        if i < 0 or start >= self.ends[i]:
+            raise ValueError("No free window contains the start time")
+
+        before = self._seconds(i)
+        self.starts[i] = min(start + duration, self.ends[i])
+        self._add(i, self._seconds(i) - before)
+
+        node = self._size + i
+        self._longest[node] = self._seconds(i)
+        node //= 2
+        while node:
+            self._longest[node] = max(self._longest[2 * node], self._longest[2 * node + 1])
+            node //= 2
+
+        return self.starts[i]
+
+    def capacity(self, start = None, end = None):
+        """
+        Sums the free time between two datetimes.
+
+        Args:
+            start (datetime): Where to start counting, defaults to the first window
+            end (datetime): Where to stop counting, defaults to the last window
+
+        Returns:
+            timedelta: The total free time
+        """
+        first = 0 if start is None else bisect_right(self.ends, start)
+        last = len(self) if end is None else bisect_right(self.starts, end)
+        if first >= last:
+            return timedelta(0)
+
+        seconds = self._prefix(last) - self._prefix(first)
+        if start is not None and self.starts[first] < start:
+            seconds -= min((start - self.starts[first]).total_seconds(), self._seconds(first))
+        if end is not None and self.ends[last - 1] > end:
+            seconds -= min((self.ends[last - 1] - max(end, self.starts[last - 1])).total_seconds(), self._seconds(last - 1))
+        return timedelta(seconds=max(seconds, 0.0))
+
+
+#Fields of an availability its expanded windows depend on
+DIGEST_FIELDS = ("kind", "day_of_week", "start_time", "end_time", "date", "interval_weeks", "starts_on", "ends_on", "timezone")
+
+
+def availability_digest(availabilities):
+    """
+    Fingerprints availabilities, so windows expanded from them are cached under what they were made from.
+    """
+    rows = sorted(repr(tuple(getattr(avail, field, None) for field in DIGEST_FIELDS)) for avail in availabilities)
+    return hashlib.sha256("\n".join(rows).encode()).hexdigest()[:32]
+
+
+def _week_key(digest, week):
+    return f"availability-week:{digest}:{timezone.get_current_timezone_name()}:{week.isoformat()}"
+
+
+def person_windows(availabilities, start, end):
+    """
+    Yields a person's availability windows between two datetimes, expanding each week only once.
+
+    The windows are cached per local week, Monday to Monday, under the availability_digest of the
+    availabilities. Saved availabilities have a new digest, so every process stops using the old weeks
+    at once without anything being invalidated, and people with the same week share its entries.
+    A long horizon reads all its weeks in one cache round trip and only expands the ones missing.
+
+    Args:
+        availabilities (List[AvailabilitySchema]): The person's availability rules, overrides and exceptions
+        start (datetime): Aware datetime the windows start at
+        end (datetime): Aware datetime the windows end at
+
+    Yields:
+        Tuple[datetime, datetime]: The non-overlapping windows in order of start time
+    """
+    local = timezone.localtime(start)
+    # Aware arithmetic keeps the wall clock, so every week starts at local midnight across DST changes
+    bounds = [(local - timedelta(days=local.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)]
+    while bounds[-1] < end:
+        bounds.append(bounds[-1] + timedelta(days=7))
+    weeks = list(zip(bounds, bounds[1:]))
+
+    digest = availability_digest(availabilities)
+    keys = {week: _week_key(digest, week.date()) for week, _ in weeks}
+    cached = cache.get_many(keys.values())
+    missing = {}
+
+    def clipped():
+        for week, until in weeks:
+            windows = cached.get(keys[week])
+            if windows is None:
+                windows = missing[keys[week]] = expand_availabilities(availabilities, week, until)
+            for window_start, window_end in windows:
+                if window_start >= end:
+                    return
+                if window_end > start:
+                    yield max(window_start, start), min(window_end, end)
+
+    try:
+        # Windows running past midnight on Sunday are split between weeks and joined back here
+        yield from _merge(clipped())
+    finally:
+        if missing:
+            cache.set_many(missing, WEEK_CACHE_TIMEOUT)
+
+
+def person_free_time(availabilities, start, end, busy = ()):
+    """
+    Builds the index of a person's free time from their cached weeks of availability windows.
+
+    Args:
+        availabilities (List[AvailabilitySchema]): The person's availability rules, overrides and exceptions
+        start (datetime): Aware datetime the free time starts at
+        end (datetime): Aware datetime the free time ends at
+        busy (List[Tuple[datetime, datetime]]): Already scheduled blocks to leave out
+
+    Returns:
+        FreeTimeIndex: A fresh index the caller may take time from
+    """
+    return FreeTimeIndex(subtract_busy(list(person_windows(availabilities, start, end)), busy))
+
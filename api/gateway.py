@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+import httpx
+from django.conf import settings
+from pydantic_ai.exceptions import UnexpectedModelBehavior
+
+from .metrics import CIRCUIT_OPENS, MODEL_BUDGET_OVERRUNS, MODEL_COALESCED, MODEL_RETRIES, MODEL_SECONDS, log_event
+
+logger = logging.getLogger(__name__)
+
+#Failures worth another attempt: the provider was slow, unreachable or answered with an error status
+RETRYABLE_ERRORS = (asyncio.TimeoutError, httpx.HTTPError, UnexpectedModelBehavior)
+
+
+class ModelUnavailable(Exception):
+    """
+    Raised instead of calling the model while its circuit is open, or once every attempt at a call failed.
+    Callers fall back to a cached or locally scheduled recommendation.
+    """
+
+
+def request_key(*parts):
+    """
+    Fingerprints a model request, so identical requests in flight at the same time can share one call.
+
+    Args:
+        parts (str): What the request is made from, such as the operation and the user's dumped schema
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing model provider for a while instead of piling more requests on it.
+
+    After `threshold` failures in a row the circuit opens and calls are refused for `cooldown` seconds.
+    Then a single trial call is let through: its success closes the circuit, its failure opens it again.
+
+    Attributes:
+        threshold (int): Failures in a row that open the circuit
+        cooldown (float): Seconds the circuit stays open before a trial call
+    """
+    def __init__(self, threshold = None, cooldown = None, clock = time.monotonic):
+        self.threshold = threshold or settings.RECOMMENDATION_BREAKER_FAILURES
+        self.cooldown = settings.RECOMMENDATION_BREAKER_COOLDOWN_SECONDS if cooldown is None else cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.clock() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        """
+        Returns whether a call may be made now, claiming the trial call of a half open circuit.
+        """
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self.trial:
+            return False
+        self.trial = True
+        return True
+
+    def success(self):
+        if self.opened_at is not None:
+            log_event("circuit", state="closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def release(self):
+        """
+        Gives back the trial call of a half open circuit when the call ended without telling whether the provider works,
+        such as when it was cancelled.
+        """
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+            self.opened_at = self.clock()
+            self.trial = False
+            CIRCUIT_OPENS.inc()
+            logger.warning("Model circuit opened after %s failures, calls resume in %ss", self.failures, self.cooldown)
+            log_event("circuit", state="open", failures=self.failures)
+
+
+class ModelGateway:
+    """
+    The single way model requests leave the process.
+
+    Calls wait for a slot of their user and then a global slot, so a burst of refreshes cannot flood
+    the provider and one user cannot take every slot. Identical requests in flight at the same time
+    share one call. Each attempt is bounded by a timeout and retried after a jittered exponential
+    backoff, and a CircuitBreaker refuses calls while the provider keeps failing.
+
+    The gateway's locks belong to the event loop it is first used on, the AgentRegistry's loop in the app.
+
+    Attributes:
+        concurrency (int): Most model calls in flight at once
+        user_concurrency (int): Most model calls in flight at once for one user
+        timeout (float): Seconds an attempt may take
+        retries (int): Attempts made after the first one fails
+        backoff (float): Upper bound in seconds of the wait before the first retry, doubled for each later one
+        breaker (CircuitBreaker): The provider's circuit
+        backend (str): Name of the backend the calls go to, for metrics
+        latency_budget (float): Seconds a call is expected to take, slower calls are counted as overruns
+    """
+    def __init__(self, concurrency = None, user_concurrency = None, timeout = None, retries = None, backoff = None, breaker = None, backend = "default", latency_budget = None):
+        self.concurrency = concurrency or settings.RECOMMENDATION_MODEL_CONCURRENCY
+        self.user_concurrency = user_concurrency or settings.RECOMMENDATION_MODEL_USER_CONCURRENCY
+        self.timeout = timeout or settings.RECOMMENDATION_MODEL_TIMEOUT_SECONDS
+        self.retries = settings.RECOMMENDATION_MODEL_RETRIES if retries is None else retries
+        self.backoff = settings.RECOMMENDATION_MODEL_RETRY_BACKOFF_SECONDS if backoff is None else backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.backend = backend
+        self.latency_budget = latency_budget
+        self._slots = None
+        #Dropped once no call of the user holds or waits for them
+        self._user_slots = weakref.WeakValueDictionary()
+        self._inflight = {}
+
+    @asynccontextmanager
+    async def slot(self, user):
+        """
+        Holds one of the user's slots and one global slot.
+
+        Args:
+            user (str): Whose call it is, such as the username
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        user_slots = self._user_slots.get(user)
+        if user_slots is None:
+            user_slots = self._user_slots[user] = asyncio.Semaphore(self.user_concurrency)
+
+        # The user's slot first, so a user queued behind their own call does not hold a global slot
+        async with user_slots:
+            async with self._slots:
+                yield
+
+    async def run(self, key, user, call):
+        """
+        Calls the model through the gateway, sharing the call of an identical request already in flight.
+
+        Args:
+            key (str): The request's request_key
+            user (str): Whose call it is, such as the username
+            call (Callable[[], Awaitable]): Makes one attempt, such as a lambda calling agent.run
+
+        Returns:
+            The result of the call
+
+        Raises:
+            ModelUnavailable: The circuit is open, or every attempt failed with a RETRYABLE_ERRORS error
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            MODEL_COALESCED.inc()
+        else:
+            task = self._inflight[key] = asyncio.ensure_future(self.attempts(user, call))
+            task.add_done_callback(lambda done: self._inflight.pop(key, None))
+        # A caller that goes away must not cancel the call for the others sharing it
+        return await asyncio.shield(task)
+
+    async def attempts(self, user, call):
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise ModelUnavailable("The model provider's circuit is open")
+            try:
+                async with self.slot(user):
+                    start = time.perf_counter()
+                    result = await asyncio.wait_for(call(), self.timeout)
+                    self.observe(time.perf_counter() - start)
+            except RETRYABLE_ERRORS as error:
+                self.breaker.failure()
+                if attempt == self.retries:
+                    raise ModelUnavailable(f"The model failed {attempt + 1} times: {error!r}") from error
+                MODEL_RETRIES.inc()
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.success()
+                return result
+
+    def observe(self, seconds):
+        MODEL_SECONDS.observe(seconds, backend=self.backend)
+        if self.latency_budget is not None and seconds > self.latency_budget:
+            MODEL_BUDGET_OVERRUNS.inc(backend=self.backend)
+            log_event("budget_overrun", backend=self.backend, seconds=round(seconds, 6), budget=self.latency_budget)
+
+    @asynccontextmanager
+    async def stream(self, user):
+        """
+        Holds slots for a streamed call, which cannot be retried or shared once it has started yielding.
+
+        Args:
+            user (str): Whose call it is, such as the username
+
+        Raises:
+            ModelUnavailable: The circuit is open
+        """
+        if not self.breaker.allow():
+            raise ModelUnavailable("The model provider's circuit is open")
+        async with self.slot(user):
+            start = time.perf_counter()
+            try:
+                yield
+            except RETRYABLE_ERRORS:
+                self.breaker.failure()
+                raise
+            except BaseException:
+                # Also reached when the client disconnects and the stream is closed early
+                self.breaker.release()
+                raise
+            self.observe(time.perf_counter() - start)
+            self.breaker.success()
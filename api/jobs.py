@@ -0,0 +1,174 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .loaders import aload_person_schema
+from .metrics import JOB_FAILURES, JOB_RETRIES, span
+from .models import RecommendationJob
+from .recommendations import recommend
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(person, engine = 'agent'):
+    """
+    Queues a recommendation job for a person.
+
+    A pending job for the same person and engine is reused instead of queueing an identical one.
+    A unique constraint on pending jobs makes concurrent calls share one job too.
+
+    Args:
+        person (Person): The person the recommendation is for
+        engine (str): One of RECOMMENDATION_ENGINES
+
+    Returns:
+        RecommendationJob: The new or already pending job
+    """
+    pending = RecommendationJob.objects.filter(person=person, engine=engine, status=RecommendationJob.PENDING)
+    job = pending.first()
+    if job is None:
+        try:
+            with transaction.atomic():
+                job = RecommendationJob.objects.create(person=person, engine=engine)
+        except IntegrityError:
+            # Another request queued it between the select and the insert
+            job = pending.get()
+    return job
+
+
+def claimable(now):
+    """
+    Jobs a worker may pick up: pending jobs that are due, and running jobs whose worker stopped renewing their lease.
+    """
+    lease = timedelta(seconds=settings.RECOMMENDATION_JOB_LEASE_SECONDS)
+    return Q(status=RecommendationJob.PENDING, run_after__lte=now) | Q(status=RecommendationJob.RUNNING, updated_at__lt=now - lease)
+
+
+class RecommendationWorker:
+    """
+    Runs queued recommendation jobs from the database.
+
+    Jobs are claimed with a conditional update, so several workers can share the queue without a broker.
+    At most `concurrency` jobs run at once in a worker, which bounds the requests made to the model provider.
+    Failed jobs are retried with exponential backoff until they run out of attempts.
+    A running job's lease is renewed every third of RECOMMENDATION_JOB_LEASE_SECONDS, so only jobs
+    whose worker died are claimed again, and a worker that lost its lease leaves the job alone.
+
+    Attributes:
+        concurrency (int): The most jobs this worker runs at once
+        poll_interval (float): Seconds to wait before checking an empty queue again
+    """
+    def __init__(self, concurrency = None, poll_interval = 1.0):
+        self.concurrency = concurrency or settings.RECOMMENDATION_MAX_CONCURRENCY
+        self.poll_interval = poll_interval
+        self.running = set()
+
+    async def claim(self, limit):
+        """
+        Claims up to `limit` jobs for this worker.
+
+        Returns:
+            List[RecommendationJob]: The claimed jobs
+        """
+        now = timezone.now()
+        claimed = []
+        candidates = RecommendationJob.objects.filter(claimable(now)).order_by('run_after', 'id').values_list('id', flat=True)[:limit]
+
+        async for job_id in candidates:
+            # Another worker may claim the same job between the select and the update, only one update wins
+            won = await RecommendationJob.objects.filter(claimable(now), id=job_id).aupdate(
+                status=RecommendationJob.RUNNING, attempts=F('attempts') + 1, updated_at=now
+            )
+            if won:
+                claimed.append(await RecommendationJob.objects.aget(id=job_id))
+        return claimed
+
+    def owned(self, job):
+        """
+        Returns the job's row while it still belongs to this claim, not to a later one after the lease lapsed.
+        """
+        return RecommendationJob.objects.filter(id=job.id, status=RecommendationJob.RUNNING, attempts=job.attempts)
+
+    async def heartbeat(self, job):
+        """
+        Renews a running job's lease until it is cancelled.
+        """
+        while True:
+            await asyncio.sleep(settings.RECOMMENDATION_JOB_LEASE_SECONDS / 3)
+            await self.owned(job).aupdate(updated_at=timezone.now())
+
+    async def process(self, job):
+        """
+        Runs one claimed job and records its result, or schedules its retry.
+
+        Args:
+            job (RecommendationJob): The claimed job
+        """
+        heartbeat = asyncio.create_task(self.heartbeat(job))
+        try:
+            with span("load"):
+                person_id, schema = await aload_person_schema(id=job.person_id)
+            # A fallback would finish the job without the model, while the model is unavailable the job is retried instead
+            job.result = await recommend(person_id, schema, job.engine, allow_fallback=False)
+            job.status = RecommendationJob.DONE
+            job.error = ""
+        except Exception as error:
+            logger.warning("Recommendation job %s failed on attempt %s: %s", job.id, job.attempts, error)
+            job.error = str(error)
+            if job.attempts >= settings.RECOMMENDATION_JOB_MAX_ATTEMPTS:
+                job.status = RecommendationJob.FAILED
+                JOB_FAILURES.inc(engine=job.engine)
+            else:
+                job.status = RecommendationJob.PENDING
+                JOB_RETRIES.inc(engine=job.engine)
+                job.run_after = timezone.now() + timedelta(seconds=settings.RECOMMENDATION_JOB_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+        finally:
+            heartbeat.cancel()
+
+        fields = {"status": job.status, "result": job.result, "error": job.error, "run_after": job.run_after, "updated_at": timezone.now()}
+        try:
+            updated = await self.owned(job).aupdate(**fields)
+        except IntegrityError:
+            # A newer pending job was queued while this one ran, it replaces the retry
+            updated = await self.owned(job).aupdate(**{**fields, "status": RecommendationJob.FAILED})
+        if not updated:
+            logger.warning("Recommendation job %s was claimed again after its lease lapsed, dropping attempt %s", job.id, job.attempts)
+
+    async def run_once(self):
+        """
+        Claims as many jobs as there are free slots and starts them.
+
+        Returns:
+            int: The number of jobs started
+        """
+        jobs = await self.claim(self.concurrency - len(self.running))
+        for job in jobs:
+            task = asyncio.create_task(self.process(job))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+        return len(jobs)
+
+    async def run(self, stop = None):
+        """
+        Keeps the worker's slots filled until `stop` is set.
+
+        Args:
+            stop (asyncio.Event): Set to stop claiming new jobs, running jobs are still finished
+        """
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            started = 0
+            if len(self.running) < self.concurrency:
+                started = await self.run_once()
+            if not started:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        if self.running:
+            await asyncio.gather(*self.running)
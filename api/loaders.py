@@ -0,0 +1,70 @@
+from .models import Person, Task, Availability
+from .schemas import PersonSchema, TaskSchema, AvailabilitySchema
+
+TASK_FIELDS = ('id', 'name', 'is_completed', 'due_date', 'priority')
+AVAILABILITY_FIELDS = ('id', 'day_of_week', 'start_time', 'end_time', 'kind', 'date', 'interval_weeks', 'starts_on', 'ends_on', 'timezone')
+
+
+def _person_rows(lookup):
+    return Person.objects.filter(**lookup).values('id', 'user__username', 'user__email')
+
+
+def _build(person, tasks, availabilities):
+    # Rows come straight from the database, so the schemas are built without re-validating them
+    return person['id'], PersonSchema.model_construct(
+        username=person['user__username'],
+        email=person['user__email'],
+        tasks=[TaskSchema.model_construct(task_id=task['id'], name=task['name'], is_completed=task['is_completed'], due_date=task['due_date'], priority=task['priority']) for task in tasks],
+        availabilities=[AvailabilitySchema.model_construct(avail_id=avail['id'], **{field: avail[field] for field in AVAILABILITY_FIELDS[1:]}) for avail in availabilities],
+    )
+
+
+def load_person_schema(**lookup):
+    """
+    Loads the PersonSchema used as recommendation input in a fixed number of queries.
+
+    One query joins the person to their user, one fetches the tasks and one the availabilities,
+    each projected to the schema's fields and read as plain rows instead of model instances.
+
+    Args:
+        **lookup: Filter identifying the Person, such as user_id or id
+
+    Returns:
+        Tuple[int, PersonSchema]: The Person's id and their schema
+
+    Raises:
+        Person.DoesNotExist: No Person matches the lookup
+    """
+    person = _person_rows(lookup).get()
+    tasks = Task.objects.filter(person_id=person['id']).order_by('id').values(*TASK_FIELDS)
+    availabilities = Availability.objects.filter(person_id=person['id']).order_by('id').values(*AVAILABILITY_FIELDS)
+    return _build(person, tasks, availabilities)
+
+
+async def aload_person_schema(**lookup):
+    """
+    Async version of load_person_schema for views running on the event loop.
+    """
+    person = await _person_rows(lookup).aget()
+    tasks = [task async for task in Task.objects.filter(person_id=person['id']).order_by('id').values(*TASK_FIELDS)]
+    availabilities = [avail async for avail in Availability.objects.filter(person_id=person['id']).order_by('id').values(*AVAILABILITY_FIELDS)]
+    return _build(person, tasks, availabilities)
+
+
+async def aload_person_schemas(person_ids):
+    """
+    Loads the PersonSchemas of many people at once in three queries, for batch jobs.
+
+    Args:
+        person_ids (List[int]): The ids of the Persons
+
+    Returns:
+        List[Tuple[int, PersonSchema]]: Each Person's id and schema, in id order
+    """
+    tasks = {person_id: [] for person_id in person_ids}
+    availabilities = {person_id: [] for person_id in person_ids}
+    async for task in Task.objects.filter(person_id__in=person_ids).order_by('id').values('person_id', *TASK_FIELDS):
+        tasks[task['person_id']].append(task)
+    async for avail in Availability.objects.filter(person_id__in=person_ids).order_by('id').values('person_id', *AVAILABILITY_FIELDS):
+        availabilities[avail['person_id']].append(avail)
+    return [_build(person, tasks[person['id']], availabilities[person['id']]) async for person in _person_rows({"id__in": person_ids}).order_by('id')]
@@ -0,0 +1,113 @@
+import copy
+import json
+import logging
+import platform
+import random
+import subprocess
+import tempfile
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.utils import timezone
+
+from api.agent import registry
+from api.backends import RuleBasedBackend
+from api.benchmark import ENDPOINTS, drive, seed
+
+
+def scale(value):
+    try:
+        users, tasks = value.lower().split("x")
+        return int(users), int(tasks)
+    except ValueError:
+        raise CommandError(f"Scales look like USERSxTASKS, such as 100x1000, not {value}")
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=settings.BASE_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a scratch database with synthetic users at several scales, drives every API endpoint "
+        "concurrently and prints throughput, latency percentiles and query counts as JSON. "
+        "The recommendation agent runs on the rule-based backend, so no network is needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', nargs='+', type=scale, default=[(100, 10), (10, 1000), (1, 100000)], help="USERSxTASKS per user to run at, such as 1000000x10 or 1x100000")
+        parser.add_argument('--endpoints', nargs='+', choices=[endpoint.name for endpoint in ENDPOINTS], help="Endpoints to drive, defaults to all of them")
+        parser.add_argument('--requests', type=int, default=100, help="Requests sent to each endpoint at each scale")
+        parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once")
+        parser.add_argument('--model-latency', type=float, default=0.0, help="Seconds the rule-based model waits per turn")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data and of the users picked")
+        parser.add_argument('--db-file', help="SQLite file to benchmark in, defaults to a temporary file that is removed afterwards")
+        parser.add_argument('--db-profile', choices=sorted(settings.SQLITE_PROFILES), default=settings.DATABASE_PROFILE, help="SQLite tuning to benchmark with, defaults to DATABASE_PROFILE")
+        parser.add_argument('--output', help="File to write the JSON results to instead of stdout")
+
+    def handle(self, *args, **options):
+        endpoints = [endpoint for endpoint in ENDPOINTS if not options['endpoints'] or endpoint.name in options['endpoints']]
+        db_file = options['db_file'] or str(Path(tempfile.mkdtemp(prefix="tempora-benchmark-")) / "benchmark.sqlite3")
+
+        # Per-request logs would drown the results, slow and failed requests are reported in them instead
+        for name in ("tempora.metrics", "api.middleware", "django.request"):
+            logging.getLogger(name).setLevel(logging.CRITICAL)
+
+        registry.get().agent.model = RuleBasedBackend("benchmark", latency=options['model_latency']).build()
+
+        report = {
+            "started_at": timezone.now().isoformat(),
+            "commit": commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": {"profile": options['db_profile'], **settings.SQLITE_PROFILES[options['db_profile']]},
+            "requests": options['requests'],
+            "concurrency": options['concurrency'],
+            "model_latency": options['model_latency'],
+            "scales": [],
+        }
+
+        # A file keeps SQLite's locking as in production, unlike the shared in-memory test database
+        connections['default'].settings_dict.update(copy.deepcopy(settings.SQLITE_PROFILES[options['db_profile']]))
+        connections['default'].settings_dict['TEST']['NAME'] = db_file
+        with override_settings(PERF_SAMPLE_RATE=1.0, PERF_PROFILING=False, PERF_SLOW_REQUEST_MS=float('inf')):
+            setup_test_environment()
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                for users, tasks in options['scales']:
+                    report["scales"].append(self.run_scale(users, tasks, endpoints, options))
+            finally:
+                teardown_databases(old_config, verbosity=0, keepdb=bool(options['db_file']))
+                teardown_test_environment()
+
+        output = json.dumps(report, indent=2, default=str)
+        if options['output']:
+            Path(options['output']).write_text(output + "\n")
+            self.stderr.write(f"Wrote results to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+    def run_scale(self, users, tasks, endpoints, options):
+        call_command('flush', interactive=False, verbosity=0)
+        for alias in settings.CACHES:
+            caches[alias].clear()
+
+        self.stderr.write(f"Seeding {users} users with {tasks} tasks each")
+        data = seed(users, tasks, options['seed'])
+
+        rng = random.Random(options['seed'])
+        results = {}
+        for endpoint in endpoints:
+            self.stderr.write(f"  {endpoint.name}")
+            results[endpoint.name] = drive(endpoint, data, options['requests'], options['concurrency'], rng).summary()
+
+        return {"users": users, "tasks_per_user": tasks, "seed_seconds": round(data.seconds, 3), "endpoints": results}
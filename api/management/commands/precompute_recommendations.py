@@ -0,0 +1,34 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from api.precompute import RecommendationPrecomputer
+
+
+class Command(BaseCommand):
+    help = (
+        "Makes and stores the recommendations of every active person ahead of time, so "
+        "/api/get-recommendation serves them without calling the model. Safe to rerun: people "
+        "whose stored recommendation still applies are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=['agent', 'hybrid'], default='agent', help="Engine to precompute recommendations with")
+        parser.add_argument('--concurrency', type=int, default=None, help="Most recommendations to make at once, defaults to RECOMMENDATION_MAX_CONCURRENCY")
+        parser.add_argument('--chunk-size', type=int, default=500, help="People read from the database at once")
+        parser.add_argument('--active-days', type=int, default=30, help="Only include people who logged in within this many days, 0 includes everyone active")
+        parser.add_argument('--after-id', type=int, default=0, help="Resume after this Person id, as printed in the progress lines")
+
+    def handle(self, *args, **options):
+        precomputer = RecommendationPrecomputer(
+            engine=options['engine'], concurrency=options['concurrency'],
+            chunk_size=options['chunk_size'], active_days=options['active_days'],
+        )
+        self.stdout.write(f"Precomputing {precomputer.engine} recommendations with concurrency {precomputer.concurrency}")
+
+        try:
+            progress = asyncio.run(precomputer.run(after_id=options['after_id'], report=lambda progress: self.stdout.write(str(progress))))
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped, rerun to pick up where it left off")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Done: {progress}"))
@@ -0,0 +1,22 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from api.jobs import RecommendationWorker
+
+
+class Command(BaseCommand):
+    help = "Runs queued recommendation jobs until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None, help="Most jobs to run at once, defaults to RECOMMENDATION_MAX_CONCURRENCY")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds between checks of an empty queue")
+
+    def handle(self, *args, **options):
+        worker = RecommendationWorker(concurrency=options['concurrency'], poll_interval=options['poll_interval'])
+        self.stdout.write(f"Running recommendation jobs with concurrency {worker.concurrency}")
+
+        try:
+            asyncio.run(worker.run())
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
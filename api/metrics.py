@@ -0,0 +1,177 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("tempora.metrics")
+
+#Upper bounds in seconds, from a cache hit to a slow multi-turn model call
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra = ()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    A named metric with one value per combination of label values.
+
+    Updates are guarded by a lock because the agent records from its own event loop thread.
+
+    Attributes:
+        name (str): The Prometheus metric name
+        help (str): The description shown in the exposition
+        labels (Tuple[str]): The label names every update must give
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """
+        Returns the metric's lines in the Prometheus text format, without its HELP and TYPE lines.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples())
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [f"{self.name}{_label_text(self.labels, key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    """
+    A metric counting observations into cumulative buckets, which p95 and p99 are computed from.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            #Bucket counts, then the sum and the count of every observation
+            counts = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def count(self, **labels):
+        return self._values.get(self._key(labels), [0])[-1]
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts[:-2] + [counts[-1]]):
+                    lines.append(f"{self.name}_bucket{_label_text(self.labels, key, [('le', bound)])} {bucket_count}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {counts[-2]}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, key)} {counts[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("tempora_recommendation_stage_seconds", "Time spent in each stage of making a recommendation.", ["stage"])
+RECOMMENDATION_SECONDS = Histogram("tempora_recommendation_seconds", "Time to answer a recommendation request.", ["engine", "outcome"])
+CACHE_LOOKUPS = Counter("tempora_recommendation_cache_total", "Recommendation cache lookups.", ["engine", "result"])
+MODEL_TURNS = Counter("tempora_model_turns_total", "Requests made to the model, one per model turn.", ["operation"])
+MODEL_TOKENS = Counter("tempora_model_tokens_total", "Tokens reported by the model.", ["operation", "kind"])
+CONTEXT_TOKENS = Histogram("tempora_context_tokens", "Estimated tokens of the compact context given to the model.", [], buckets=(250, 500, 1000, 2000, 4000, 8000))
+ERRORS = Counter("tempora_recommendation_errors_total", "Errors while making recommendations.", ["stage", "error"])
+JOB_RETRIES = Counter("tempora_recommendation_job_retries_total", "Recommendation jobs scheduled to run again after failing.", ["engine"])
+JOB_FAILURES = Counter("tempora_recommendation_job_failures_total", "Recommendation jobs that ran out of attempts.", ["engine"])
+MODEL_RETRIES = Counter("tempora_model_retries_total", "Model calls attempted again after a timeout or provider error.")
+MODEL_COALESCED = Counter("tempora_model_coalesced_total", "Model requests that shared an identical request's call already in flight.")
+MODEL_SECONDS = Histogram("tempora_model_call_seconds", "Time a successful model call took, per backend.", ["backend"])
+MODEL_BUDGET_OVERRUNS = Counter("tempora_model_budget_overruns_total", "Model calls slower than their backend's latency budget.", ["backend"])
+CIRCUIT_OPENS = Counter("tempora_model_circuit_opens_total", "Times the model provider's circuit opened.")
+RECOMMENDATION_VIOLATIONS = Counter("tempora_recommendation_violations_total", "Recs from the model breaking a scheduling rule, per rule.", ["kind"])
+RECOMMENDATION_REPAIRS = Counter("tempora_recommendation_repairs_total", "Recs from the model repaired locally or asked for again, per action.", ["action"])
+FALLBACKS = Counter("tempora_recommendation_fallbacks_total", "Recommendations served without the model because it was unavailable.", ["engine", "source"])
+
+HTTP_SECONDS = Histogram("tempora_http_request_seconds", "Time to answer a request, per view.", ["view", "method", "status"])
+HTTP_DB_QUERIES = Histogram("tempora_http_db_queries", "Database queries made while answering a request, per view.", ["view"], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100, 250))
+HTTP_DB_SECONDS = Histogram("tempora_http_db_seconds", "Time spent in the database while answering a request, per view.", ["view"])
+HTTP_RESPONSE_BYTES = Histogram("tempora_http_response_bytes", "Size of response bodies, per view.", ["view"], buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576))
+
+METRICS = [STAGE_SECONDS, RECOMMENDATION_SECONDS, CACHE_LOOKUPS, MODEL_TURNS, MODEL_TOKENS, CONTEXT_TOKENS, ERRORS, JOB_RETRIES, JOB_FAILURES, MODEL_RETRIES, MODEL_COALESCED, MODEL_SECONDS, MODEL_BUDGET_OVERRUNS, CIRCUIT_OPENS, FALLBACKS, RECOMMENDATION_VIOLATIONS, RECOMMENDATION_REPAIRS, HTTP_SECONDS, HTTP_DB_QUERIES, HTTP_DB_SECONDS, HTTP_RESPONSE_BYTES]
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+def log_event(event, **fields):
+    """
+    Writes a structured log line as a single JSON object.
+
+    Args:
+        event (str): What happened, such as "stage" or "model_usage"
+        fields: The values to log with it
+    """
+    logger.info(json.dumps({"event": event, **fields}, default=str))
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Times a stage of making a recommendation.
+
+    The duration is observed in STAGE_SECONDS and logged, and an exception escaping
+    the stage is counted in ERRORS before it is raised again.
+
+    Args:
+        stage (str): The stage, such as "load", "agent_build", "model" or "validate"
+        fields: Extra values for the log line
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception as error:
+        outcome = "error"
+        ERRORS.inc(stage=stage, error=type(error).__name__)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        log_event("stage", stage=stage, seconds=round(seconds, 6), outcome=outcome, **fields)
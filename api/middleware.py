@@ -0,0 +1,182 @@
+import cProfile
+import logging
+import random
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils import timezone
+
+from .metrics import HTTP_DB_QUERIES, HTTP_DB_SECONDS, HTTP_RESPONSE_BYTES, HTTP_SECONDS, log_event
+
+logger = logging.getLogger(__name__)
+
+#The stats of the request being handled, also seen by ORM calls made through sync_to_async
+_current = ContextVar("request_stats", default=None)
+
+
+@dataclass
+class RequestStats:
+    """
+    What a request cost in the database.
+
+    Attributes:
+        queries (int): How many queries were run
+        db_seconds (float): Time spent running them
+        sql (List[Tuple[float, str]]): Duration and SQL of each query, up to PERF_MAX_CAPTURED_QUERIES
+    """
+    queries : int = 0
+    db_seconds : float = 0.0
+    sql : list = field(default_factory=list)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding each query to the current request's stats.
+
+    Installed on every connection by ApiConfig, it does nothing outside a sampled request.
+    """
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        stats.queries += 1
+        stats.db_seconds += seconds
+        if len(stats.sql) < settings.PERF_MAX_CAPTURED_QUERIES:
+            stats.sql.append((seconds, sql))
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def view_name(request):
+    """
+    Names the view that handled a request, such as "GetTasksView".
+    """
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    view_class = getattr(match.func, "view_class", None)
+    return view_class.__name__ if view_class is not None else match._func_path
+
+
+class PerformanceMiddleware:
+    """
+    Records the wall time, database queries, database time and response size of each request.
+
+    A PERF_SAMPLE_RATE share of requests is measured into the tempora_http_* metrics and logged.
+    Every request is timed, so requests slower than PERF_SLOW_REQUEST_MS are always logged, with their
+    slowest SQL when they were sampled. When PERF_PROFILING
+    is on, a request with the X-Profile header is run under cProfile and the dump written to PERF_PROFILE_DIR.
+    Only requests served synchronously are profiled: under ASGI cProfile would run on the event loop thread
+    and record every request in flight, so X-Profile requests there are measured without a profile.
+    Streamed responses are measured up to the point their body starts streaming.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        stats = RequestStats() if self.sampled(request) else None
+        token = _current.set(stats)
+        profiler = self.profiler(request)
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                response = profiler.runcall(self.get_response, request)
+            else:
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - start, profiler)
+
+    async def __acall__(self, request):
+        stats = RequestStats() if self.sampled(request) else None
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - start, None)
+
+    def sampled(self, request):
+        return self.profiling(request) or random.random() < settings.PERF_SAMPLE_RATE
+
+    def profiling(self, request):
+        return settings.PERF_PROFILING and "X-Profile" in request.headers
+
+    def profiler(self, request):
+        return cProfile.Profile() if self.profiling(request) else None
+
+    def finish(self, request, response, stats, seconds, profiler):
+        """
+        Logs a slow request, and records a sampled one and adds its timings to the response.
+        """
+        view = view_name(request)
+        if stats is None:
+            if seconds * 1000 >= settings.PERF_SLOW_REQUEST_MS:
+                logger.warning(
+                    "Slow request %s %s (%s) took %.0f ms, its queries were not sampled",
+                    request.method, request.path, view, seconds * 1000,
+                )
+            return response
+
+        size = None if response.streaming else len(response.content)
+
+        HTTP_SECONDS.observe(seconds, view=view, method=request.method, status=response.status_code)
+        HTTP_DB_QUERIES.observe(stats.queries, view=view)
+        HTTP_DB_SECONDS.observe(stats.db_seconds, view=view)
+        if size is not None:
+            HTTP_RESPONSE_BYTES.observe(size, view=view)
+
+        log_event(
+            "request", view=view, method=request.method, path=request.path, status=response.status_code,
+            seconds=round(seconds, 6), queries=stats.queries, db_seconds=round(stats.db_seconds, 6), bytes=size,
+        )
+
+        if seconds * 1000 >= settings.PERF_SLOW_REQUEST_MS:
+            worst = sorted(stats.sql, reverse=True)[:settings.PERF_SLOW_REQUEST_QUERIES]
+            logger.warning(
+                "Slow request %s %s (%s) took %.0f ms with %s queries in %.0f ms. Slowest SQL:\n%s",
+                request.method, request.path, view, seconds * 1000, stats.queries, stats.db_seconds * 1000,
+                "\n".join(f"{query_seconds * 1000:.1f} ms: {sql}" for query_seconds, sql in worst),
+            )
+
+        if profiler is not None:
+            response["X-Profile-File"] = self.dump(profiler, view)
+
+        response["Server-Timing"] = f"app;dur={seconds * 1000:.1f}, db;dur={stats.db_seconds * 1000:.1f};desc=\"{stats.queries} queries\""
+        #Read by in-process callers such as the benchmark command
+        response.perf_stats = stats
+        return response
+
+    def dump(self, profiler, view):
+        """
+        Writes a cProfile dump, readable with pstats or snakeviz.
+
+        Returns:
+            str: The name of the dump file in PERF_PROFILE_DIR
+        """
+        directory = Path(settings.PERF_PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"{timezone.now():%Y%m%dT%H%M%S%f}-{view}.prof"
+        profiler.dump_stats(directory / name)
+        return name
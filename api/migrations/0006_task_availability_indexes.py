@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_recommendationjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='availability',
+            index=models.Index(fields=['person', 'day_of_week', 'start_time'], name='avail_person_day_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['person', 'is_completed', 'due_date'], name='task_person_open_due_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_task_availability_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_blocks', to='api.person')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_blocks', to='api.task')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['person', 'start_time'], name='block_person_start_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_scheduledblock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('engine', models.CharField(default='agent', max_length=10)),
+                ('digest', models.CharField(max_length=64)),
+                ('result', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stored_recommendations', to='api.person')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('person', 'engine'), name='stored_rec_person_engine_uniq')],
+            },
+        ),
+    ]
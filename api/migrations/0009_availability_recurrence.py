@@ -0,0 +1,43 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_storedrecommendation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='availability',
+            name='date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='availability',
+            name='ends_on',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='availability',
+            name='interval_weeks',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='availability',
+            name='kind',
+            field=models.CharField(choices=[('weekly', 'Weekly'), ('override', 'Override'), ('exception', 'Exception')], default='weekly', max_length=9),
+        ),
+        migrations.AddField(
+            model_name='availability',
+            name='starts_on',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='availability',
+            name='timezone',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:32
+
+from django.db import migrations, models
+
+
+def fail_duplicate_pending_jobs(apps, schema_editor):
+    # Only the oldest pending job of a person and engine is kept pending
+    RecommendationJob = apps.get_model('api', 'RecommendationJob')
+    seen = set()
+    duplicates = []
+    for job_id, person_id, engine in RecommendationJob.objects.filter(status='pending').order_by('id').values_list('id', 'person_id', 'engine'):
+        if (person_id, engine) in seen:
+            duplicates.append(job_id)
+        seen.add((person_id, engine))
+    RecommendationJob.objects.filter(id__in=duplicates).update(status='failed', error='Duplicate of an earlier pending job')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_availability_recurrence'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_duplicate_pending_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='recommendationjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'pending')), fields=('person', 'engine'), name='job_person_engine_pending_uniq'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 import uuid
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 
@@ -57,8 +58,26 @@ class Task(models.Model):
 
     person = models.ForeignKey(Person, related_name="tasks", on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # Serves a person's task list filtered by completion and ordered by due date
+            models.Index(fields=["person", "is_completed", "due_date"], name="task_person_open_due_idx"),
+        ]
+
 class Availability(models.Model):
+    #A slot recurring every interval_weeks on day_of_week, between starts_on and ends_on when given
+    WEEKLY = "weekly"
+    #A slot on one date replacing that date's weekly slots, several overrides on a date add up
+    OVERRIDE = "override"
+    #Time on one date taken out of the slots, such as a holiday or a busy afternoon
+    EXCEPTION = "exception"
+
     person = models.ForeignKey(Person, related_name="availabilities", on_delete=models.CASCADE)
+    kind = models.CharField(max_length=9, default=WEEKLY, choices=[
+        (WEEKLY, "Weekly"),
+        (OVERRIDE, "Override"),
+        (EXCEPTION, "Exception")
+    ])
     
     day_of_week = models.CharField(max_length=9, choices=[
         ("Monday", "Monday"),
@@ -68,9 +87,70 @@ class Availability(models.Model):
         ("Friday", "Friday"),
         ("Saturday", "Saturday"),
         ("Sunday", "Sunday")
-    ])
+    ])  # The weekday of `date` for overrides and exceptions
     start_time = models.TimeField()
     end_time = models.TimeField()
+    date = models.DateField(null = True, blank = True)  # Overrides and exceptions only
+    interval_weeks = models.PositiveSmallIntegerField(default=1)  # Counted from the week of starts_on
+    starts_on = models.DateField(null = True, blank = True)
+    ends_on = models.DateField(null = True, blank = True)
+    timezone = models.CharField(max_length=64, blank=True, default="")  # IANA zone of the times, TIME_ZONE when blank
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["person", "day_of_week", "start_time"], name="avail_person_day_start_idx"),
+        ]
 
     def __str__(self):
         return f"{self.person.user.username} - {self.day_of_week} ({self.start_time} - {self.end_time})"
+
+class RecommendationJob(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    person = models.ForeignKey(Person, related_name="recommendation_jobs", on_delete=models.CASCADE)
+    engine = models.CharField(max_length=10, default="agent")
+    status = models.CharField(max_length=10, default=PENDING, choices=[
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed")
+    ])
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)  # Pushed back after a failed attempt
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Renewed while the job runs, its worker's lease
+
+    class Meta:
+        constraints = [
+            # Concurrent enqueues for the same person and engine share one pending job
+            models.UniqueConstraint(fields=["person", "engine"], condition=models.Q(status="pending"), name="job_person_engine_pending_uniq"),
+        ]
+
+class ScheduledBlock(models.Model):
+    person = models.ForeignKey(Person, related_name="scheduled_blocks", on_delete=models.CASCADE)
+    task = models.ForeignKey(Task, related_name="scheduled_blocks", on_delete=models.CASCADE)  # Removing a task frees its slot
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["person", "start_time"], name="block_person_start_idx"),
+        ]
+
+class StoredRecommendation(models.Model):
+    person = models.ForeignKey(Person, related_name="stored_recommendations", on_delete=models.CASCADE)
+    engine = models.CharField(max_length=10, default="agent")
+    digest = models.CharField(max_length=64)  # data_digest of the tasks and availabilities it was made from
+    result = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["person", "engine"], name="stored_rec_person_engine_uniq"),
+        ]
@@ -0,0 +1,54 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(due_date, id):
+    """
+    Encodes the (due_date, id) position of the last task on a page.
+
+    Args:
+        due_date (datetime): The task's due date, may be None
+        id (int): The task's id
+    """
+    position = [due_date.isoformat() if due_date is not None else None, id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by encode_cursor.
+
+    Returns:
+        Tuple[datetime, int]: The due date (or None) and id the page ended on
+
+    Raises:
+        ValueError: The cursor is malformed
+    """
+    try:
+        due_date, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+    if due_date is not None:
+        due_date = parse_datetime(due_date)
+        if due_date is None:
+            raise ValueError("Invalid cursor")
+    if not isinstance(id, int):
+        raise ValueError("Invalid cursor")
+    return due_date, id
+
+
+def after_cursor(due_date, id):
+    """
+    Filter for the tasks after a cursor when ordered by due date (nulls last) then id.
+
+    Args:
+        due_date (datetime): The due date the previous page ended on, may be None
+        id (int): The id the previous page ended on
+    """
+    if due_date is None:
+        return Q(due_date__isnull=True, id__gt=id)
+    return Q(due_date__gt=due_date) | Q(due_date=due_date, id__gt=id) | Q(due_date__isnull=True)
@@ -0,0 +1,242 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .loaders import load_person_schema
+from .models import Person, ScheduledBlock
+from .schemas import Rec, RecommendationOutput
+from .freetime import DAYS_OF_WEEK, WEEKLY, person_free_time
+from .scheduler import DEFAULT_HORIZON_DAYS, MIN_BLOCK_MINUTES, block_title, place_tasks, task_order
+
+
+class SchedulePlanner:
+    """
+    Keeps a person's persisted schedule up to date with small repairs instead of full re-plans.
+
+    New tasks are slotted into the free gaps left by the existing blocks, completing or
+    removing a task frees its blocks, and an availability change only re-plans the days it touched.
+    The whole schedule is only rebuilt when a repair cannot place a task before its due date and blocks
+    of less urgent tasks hold time it could have.
+
+    Attributes:
+        person_id (int): The id of the Person whose schedule this is
+        now (datetime): The time the schedule is planned from
+        horizon_days (int): How many days ahead of now blocks are planned
+    """
+    def __init__(self, person_id, user = None, now = None, horizon_days = DEFAULT_HORIZON_DAYS):
+        self.person_id = person_id
+        self._user = user
+        self.now = now or timezone.localtime()
+        self.horizon_days = horizon_days
+
+    @property
+    def user(self):
+        """
+        The person's PersonSchema, loaded on first use unless it was given.
+        """
+        if self._user is None:
+            _, self._user = load_person_schema(id=self.person_id)
+        return self._user
+
+    def _blocks(self):
+        return list(
+            ScheduledBlock.objects.filter(person_id=self.person_id)
+            .values('id', 'task_id', 'start_time', 'end_time', 'task__name')
+        )
+
+    def _lock(self):
+        """
+        Locks the person's row until the transaction ends, so only one request at a time changes their schedule.
+
+        Must be called inside transaction.atomic. SQLite has no row locks, there the IMMEDIATE
+        transaction of the production profile already holds the write lock.
+        """
+        list(Person.objects.select_for_update().filter(id=self.person_id).values_list('id', flat=True))
+
+    def _free_time(self, busy):
+        return person_free_time(self.user.availabilities, self.now, self.now + timedelta(days=self.horizon_days), busy)
+
+    def _has_room(self, blocks):
+        """
+        Returns whether any block fits between the given blocks, so tasks that cannot be placed do not take the lock on every request.
+        """
+        free = self._free_time([(block['start_time'], block['end_time']) for block in blocks if block['end_time'] > self.now])
+        return free.earliest_fit(timedelta(minutes=MIN_BLOCK_MINUTES)) is not None
+
+    def _place(self, task_ids, blocks):
+        """
+        Places tasks into the gaps between the given blocks and saves the new blocks.
+
+        Returns:
+            Tuple[List[ScheduledBlock], List[TaskSchema]]: The new blocks, and the tasks that got no block or one past their due date
+        """
+        tasks = sorted((task for task in self.user.tasks if task.task_id in task_ids and not task.is_completed), key=lambda task: task_order(task, self.now))
+        free = self._free_time([(block['start_time'], block['end_time']) for block in blocks if block['end_time'] > self.now])
+
+        new_blocks = []
+        late = []
+        for task, start, end in place_tasks(tasks, free):
+            new_blocks.append(ScheduledBlock(person_id=self.person_id, task_id=task.task_id, start_time=start, end_time=end))
+            #Overdue tasks cannot make their due date wherever they go
+            if task.due_date is not None and task.due_date > self.now and end > task.due_date:
+                late.append(task)
+
+        placed = {block.task_id for block in new_blocks}
+        late += [task for task in tasks if task.task_id not in placed]
+
+        ScheduledBlock.objects.bulk_create(new_blocks)
+        return new_blocks, late
+
+    def _movable(self, late, blocks):
+        """
+        Returns whether a full re-plan could do better for the late tasks.
+
+        It can only by giving them time held by blocks of less urgent tasks, so a person whose time is
+        all held by more urgent tasks, or who has none left, does not get a full re-plan on every change.
+
+        Args:
+            late (List[TaskSchema]): The tasks _place could not place in time
+            blocks (List[dict]): The blocks they were placed around
+        """
+        open_tasks = {task.task_id: task for task in self.user.tasks if not task.is_completed}
+        for task in late:
+            rank = task_order(task, self.now)
+            for block in blocks:
+                other = open_tasks.get(block['task_id'])
+                if block['end_time'] > self.now and (other is None or task_order(other, self.now) > rank):
+                    return True
+        return False
+
+    def replan(self):
+        """
+        Throws the schedule away and plans every open task from scratch.
+        """
+        free = self._free_time([])
+        tasks = sorted((task for task in self.user.tasks if not task.is_completed), key=lambda task: task_order(task, self.now))
+
+        with transaction.atomic():
+            self._lock()
+            ScheduledBlock.objects.filter(person_id=self.person_id).delete()
+            ScheduledBlock.objects.bulk_create(
+                ScheduledBlock(person_id=self.person_id, task_id=task.task_id, start_time=start, end_time=end)
+                for task, start, end in place_tasks(tasks, free)
+            )
+
+    def add(self, task_ids):
+        """
+        Slots new or changed tasks into the free gaps of the schedule.
+
+        Falls back to a full re-plan if one of them cannot be placed before its due date and a re-plan could move
+        less urgent blocks out of its way, otherwise the tasks keep the places they got.
+
+        Args:
+            task_ids (List[int]): The tasks to place
+        """
+        if not task_ids:
+            return
+
+        with transaction.atomic():
+            self._lock()
+            blocks = self._blocks()
+            _, late = self._place(set(task_ids), blocks)
+            replan = self._movable(late, blocks)
+            if replan:
+                transaction.set_rollback(True)
+
+        if replan:
+            self.replan()
+
+    def release(self, task_ids):
+        """
+        Frees the blocks of completed or changed tasks.
+
+        Args:
+            task_ids (List[int]): The tasks whose blocks are freed
+        """
+        if task_ids:
+            ScheduledBlock.objects.filter(person_id=self.person_id, task_id__in=task_ids).delete()
+
+    def replan_days(self, days_of_week = (), dates = ()):
+        """
+        Re-plans the schedule from the first upcoming day whose availabilities changed.
+
+        Blocks on a changed day may no longer fit, and time added on a changed day should pull later
+        blocks earlier, so every block from the start of that day on is dropped and its task slotted back in
+        around the blocks before it. Blocks before the first changed day stay where they are, and dates
+        past the planning horizon change nothing.
+
+        Args:
+            days_of_week (Set[str]): Weekdays whose weekly rules changed, as stored in Availability.day_of_week
+            dates (Set[date]): Dates whose overrides or exceptions changed
+        """
+        today = timezone.localtime(self.now).replace(hour=0, minute=0, second=0, microsecond=0)
+        changed = [today + timedelta(days=offset) for offset in range(7) if DAYS_OF_WEEK[(today + timedelta(days=offset)).weekday()] in days_of_week]
+        changed += [today + timedelta(days=(day - today.date()).days) for day in dates if 0 <= (day - today.date()).days <= self.horizon_days]
+        if not changed:
+            return
+
+        with transaction.atomic():
+            self._lock()
+            replan = False
+            displaced = [block for block in self._blocks() if block['end_time'] > max(self.now, min(changed))]
+            if displaced:
+                ScheduledBlock.objects.filter(id__in=[block['id'] for block in displaced]).delete()
+                kept = self._blocks()
+                _, late = self._place({block['task_id'] for block in displaced}, kept)
+                replan = self._movable(late, kept)
+                if replan:
+                    transaction.set_rollback(True)
+
+        if replan:
+            self.replan()
+
+    def replan_availability(self, availability):
+        """
+        Re-plans the days one added or removed availability changes.
+
+        Args:
+            availability (Availability): A weekly rule, which changes its weekday, or an override or exception, which changes its date
+        """
+        if availability.kind == WEEKLY:
+            self.replan_days(days_of_week={availability.day_of_week})
+        else:
+            self.replan_days(dates={availability.date})
+
+    def recommendation(self):
+        """
+        Returns the upcoming blocks as a recommendation.
+
+        Open tasks without an upcoming block, such as ones whose block passed before they were
+        completed, are slotted in first. Tasks that no longer fit are left out until the next change.
+
+        Returns:
+            RecommendationOutput: The upcoming blocks ordered by start time
+        """
+        open_tasks = {task.task_id: task for task in self.user.tasks if not task.is_completed}
+
+        def split(blocks):
+            upcoming = [block for block in blocks if block['end_time'] > self.now and block['task_id'] in open_tasks]
+            stale = [block['id'] for block in blocks if block['end_time'] <= self.now or block['task_id'] not in open_tasks]
+            return upcoming, stale, set(open_tasks) - {block['task_id'] for block in upcoming}
+
+        upcoming, stale, missing = split(self._blocks())
+        recs = [(block['start_time'], block['end_time'], block['task__name']) for block in upcoming]
+
+        if stale or (missing and self._has_room(upcoming)):
+            # Read again under the lock, so concurrent requests do not both place the same missing tasks
+            with transaction.atomic():
+                self._lock()
+                upcoming, stale, missing = split(self._blocks())
+                if stale:
+                    ScheduledBlock.objects.filter(id__in=stale).delete()
+                recs = [(block['start_time'], block['end_time'], block['task__name']) for block in upcoming]
+                if missing:
+                    new_blocks, _ = self._place(missing, upcoming)
+                    recs += [(block.start_time, block.end_time, open_tasks[block.task_id].name) for block in new_blocks]
+
+        tz = timezone.get_current_timezone()
+        return RecommendationOutput(recs=[
+            Rec(start_time=start.astimezone(tz).isoformat(), end_time=end.astimezone(tz).isoformat(), title=block_title(name))
+            for start, end, name in sorted(recs)
+        ])
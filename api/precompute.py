@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import data_digest
+from .loaders import aload_person_schemas
+from .models import Person, StoredRecommendation
+from .recommendations import generate
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PrecomputeProgress:
+    """
+    How far a precompute run has got.
+
+    Attributes:
+        total (int): People to go through when the run started
+        processed (int): People gone through so far
+        generated (int): Recommendations made and stored
+        fresh (int): People skipped because their stored recommendation still applies
+        failed (int): People whose recommendation could not be made
+        last_person_id (int): The highest Person id of the last finished chunk, to resume after
+    """
+    total : int
+    processed : int = 0
+    generated : int = 0
+    fresh : int = 0
+    failed : int = 0
+    last_person_id : int = 0
+    started : float = field(default_factory=time.perf_counter)
+
+    def rate(self):
+        """
+        Returns the people processed per second so far.
+        """
+        return self.processed / max(time.perf_counter() - self.started, 1e-9)
+
+    def eta(self):
+        """
+        Returns the seconds left at the current rate, or None before anything was processed.
+        """
+        rate = self.rate()
+        return max(self.total - self.processed, 0) / rate if rate else None
+
+    def __str__(self):
+        eta = self.eta()
+        return (
+            f"{self.processed}/{self.total} people ({self.generated} generated, {self.fresh} fresh, {self.failed} failed), "
+            f"{self.rate():.1f}/s, ETA {'unknown' if eta is None else f'{eta:.0f}s'}, resume after id {self.last_person_id}"
+        )
+
+
+class RecommendationPrecomputer:
+    """
+    Makes and stores recommendations for every active person ahead of time.
+
+    People are read in chunks ordered by id, so a run can be resumed after the last finished chunk
+    and memory stays flat however many people there are. Each chunk's schemas are loaded in three queries.
+    At most `concurrency` recommendations are made at once, which bounds the requests made to the model provider.
+    People whose stored recommendation still matches their data and is fresh are skipped, so a rerun
+    after an interruption only makes what is missing.
+
+    Attributes:
+        engine (str): The engine to precompute, "agent" or "hybrid"
+        concurrency (int): The most recommendations made at once
+        chunk_size (int): People read from the database at once
+        active_days (int): Only people who logged in within this many days are included, 0 includes everyone active
+    """
+    def __init__(self, engine = 'agent', concurrency = None, chunk_size = 500, active_days = 30):
+        self.engine = engine
+        self.concurrency = concurrency or settings.RECOMMENDATION_MAX_CONCURRENCY
+        self.chunk_size = chunk_size
+        self.active_days = active_days
+
+    def people(self):
+        """
+        Returns the Persons to precompute for.
+        """
+        people = Person.objects.filter(user__is_active=True)
+        if self.active_days:
+            people = people.filter(user__last_login__gte=timezone.now() - timedelta(days=self.active_days))
+        return people
+
+    async def chunks(self, after_id = 0):
+        """
+        Yields the ids of the people to precompute for, `chunk_size` at a time, by keyset pagination.
+
+        Args:
+            after_id (int): Only people with a higher id are included
+        """
+        while True:
+            ids = [person_id async for person_id in self.people().filter(id__gt=after_id).order_by('id').values_list('id', flat=True)[:self.chunk_size]]
+            if not ids:
+                return
+            yield ids
+            after_id = ids[-1]
+
+    async def stored_digests(self, person_ids):
+        """
+        Returns the digests of the people's stored recommendations that are still fresh, by Person id.
+        """
+        fresh_after = timezone.now() - timedelta(hours=settings.RECOMMENDATION_PRECOMPUTED_MAX_AGE_HOURS)
+        stored = StoredRecommendation.objects.filter(person_id__in=person_ids, engine=self.engine, updated_at__gte=fresh_after)
+        return {person_id: digest async for person_id, digest in stored.values_list('person_id', 'digest')}
+
+    async def precompute(self, person_id, schema, digest, limit, progress):
+        """
+        Makes and stores one person's recommendation.
+        """
+        async with limit:
+            try:
+                # A fallback would be served as the model's answer until it expires, so the person is retried next run instead
+                recommendation = await generate(person_id, schema, self.engine, allow_fallback=False)
+                await StoredRecommendation.objects.aupdate_or_create(
+                    person_id=person_id, engine=self.engine, defaults={"digest": digest, "result": recommendation}
+                )
+                progress.generated += 1
+            except Exception as error:
+                logger.warning("Precomputing the recommendation of person %s failed: %s", person_id, error)
+                progress.failed += 1
+            progress.processed += 1
+
+    async def run(self, after_id = 0, report = None):
+        """
+        Precomputes the recommendations of every active person.
+
+        Args:
+            after_id (int): Resume after this Person id
+            report (Callable[[PrecomputeProgress], None]): Called after every chunk
+
+        Returns:
+            PrecomputeProgress: The final progress
+        """
+        progress = PrecomputeProgress(total=await self.people().filter(id__gt=after_id).acount(), last_person_id=after_id)
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async for person_ids in self.chunks(after_id):
+            stored = await self.stored_digests(person_ids)
+            pending = []
+            for person_id, schema in await aload_person_schemas(person_ids):
+                digest = data_digest(schema, self.engine)
+                if stored.get(person_id) == digest:
+                    progress.fresh += 1
+                    progress.processed += 1
+                else:
+                    pending.append(self.precompute(person_id, schema, digest, limit, progress))
+            await asyncio.gather(*pending)
+
+            progress.last_person_id = person_ids[-1]
+            if report is not None:
+                report(progress)
+        return progress
@@ -0,0 +1,204 @@
+from dataclasses import asdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .agent import registry as agent_registry
+from .cache import RecommendationCache, data_digest, snapshot_key
+from .gateway import ModelUnavailable
+from .metrics import CACHE_LOOKUPS, FALLBACKS, span
+from .models import StoredRecommendation
+from .schemas import PersonSchema, RecommendationOutput
+from .planner import SchedulePlanner
+from .repair import parse_time
+
+#local only uses the scheduler, agent only uses the LLM, hybrid schedules locally and lets the LLM phrase it
+RECOMMENDATION_ENGINES = ('local', 'agent', 'hybrid')
+
+
+async def local_plan(person_id, user:PersonSchema):
+    """
+    Returns the person's persisted schedule, slotting in any open tasks it is missing.
+
+    Returns:
+        RecommendationOutput: The upcoming scheduled blocks
+    """
+    with span("local_plan"):
+        return await sync_to_async(SchedulePlanner(person_id, user).recommendation)()
+
+
+def upcoming(recommendation, now = None):
+    """
+    Drops the Recs of a stored recommendation that have already ended.
+
+    Args:
+        recommendation (dict): The dumped RecommendationOutput, or None
+        now (datetime): Recs ending before it are dropped, defaults to the current time
+
+    Returns:
+        dict: The recommendation without its past Recs, or None when none are left
+    """
+    if recommendation is None:
+        return None
+    now = now or timezone.now()
+    recs = [rec for rec in recommendation["recs"] if (parse_time(rec["end_time"])[0] or now) >= now]
+    if recommendation["recs"] and not recs:
+        return None
+    return {**recommendation, "recs": recs}
+
+
+async def precomputed(person_id, user:PersonSchema, engine):
+    """
+    Returns the recommendation stored by the precompute_recommendations command, if it still applies.
+
+    It applies while it was made from the same tasks and availabilities and is not older than
+    RECOMMENDATION_PRECOMPUTED_MAX_AGE_HOURS. Recs that have ended since it was made are left out,
+    and once all of them have it no longer applies.
+
+    Returns:
+        dict: The dumped RecommendationOutput, or None
+    """
+    fresh_after = timezone.now() - timedelta(hours=settings.RECOMMENDATION_PRECOMPUTED_MAX_AGE_HOURS)
+    with span("precomputed"):
+        recommendation = upcoming(await StoredRecommendation.objects.filter(
+            person_id=person_id, engine=engine, digest=data_digest(user, engine), updated_at__gte=fresh_after
+        ).values_list('result', flat=True).afirst())
+    if recommendation is not None:
+        CACHE_LOOKUPS.inc(engine=engine, result="precomputed")
+    return recommendation
+
+
+async def fallback(person_id, user:PersonSchema, engine):
+    """
+    Answers without the model while it is unavailable.
+
+    Prefers the model's last answer for the same tasks and availabilities, from the previous cache
+    bucket or a stored recommendation of any age, and otherwise schedules locally.
+
+    Returns:
+        dict: The dumped RecommendationOutput
+    """
+    previous = timezone.now() - timedelta(minutes=settings.RECOMMENDATION_TIME_BUCKET_MINUTES)
+    recommendation = await RecommendationCache().aget(person_id, snapshot_key(user, engine, previous))
+    source = "cache"
+    if recommendation is None:
+        recommendation = upcoming(await StoredRecommendation.objects.filter(
+            person_id=person_id, engine=engine, digest=data_digest(user, engine)
+        ).values_list('result', flat=True).afirst())
+        source = "stored"
+    if recommendation is None:
+        recommendation = (await local_plan(person_id, user)).model_dump()
+        source = "local"
+
+    FALLBACKS.inc(engine=engine, source=source)
+    return recommendation
+
+
+async def generate(person_id, user:PersonSchema, engine, allow_fallback = True):
+    """
+    Makes a model-backed recommendation, served from the recommendation cache when the user's
+    tasks, availabilities and time bucket have not changed.
+
+    While the model is unavailable the fallback is returned, and not cached so the model is asked again once it is back.
+
+    Args:
+        allow_fallback (bool): Whether to return the fallback instead of raising ModelUnavailable
+
+    Returns:
+        dict: The dumped RecommendationOutput
+    """
+    cache = RecommendationCache()
+    key = snapshot_key(user, engine)
+    with span("cache"):
+        recommendation = await cache.aget(person_id, key)
+    CACHE_LOOKUPS.inc(engine=engine, result="miss" if recommendation is None else "hit")
+
+    if recommendation is None:
+        agent = agent_registry.get()
+        try:
+            if engine == 'agent':
+                recommendation = await agent_registry.arun(agent.makeRecommendations(user=user))
+            else:
+                plan = await local_plan(person_id, user)
+                recommendation = await agent_registry.arun(agent.phraseRecommendations(user=user, plan=plan))
+        except ModelUnavailable:
+            if not allow_fallback:
+                raise
+            return await fallback(person_id, user, engine)
+        await cache.aset(person_id, key, recommendation)
+
+    return recommendation
+
+
+async def recommend(person_id, user:PersonSchema, engine = 'local', allow_fallback = True):
+    """
+    Makes a recommendation for a user with the given engine.
+
+    Model-backed engines are served from the precomputed recommendation first, then from the
+    recommendation cache, and only reach the model when neither applies.
+
+    Args:
+        person_id (int): The id of the Person the recommendation is for
+        user (PersonSchema): The user's tasks and availabilities
+        engine (str): One of RECOMMENDATION_ENGINES
+        allow_fallback (bool): Whether to return the fallback instead of raising ModelUnavailable
+
+    Returns:
+        dict: The dumped RecommendationOutput
+    """
+    if engine == 'local':
+        return (await local_plan(person_id, user)).model_dump()
+
+    recommendation = await precomputed(person_id, user, engine)
+    if recommendation is None:
+        recommendation = await generate(person_id, user, engine, allow_fallback=allow_fallback)
+    return recommendation
+
+
+async def stream_recommend(person_id, user:PersonSchema, engine = 'local'):
+    """
+    Yields a user's recommendation one Rec at a time, as soon as each is made.
+
+    A precomputed or cached recommendation is replayed at once, and a streamed model recommendation is cached when it completes.
+
+    Args:
+        person_id (int): The id of the Person the recommendation is for
+        user (PersonSchema): The user's tasks and availabilities
+        engine (str): One of RECOMMENDATION_ENGINES
+
+    Yields:
+        dict: Each Rec as a dict
+    """
+    if engine == 'local':
+        for rec in (await local_plan(person_id, user)).recs:
+            yield asdict(rec)
+        return
+
+    cache = RecommendationCache()
+    key = snapshot_key(user, engine)
+    recommendation = await precomputed(person_id, user, engine)
+    if recommendation is None:
+        with span("cache"):
+            recommendation = await cache.aget(person_id, key)
+        CACHE_LOOKUPS.inc(engine=engine, result="miss" if recommendation is None else "hit")
+
+    if recommendation is not None:
+        for rec in recommendation["recs"]:
+            yield rec
+        return
+
+    plan = await local_plan(person_id, user) if engine == 'hybrid' else None
+    recs = []
+    try:
+        async for rec in agent_registry.astream(agent_registry.get().streamRecommendations(user=user, plan=plan)):
+            recs.append(rec)
+            yield asdict(rec)
+    except ModelUnavailable:
+        # Only raised before the stream starts, while the model's circuit is open
+        for rec in (await fallback(person_id, user, engine))["recs"]:
+            yield rec
+        return
+
+    await cache.aset(person_id, key, RecommendationOutput(recs=recs).model_dump())
@@ -0,0 +1,257 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .freetime import FreeTimeIndex, expand_availabilities, subtract_busy
+from .metrics import RECOMMENDATION_REPAIRS, RECOMMENDATION_VIOLATIONS
+from .schemas import PersonSchema, Rec, RecommendationOutput
+from .scheduler import DEFAULT_HORIZON_DAYS, MIN_BLOCK_MINUTES, block_title
+
+#What can be wrong with a Rec, each counted in tempora_recommendation_violations_total
+UNPARSEABLE = "unparseable"
+INVERTED = "inverted"
+IN_PAST = "in_past"
+OUTSIDE_AVAILABILITY = "outside_availability"
+OVERLAP = "overlap"
+PAST_DUE = "past_due"
+
+
+def parse_time(value):
+    """
+    Parses a Rec time, reading times without an offset in the current time zone.
+
+    Returns:
+        Tuple[datetime, bool]: The aware datetime and whether the text had no offset, or (None, False)
+    """
+    try:
+        parsed = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None, False
+    if timezone.is_naive(parsed):
+        return timezone.make_aware(parsed), True
+    return parsed, False
+
+
+def format_time(value, naive):
+    local = timezone.localtime(value)
+    return (local.replace(tzinfo=None) if naive else local).isoformat()
+
+
+@dataclass
+class RepairReport:
+    """
+    What repairing a recommendation found and did.
+
+    Attributes:
+        output (RecommendationOutput): The repaired recommendation
+        violations (Counter): How many Recs had each violation
+        repairs (Counter): How many Recs were shifted, trimmed, swapped or dropped
+        unrecoverable (bool): Too much had to be dropped, the model should be asked again
+    """
+    output : RecommendationOutput
+    violations : Counter = field(default_factory=Counter)
+    repairs : Counter = field(default_factory=Counter)
+    unrecoverable : bool = False
+
+    def describe(self):
+        """
+        Lists the violations for a prompt asking the model to fix them.
+        """
+        return ", ".join(f"{count} {kind.replace('_', ' ')}" for kind, count in sorted(self.violations.items()))
+
+
+class RecommendationRepairer:
+    """
+    Checks a model's Recs against the user's tasks and availabilities and fixes what it can locally.
+
+    A Rec must parse, end after it starts, end after now, lie inside an availability window, not overlap
+    an earlier Rec and end by the due date of the task it is for. A Rec breaking a rule is moved to the
+    earliest free stretch after it that fits, trimmed to a shorter stretch, or dropped, in that order.
+    Recs are only moved forward, so the model's order is kept, except late ones, which may move earlier to be on time.
+
+    Recs are repaired one at a time in the order given, so a streamed recommendation can be repaired as it arrives.
+    Kept Recs are checked against each other rather than taken from the front of the free time, so a Rec
+    earlier than one already kept is not mistaken for an overlap.
+
+    Attributes:
+        now (datetime): Where free time starts
+        horizon_days (int): How far ahead Recs may be placed
+        task_ids (Set[int]): The tasks the model was shown, the only ones Recs are matched to, defaults to every open task
+    """
+    def __init__(self, user:PersonSchema, now = None, horizon_days = DEFAULT_HORIZON_DAYS, task_ids = None):
+        self.now = now or timezone.now()
+        self.horizon_days = horizon_days
+        end = self.now + timedelta(days=horizon_days)
+        # From the start of today, so a block already under way is still inside its window
+        today = timezone.localtime(self.now).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.available = expand_availabilities(user.availabilities, today, end)
+        self.available_starts = [start for start, _ in self.available]
+        self.available_ends = [end for _, end in self.available]
+        # The kept Recs, sorted and not overlapping
+        self.taken = []
+        self._free = None
+
+        open_tasks = [task for task in user.tasks if not task.is_completed and (task_ids is None or task.task_id in task_ids)]
+        # Tasks already overdue or due after the horizon cannot be scheduled any more or less on time
+        self.deadlines = {task.name.lower(): task.due_date for task in open_tasks if task.due_date is not None and self.now < task.due_date <= end}
+        self.violations = Counter()
+        self.repairs = Counter()
+
+    def deadline(self, title):
+        """
+        Returns the due date of the task a Rec is for, matched on the task's name appearing in the title.
+        """
+        title = title.lower()
+        exact = self.deadlines.get(title.removeprefix(block_title("").lower()))
+        if exact is not None:
+            return exact
+        matches = [name for name in self.deadlines if name and name in title]
+        return self.deadlines[max(matches, key=len)] if matches else None
+
+    @property
+    def free(self):
+        """
+        The free time around the kept Recs, rebuilt only when a Rec has to be placed after another was kept.
+        """
+        if self._free is None:
+            self._free = FreeTimeIndex(subtract_busy(self.available, self.taken))
+        return self._free
+
+    def keep(self, start, end):
+        insort(self.taken, (start, end))
+        self._free = None
+
+    def _overlaps(self, start, end):
+        i = bisect_left(self.taken, (start, start))
+        return (i > 0 and self.taken[i - 1][1] > start) or (i < len(self.taken) and self.taken[i][0] < end)
+
+    def _within(self, starts, ends, start, end):
+        # Windows are sorted and do not overlap, so only the last one starting by `start` can hold the Rec
+        i = bisect_right(starts, start) - 1
+        return i >= 0 and end <= ends[i]
+
+    def check(self, start, end, deadline):
+        """
+        Returns the violations of a parsed Rec against the free time left.
+        """
+        found = []
+        if end <= self.now:
+            found.append(IN_PAST)
+        elif not self._within(self.available_starts, self.available_ends, start, end):
+            found.append(OUTSIDE_AVAILABILITY)
+        elif self._overlaps(start, end):
+            found.append(OVERLAP)
+        if deadline is not None and end > deadline:
+            found.append(PAST_DUE)
+        return found
+
+    def place(self, start, duration, deadline, late_ok):
+        """
+        Finds where a Rec can go from `start` on, first at full length, then trimmed,
+        before its deadline and then, when `late_ok`, after it.
+
+        Returns:
+            Tuple[datetime, datetime, str]: The new start and end and the repair made, or None
+        """
+        minimum = timedelta(minutes=MIN_BLOCK_MINUTES)
+        for before in (deadline, None) if late_ok and deadline is not None else (deadline,):
+            fit = self.free.earliest_fit(duration, after=start, before=before)
+            if fit is not None:
+                return fit, fit + duration, "shift"
+            fit = self.free.earliest_fit(minimum, after=start, before=before)
+            if fit is not None:
+                end = min(fit + duration, self.free.ends[bisect_right(self.free.starts, fit) - 1])
+                return fit, end if before is None else min(end, before), "trim"
+        return None
+
+    def repair_rec(self, rec:Rec):
+        """
+        Checks one Rec and returns it as is, repaired, or None when it has to be dropped.
+        """
+        start, start_naive = parse_time(rec.start_time)
+        end, end_naive = parse_time(rec.end_time)
+        if start is None or end is None:
+            return self.drop([UNPARSEABLE])
+
+        found = []
+        if end <= start:
+            found.append(INVERTED)
+            if end == start:
+                return self.drop(found)
+            start, end, start_naive, end_naive = end, start, end_naive, start_naive
+            self.repairs["swap"] += 1
+
+        deadline = self.deadline(rec.title)
+        found += self.check(start, end, deadline)
+        self.violations.update(found)
+        if not found:
+            self.keep(start, end)
+            return rec
+        if found == [INVERTED]:
+            self.keep(start, end)
+            return Rec(start_time=format_time(start, start_naive), end_time=format_time(end, end_naive), title=rec.title)
+
+        if found == [PAST_DUE]:
+            # A Rec that is only late may be moved earlier, and is kept late when nothing before its due date is free
+            placed = self.place(self.now, end - start, deadline, late_ok=False)
+            if placed is None:
+                self.keep(start, end)
+                return rec
+        else:
+            placed = self.place(max(start, self.now), end - start, deadline, late_ok=True)
+            if placed is None:
+                return self.drop([])
+
+        new_start, new_end, repair = placed
+        self.keep(new_start, new_end)
+        self.repairs[repair] += 1
+        return Rec(start_time=format_time(new_start, start_naive), end_time=format_time(new_end, end_naive), title=rec.title)
+
+    def drop(self, found):
+        self.violations.update(found)
+        self.repairs["drop"] += 1
+        return None
+
+    def report(self, recs, given):
+        """
+        Builds the report of the Recs repaired so far and records its metrics.
+
+        Args:
+            recs (List[Rec]): The Recs kept
+            given (int): How many Recs the model gave
+        """
+        for kind, count in self.violations.items():
+            RECOMMENDATION_VIOLATIONS.inc(count, kind=kind)
+        for action, count in self.repairs.items():
+            RECOMMENDATION_REPAIRS.inc(count, action=action)
+
+        dropped = self.repairs["drop"]
+        unrecoverable = dropped > 0 and dropped > given * settings.RECOMMENDATION_REPAIR_MAX_DROPPED_SHARE
+        return RepairReport(output=RecommendationOutput(recs=recs), violations=self.violations, repairs=self.repairs, unrecoverable=unrecoverable)
+
+
+def repair_recommendation(user:PersonSchema, output:RecommendationOutput, now = None, task_ids = None):
+    """
+    Checks a whole recommendation and repairs it locally, earliest Rec first.
+
+    Args:
+        user (PersonSchema): The user the recommendation was made for
+        output (RecommendationOutput): The model's recommendation
+        now (datetime): Where free time starts, defaults to the current time
+        task_ids (Set[int]): The tasks the model was shown, defaults to every open task
+
+    Returns:
+        RepairReport: The repaired recommendation and what was wrong with it
+    """
+    repairer = RecommendationRepairer(user, now, task_ids=task_ids)
+
+    def order(rec):
+        start, _ = parse_time(rec.start_time)
+        return (start is None, start or repairer.now)
+
+    recs = [repaired for repaired in map(repairer.repair_rec, sorted(output.recs, key=order)) if repaired is not None]
+    return repairer.report(recs, len(output.recs))
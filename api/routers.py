@@ -0,0 +1,63 @@
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+
+#Set once the current request has written, so its later reads see its own writes
+_wrote = ContextVar("wrote_primary", default=False)
+
+
+class ReadReplicaRouter:
+    """
+    Sends reads to the "replica" database and writes to "default".
+
+    The replica lags the primary, so once a request writes, its remaining reads go to the primary too.
+    PrimaryPinningMiddleware clears that for each new request. Reads inside a transaction on the primary
+    also stay on it, since they decide what the transaction writes. select_for_update() querysets are
+    routed as writes by Django, so their locks are always taken on the primary.
+    """
+    def db_for_read(self, model, **hints):
+        if _wrote.get() or connections["default"].in_atomic_block:
+            return "default"
+        return "replica"
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both databases hold the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name = None, **hints):
+        return db == "default"
+
+
+class PrimaryPinningMiddleware:
+    """
+    Starts every request reading from the replica, whatever the previous request on the thread did.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        token = _wrote.set(False)
+        try:
+            return self.get_response(request)
+        finally:
+            _wrote.reset(token)
+
+    async def __acall__(self, request):
+        token = _wrote.set(False)
+        try:
+            return await self.get_response(request)
+        finally:
+            _wrote.reset(token)
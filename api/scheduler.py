@@ -0,0 +1,105 @@
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .freetime import DAYS_OF_WEEK, FreeTimeIndex, expand_availabilities
+from .schemas import PersonSchema, Rec, RecommendationOutput
+
+PRIORITY_RANK = {"high": 0, "medium": 1, "low": 2}
+
+#Length of the work block given to a task of each priority
+BLOCK_MINUTES = {"high": 60, "medium": 45, "low": 30}
+
+#Free time shorter than this is not worth scheduling into
+MIN_BLOCK_MINUTES = 15
+
+DEFAULT_HORIZON_DAYS = 14
+
+
+def place_tasks(tasks, free):
+    """
+    Gives each task, in order, the earliest free stretch that is long enough to be worth working in.
+
+    Args:
+        tasks (List[TaskSchema]): The tasks to place, most urgent first
+        free (FreeTimeIndex): The free time, which the placed blocks are taken from
+
+    Yields:
+        Tuple[TaskSchema, datetime, datetime]: Each placed task with its block
+    """
+    for task in tasks:
+        block = timedelta(minutes=BLOCK_MINUTES.get(task.priority, BLOCK_MINUTES["medium"]))
+
+        start = free.earliest_fit(timedelta(minutes=MIN_BLOCK_MINUTES))
+        if start is None:
+            return
+
+        yield task, start, free.take(start, block)
+
+
+def task_order(task, now):
+    """
+    Sort key placing overdue tasks first, then earliest due date, then highest priority.
+
+    Args:
+        task (TaskSchema): The task to rank
+        now (datetime): The current time
+    """
+    overdue = task.due_date is not None and task.due_date < now
+    return (
+        not overdue,
+        task.due_date is None,
+        task.due_date or now,
+        PRIORITY_RANK.get(task.priority, len(PRIORITY_RANK)),
+        task.task_id,
+    )
+
+
+def block_title(name):
+    return f"Work on {name}"
+
+
+class LocalScheduler:
+    """
+    Deterministic scheduler that places a user's open tasks into their availabilities.
+
+    Tasks are handled earliest-deadline-first with overdue tasks ahead of everything else,
+    and each one is given the earliest free block in the user's availability windows.
+
+    Attributes:
+        horizon_days (int): How many days ahead of now to expand the availabilities for
+    """
+    def __init__(self, horizon_days = DEFAULT_HORIZON_DAYS):
+        self.horizon_days = horizon_days
+
+    def iter_schedule(self, user:PersonSchema, now = None):
+        """
+        Yields the user's work blocks one at a time, in order of start time.
+
+        Args:
+            user (PersonSchema): The user's tasks and availabilities
+            now (datetime): The time to schedule from, defaults to the current local time
+        """
+        now = now or timezone.localtime()
+        free = FreeTimeIndex.from_availabilities(user.availabilities, now, now + timedelta(days=self.horizon_days))
+        tasks = sorted((task for task in user.tasks if not task.is_completed), key=lambda task: task_order(task, now))
+
+        # Blocks are always taken from the front of the earliest window with room, so they come out in time order
+        for task, start, end in place_tasks(tasks, free):
+            yield Rec(start_time=start.isoformat(), end_time=end.isoformat(), title=block_title(task.name))
+
+    def schedule(self, user:PersonSchema, now = None):
+        """
+        Builds the recommendation for a user.
+
+        Args:
+            user (PersonSchema): The user's tasks and availabilities
+            now (datetime): The time to schedule from, defaults to the current local time
+
+        Returns:
+            RecommendationOutput: The scheduled work blocks ordered by start time
+        """
+        return RecommendationOutput(recs=list(self.iter_schedule(user, now)))
+
+    async def makeRecommendations(self, user:PersonSchema):
+        return self.schedule(user).model_dump()
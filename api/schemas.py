@@ -1,6 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from dataclasses import dataclass
 from typing import List, Optional
-from datetime import datetime, time
+from datetime import date as Date, datetime, time  # `date` is also a field of AvailabilitySchema
 
 class TaskSchema(BaseModel):
     task_id: int  # Add task_id to represent the primary key (id)
@@ -28,6 +29,12 @@ class AvailabilitySchema(BaseModel):
     day_of_week: str
     start_time: time
     end_time: time
+    kind: str = "weekly"
+    date: Optional[Date] = None
+    interval_weeks: int = 1
+    starts_on: Optional[Date] = None
+    ends_on: Optional[Date] = None
+    timezone: str = ""
 
     class Config:
         from_attributes = True
@@ -39,7 +46,13 @@ class AvailabilitySchema(BaseModel):
             avail_id=availability.id,  # Map the task's id to task_id
             day_of_week=availability.day_of_week,
             start_time=availability.start_time,
-            end_time=availability.end_time
+            end_time=availability.end_time,
+            kind=availability.kind,
+            date=availability.date,
+            interval_weeks=availability.interval_weeks,
+            starts_on=availability.starts_on,
+            ends_on=availability.ends_on,
+            timezone=availability.timezone
         )
 
 class PersonSchema(BaseModel):
@@ -59,4 +72,15 @@ class PersonSchema(BaseModel):
             email=person.user.email,
             tasks=[TaskSchema.model_validate(task) for task in person.tasks.all()],
             availabilities = [AvailabilitySchema.model_validate(availability) for availability in person.availabilities.all()],
-        )
\ No newline at end of file
+        )
+
+
+@dataclass
+class Rec:
+    start_time : str
+    end_time : str
+    title : str
+
+
+class RecommendationOutput(BaseModel):
+    recs : List[Rec] = Field(description = "A list of recommendations for what the user should be completing at what time.")
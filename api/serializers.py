@@ -1,5 +1,12 @@
+from datetime import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
 from rest_framework import serializers
+from django.db import transaction
+from .freetime import DAYS_OF_WEEK
 from .models import Person, CustomUser, Task, Availability
+from .pagination import decode_cursor
+from .signals import person_data_changed
 
 class PersonSerializer(serializers.ModelSerializer):
     """
@@ -75,7 +82,258 @@ class TaskSerializer(serializers.ModelSerializer):
         model = Task
         fields = ['name', 'is_completed', 'due_date', 'priority']
 
+class TaskOperationSerializer(serializers.Serializer):
+    """
+    Serializer class that checks the shape of one operation in a task batch.
+
+    Attributes:
+        op (serializers.ChoiceField) : What to do, one of create, update, complete or delete
+        task_id (serializers.IntegerField) : The task to update, complete or delete
+        task (serializers.DictField) : The task fields to create or update
+    """
+    op = serializers.ChoiceField(choices=['create', 'update', 'complete', 'delete'])
+    task_id = serializers.IntegerField(required=False)
+    task = serializers.DictField(required=False)
+
+    def validate(self, data):
+        if data['op'] != 'create' and 'task_id' not in data:
+            raise serializers.ValidationError({'task_id': 'This field is required.'})
+        if data['op'] in ('create', 'update') and 'task' not in data:
+            raise serializers.ValidationError({'task': 'This field is required.'})
+        return data
+
+class TaskBatchSerializer(serializers.Serializer):
+    """
+    Serializer class that validates and applies a batch of task operations for a person.
+
+    Every operation is validated before anything is written, and the batch is applied
+    with bulk queries in one transaction, so either all of it happens or none of it.
+    The person is passed in the serializer's context. A batch may touch each task only once,
+    so applying the operations grouped by kind gives the same result as applying them in order.
+
+    Attributes:
+        operations (TaskOperationSerializer) : The operations, applied in the order create, update, complete, delete
+    """
+    operations = TaskOperationSerializer(many=True, allow_empty=False, max_length=500)
+
+    def validate_operations(self, operations):
+        person = self.context['person']
+        errors = [{} for _ in operations]
+
+        # Task fields are validated together, full for creates and partial for updates
+        for op, partial in (('create', False), ('update', True)):
+            indexes = [i for i, operation in enumerate(operations) if operation['op'] == op]
+            tasks = TaskSerializer(data=[operations[i]['task'] for i in indexes], many=True, partial=partial)
+            if tasks.is_valid():
+                for i, task in zip(indexes, tasks.validated_data):
+                    operations[i]['task'] = task
+            else:
+                # Depending on the DRF version item errors are a list, or a dict keyed by position with only the failures
+                item_errors = tasks.errors
+                if isinstance(item_errors, dict):
+                    item_errors = [item_errors.get(j, {}) for j in range(len(indexes))]
+                for i, error in zip(indexes, item_errors):
+                    if error:
+                        errors[i]['task'] = error
+
+        ids = {operation['task_id'] for operation in operations if operation['op'] != 'create'}
+        owned = set(Task.objects.filter(person=person, id__in=ids).values_list('id', flat=True))
+        for i, operation in enumerate(operations):
+            if operation['op'] != 'create' and operation['task_id'] not in owned:
+                errors[i]['task_id'] = 'Task not found for the user'
+
+        first = {}
+        for i, operation in enumerate(operations):
+            if operation['op'] != 'create':
+                j = first.setdefault(operation['task_id'], i)
+                if j != i:
+                    errors[i]['task_id'] = f'Task is already changed by operation {j} of the batch'
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return operations
+
+    def create(self, validated_data):
+        """
+        Method that applies the batch.
+
+        Returns:
+            List[dict]: One result per operation, in the order they were given
+        """
+        person = self.context['person']
+        operations = validated_data['operations']
+        by_op = lambda op: [operation for operation in operations if operation['op'] == op]
+
+        with transaction.atomic():
+            created = Task.objects.bulk_create(Task(person=person, **operation['task']) for operation in by_op('create'))
+
+            updates = by_op('update')
+            tasks = Task.objects.in_bulk([operation['task_id'] for operation in updates])
+            fields = set()
+            for operation in updates:
+                for field, value in operation['task'].items():
+                    setattr(tasks[operation['task_id']], field, value)
+                    fields.add(field)
+            if fields:
+                Task.objects.bulk_update(tasks.values(), sorted(fields))
+
+            Task.objects.filter(person=person, id__in=[operation['task_id'] for operation in by_op('complete')]).update(is_completed=True)
+            Task.objects.filter(person=person, id__in=[operation['task_id'] for operation in by_op('delete')]).delete()
+
+            person_data_changed.send(sender=Task, person_ids=[person.id])
+
+        created = iter(created)
+        return [
+            {"op": operation['op'], "task_id": next(created).id if operation['op'] == 'create' else operation['task_id']}
+            for operation in operations
+        ]
+
+class TaskListQuerySerializer(serializers.Serializer):
+    """
+    Serializer class that validates the filters, page and fields requested from the task list.
+
+    Attributes:
+        completed (serializers.BooleanField) : Only return tasks with this completion state
+        priority (serializers.CharField) : Comma separated priorities to return
+        due_after (serializers.DateTimeField) : Only return tasks due at or after this time
+        due_before (serializers.DateTimeField) : Only return tasks due before this time
+        limit (serializers.IntegerField) : Page size, the whole list is returned when it is not given
+        cursor (serializers.CharField) : The next_cursor of the previous page
+        fields (serializers.CharField) : Comma separated task fields to return
+    """
+    FIELDS = ['task_id'] + TaskSerializer.Meta.fields
+
+    completed = serializers.BooleanField(required=False, allow_null=True, default=None)
+    priority = serializers.CharField(required=False)
+    due_after = serializers.DateTimeField(required=False)
+    due_before = serializers.DateTimeField(required=False)
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=500)
+    cursor = serializers.CharField(required=False)
+    fields = serializers.CharField(required=False)
+
+    def validate_priority(self, value):
+        return value.split(',')
+
+    def validate_fields(self, value):
+        fields = value.split(',')
+        unknown = [field for field in fields if field not in self.FIELDS]
+        if unknown:
+            raise serializers.ValidationError(f"Unknown fields: {', '.join(unknown)}")
+        return fields
+
+    def validate_cursor(self, value):
+        try:
+            return decode_cursor(value)
+        except ValueError as error:
+            raise serializers.ValidationError(str(error))
+
+#Fields of an availability compared when saving a list, and what they are when left out
+AVAILABILITY_FIELDS = ['kind', 'day_of_week', 'start_time', 'end_time', 'date', 'interval_weeks', 'starts_on', 'ends_on', 'timezone']
+AVAILABILITY_DEFAULTS = {'kind': Availability.WEEKLY, 'interval_weeks': 1, 'timezone': ""}
+
+class AvailabilityListSerializer(serializers.ListSerializer):
+    """
+    Serializer class that replaces a person's weekly availabilities with a new list by applying only the differences.
+
+    Overrides and exceptions are added and removed one at a time, so saving the week leaves them alone.
+    """
+    def validate(self, data):
+        if any(avail.get('kind', Availability.WEEKLY) != Availability.WEEKLY for avail in data):
+            raise serializers.ValidationError("Only weekly availabilities are saved as a list, overrides and exceptions are added with /api/add-availability.")
+        return data
+
+    def update(self, instance, validated_data):
+        """
+        Method that diffs the new availabilities against the existing ones and writes the changes in bulk.
+
+        Unchanged slots are kept, changed slots are updated in place, and the rest are created or deleted.
+        Runs in one transaction so the person is never left without their availabilities.
+
+        Args:
+            instance : The person's existing availabilities, of which only the weekly ones are replaced
+            validated_data : The new weekly availabilities, each including the person
+        """
+        key = lambda avail: tuple(avail.get(field, AVAILABILITY_DEFAULTS.get(field)) for field in AVAILABILITY_FIELDS)
+
+        with transaction.atomic():
+            existing = {}
+            for avail in instance.filter(kind=Availability.WEEKLY).select_for_update():
+                existing.setdefault(tuple(getattr(avail, field) for field in AVAILABILITY_FIELDS), []).append(avail)
+
+            kept = []
+            added = []
+            for data in validated_data:
+                matches = existing.get(key(data))
+                if matches:
+                    kept.append(matches.pop())
+                else:
+                    added.append(data)
+
+            removed = [avail for matches in existing.values() for avail in matches]
+
+            # Days whose slots were added, removed or moved, so only those need re-planning
+            self.changed_days = {avail.day_of_week for avail in removed} | {data['day_of_week'] for data in added}
+
+            # Leftover rows are reused for new slots before anything is inserted or deleted
+            changed = []
+            for avail, data in zip(removed, added):
+                for field, value in zip(AVAILABILITY_FIELDS, key(data)):
+                    setattr(avail, field, value)
+                changed.append(avail)
+
+            Availability.objects.bulk_update(changed, AVAILABILITY_FIELDS)
+            created = Availability.objects.bulk_create(Availability(**data) for data in added[len(changed):])
+            Availability.objects.filter(id__in=[avail.id for avail in removed[len(changed):]]).delete()
+
+            if changed or created:
+                person_data_changed.send(sender=Availability, person_ids=[avail.person_id for avail in changed + created])
+
+        return kept + changed + created
+
 class AvailabilitySerializer(serializers.ModelSerializer):
+    """
+    Serializer class for a weekly availability rule, a date-specific override or an exception.
+
+    Overrides and exceptions take their day_of_week from their date. An exception without
+    start_time and end_time takes out the whole day.
+    """
     class Meta:
         model = Availability
-        fields = ['day_of_week', 'start_time', 'end_time']
\ No newline at end of file
+        fields = AVAILABILITY_FIELDS
+        list_serializer_class = AvailabilityListSerializer
+        extra_kwargs = {
+            'day_of_week': {'required': False},
+            'start_time': {'required': False},
+            'end_time': {'required': False},
+            'interval_weeks': {'min_value': 1},
+        }
+
+    def validate_timezone(self, value):
+        try:
+            return value and str(ZoneInfo(value))
+        except (ZoneInfoNotFoundError, ValueError):
+            raise serializers.ValidationError(f"Unknown time zone: {value}")
+
+    def validate(self, data):
+        kind = data.get('kind', Availability.WEEKLY)
+        if kind == Availability.WEEKLY:
+            if 'day_of_week' not in data:
+                raise serializers.ValidationError({'day_of_week': 'This field is required.'})
+            if data.get('date') is not None:
+                raise serializers.ValidationError({'date': 'Weekly availabilities have no date.'})
+        else:
+            if data.get('date') is None:
+                raise serializers.ValidationError({'date': 'This field is required.'})
+            data['day_of_week'] = DAYS_OF_WEEK[data['date'].weekday()]
+            # Dates do not recur
+            data['interval_weeks'], data['starts_on'], data['ends_on'] = 1, None, None
+
+        if kind == Availability.EXCEPTION and 'start_time' not in data and 'end_time' not in data:
+            data['start_time'], data['end_time'] = time.min, time.max
+        for field in ('start_time', 'end_time'):
+            if field not in data:
+                raise serializers.ValidationError({field: 'This field is required.'})
+
+        if data.get('starts_on') and data.get('ends_on') and data['ends_on'] < data['starts_on']:
+            raise serializers.ValidationError({'ends_on': 'Must not be before starts_on.'})
+        return data
\ No newline at end of file
@@ -0,0 +1,38 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from .models import CustomUser, Task, Availability
+from .snapshots import SnapshotCache
+
+#Sent by bulk writes to a person's tasks or availabilities, which do not send post_save or post_delete
+person_data_changed = Signal()
+
+
+def bump_person(person_id, user_id = None):
+    # Bumped once the write commits, so no request can store the old rows under the new version
+    snapshots = SnapshotCache()
+    user_id = user_id or snapshots.owner(person_id)
+    if user_id is not None:
+        transaction.on_commit(lambda: snapshots.bump(user_id))
+
+
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+@receiver(post_save, sender=Availability)
+@receiver(post_delete, sender=Availability)
+def row_changed(sender, instance, **kwargs):
+    # Views save rows with the person they loaded, whose user needs no lookup
+    person = sender.person.field.get_cached_value(instance, None)
+    bump_person(instance.person_id, person.user_id if person is not None else None)
+
+
+@receiver(person_data_changed)
+def rows_changed(sender, person_ids, **kwargs):
+    for person_id in set(person_ids):
+        bump_person(person_id)
+
+
+@receiver(post_save, sender=CustomUser)
+def user_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: SnapshotCache().bump(instance.id))
@@ -0,0 +1,95 @@
+import hashlib
+import uuid
+
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from rest_framework.renderers import JSONRenderer
+
+SNAPSHOT_CACHE_ALIAS = "snapshots"
+
+
+class SnapshotCache:
+    """
+    Serves a user's read endpoints from JSON rendered once per version of their data.
+
+    Each user has a version token that changes whenever their tasks, availabilities or account change
+    (see api/signals.py). Rendered bodies are stored under the version, so a change makes the old ones
+    unreachable instead of deleting them. The version is also the ETag, so a client that already has
+    the current body gets a 304 without any rendering or queries for the data.
+    """
+    def __init__(self, alias = SNAPSHOT_CACHE_ALIAS):
+        self.cache = caches[alias]
+
+    def _version_key(self, user_id):
+        return f"snapshot-version:{user_id}"
+
+    def version(self, user_id):
+        """
+        Returns the user's current version token, starting a new one if none is stored.
+        """
+        key = self._version_key(user_id)
+        version = self.cache.get(key)
+        if version is None:
+            # add keeps a token another request stored first
+            self.cache.add(key, uuid.uuid4().hex)
+            version = self.cache.get(key)
+        return version
+
+    def bump(self, user_id):
+        """
+        Gives the user a new version token, so their stored bodies and ETags no longer match.
+
+        Args:
+            user_id (int): The id of the CustomUser whose data changed
+        """
+        self.cache.set(self._version_key(user_id), uuid.uuid4().hex)
+
+    def owner(self, person_id):
+        """
+        Returns the id of the CustomUser of a Person, remembered since it never changes.
+        """
+        from .models import Person
+
+        key = f"snapshot-owner:{person_id}"
+        user_id = self.cache.get(key)
+        if user_id is None:
+            user_id = Person.objects.filter(id=person_id).values_list('user_id', flat=True).first()
+            if user_id is not None:
+                self.cache.set(key, user_id, timeout=None)
+        return user_id
+
+    def serve(self, request, name, render):
+        """
+        Responds with the user's snapshot of an endpoint.
+
+        Args:
+            request (Request): The request of an authenticated user
+            name (str): The endpoint, which together with the query string names the snapshot
+            render (Callable): Builds the endpoint's data when no current snapshot is stored
+
+        Returns:
+            HttpResponse: The JSON body with its ETag, or a 304 when the client's copy is current
+        """
+        version = self.version(request.user.id)
+        query = "&".join(f"{key}={value}" for key, values in sorted(request.GET.lists()) for value in values)
+        digest = hashlib.sha256(f"{name}?{query}".encode()).hexdigest()[:16]
+        etag = f'"{version}-{digest}"'
+
+        # Entity tags are compared whole and weakly, as If-None-Match asks
+        matches = {tag.removeprefix("W/") for tag in parse_etags(request.headers.get("If-None-Match", ""))}
+        if etag in matches or "*" in matches:
+            response = HttpResponseNotModified()
+        else:
+            key = f"snapshot:{request.user.id}:{version}:{digest}"
+            body = self.cache.get(key)
+            if body is None:
+                body = JSONRenderer().render(render())
+                self.cache.set(key, body)
+            response = HttpResponse(body, content_type="application/json")
+
+        response["ETag"] = etag
+        # The body belongs to the logged in user and must be revalidated before it is reused
+        response["Cache-Control"] = "private, no-cache"
+        response["Vary"] = "Cookie"
+        return response
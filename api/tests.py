@@ -1,3 +1,1184 @@
-from django.test import TestCase
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.conf import settings
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+from unittest import mock
 
-# Create your tests here.
+import asyncio
+import json
+import tempfile
+from pathlib import Path
+
+from pydantic_ai.exceptions import UnexpectedModelBehavior
+from pydantic_ai.messages import ModelResponse, ToolCallPart
+from pydantic_ai.models.function import DeltaToolCall, FunctionModel
+
+from .agent import RecommendationAgent, registry
+from .freetime import FreeTimeIndex, expand_availabilities, iter_windows, person_free_time
+from .backends import ReplayBackend, load_backend, record_response, rule_based_recommendation, select_backend
+from .jobs import RecommendationWorker, enqueue
+from .cache import RecommendationCache, snapshot_key, data_digest
+from .gateway import CircuitBreaker, ModelGateway, ModelUnavailable
+from .metrics import FALLBACKS
+from .models import CustomUser, Person, Task, Availability, RecommendationJob, ScheduledBlock, StoredRecommendation
+from .loaders import aload_person_schema, load_person_schema
+from .planner import SchedulePlanner
+from .recommendations import recommend
+from .repair import repair_recommendation
+from .routers import _wrote
+from .serializers import AvailabilitySerializer
+from .schemas import AvailabilitySchema, PersonSchema, Rec, RecommendationOutput, TaskSchema
+from .scheduler import LocalScheduler
+from .context import MAX_NAME_LENGTH, TASK_HEADER, build_context, estimate_tokens
+from .precompute import RecommendationPrecomputer
+
+class RecommendationInputQueryTests(TestCase):
+    """
+    Loading a user's recommendation input must cost the same number of queries however many tasks they have.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+
+    def add_tasks(self, count):
+        Task.objects.bulk_create(
+            Task(person=self.person, name=f"Task {i}", due_date=timezone.now() + timedelta(days=i)) for i in range(count)
+        )
+
+    def recommendation_queries(self):
+        self.client.force_login(self.user)
+        # The first request slots the new tasks into the persisted schedule
+        self.client.get("/api/get-recommendation")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/get-recommendation")
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_loader_query_count_is_constant(self):
+        self.add_tasks(1)
+        with self.assertNumQueries(3):
+            load_person_schema(user_id=self.user.id)
+
+        self.add_tasks(50)
+        with self.assertNumQueries(3):
+            person_id, schema = load_person_schema(user_id=self.user.id)
+
+        self.assertEqual(person_id, self.person.id)
+        self.assertEqual(len(schema.tasks), 51)
+        self.assertEqual(len(schema.availabilities), 1)
+
+    def test_recommendation_query_count_does_not_grow_with_tasks(self):
+        self.add_tasks(1)
+        few = self.recommendation_queries()
+
+        self.add_tasks(100)
+        self.assertEqual(self.recommendation_queries(), few)
+
+
+class LocalSchedulerTests(TestCase):
+    """
+    The local engine places overdue tasks first, then by due date and priority, without asking the model.
+    """
+    def setUp(self):
+        self.now = timezone.make_aware(timezone.datetime(2026, 10, 19, 8))  # A Monday
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+
+    def schema(self, *tasks):
+        return PersonSchema(
+            username="tester", email="tester@example.com",
+            tasks=[TaskSchema(task_id=i, name=name, is_completed=done, due_date=due, priority=priority) for i, (name, due, priority, done) in enumerate(tasks)],
+            availabilities=[AvailabilitySchema(avail_id=1, day_of_week="Monday", start_time=time(9), end_time=time(12))],
+        )
+
+    def test_tasks_are_placed_by_urgency(self):
+        user = self.schema(
+            ("Email", self.now + timedelta(days=2), "medium", False),
+            ("Essay", self.now + timedelta(days=2), "high", False),
+            ("Report", self.now - timedelta(days=1), "low", False),
+            ("Done", self.now - timedelta(days=2), "high", True),
+            ("Someday", None, "high", False),
+        )
+        recs = LocalScheduler().schedule(user, now=self.now).recs
+        at = lambda hour, minute = 0: self.now.replace(hour=hour, minute=minute)
+        self.assertEqual(
+            [(rec.title, datetime.fromisoformat(rec.start_time), datetime.fromisoformat(rec.end_time)) for rec in recs],
+            [
+                ("Work on Report", at(9), at(9, 30)),
+                ("Work on Essay", at(9, 30), at(10, 30)),
+                ("Work on Email", at(10, 30), at(11, 15)),
+                ("Work on Someday", at(11, 15), at(12)),
+            ],
+        )
+
+    def test_tasks_without_room_are_left_out(self):
+        user = self.schema(*((f"Task {i}", self.now + timedelta(days=1), "high", False) for i in range(5)))
+        recs = LocalScheduler(horizon_days=1).schedule(user, now=self.now).recs
+        self.assertEqual([rec.title for rec in recs], ["Work on Task 0", "Work on Task 1", "Work on Task 2"])
+
+    def test_local_engine_is_the_default(self):
+        Task.objects.create(person=self.person, name="Essay", due_date=timezone.now() + timedelta(days=1))
+        self.client.force_login(self.user)
+        with mock.patch("api.recommendations.agent_registry") as registry:
+            response = self.client.get("/api/get-recommendation")
+        self.assertEqual(response.status_code, 200)
+        registry.get.assert_not_called()
+        self.assertTrue(all(rec["title"] == "Work on Essay" for rec in response.json()["recommendation"]["recs"]))
+
+    def test_unknown_engine_is_rejected(self):
+        self.client.force_login(self.user)
+        response = self.client.get("/api/get-recommendation", {"engine": "oracle"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("local, agent, hybrid", response.json()["error"])
+
+
+class TaskListTests(TestCase):
+    """
+    /api/get-events pages through tasks by due date then id, and filters and trims them in the database.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        caches["snapshots"].clear()
+        self.now = timezone.now().replace(microsecond=0)
+        due = [self.now + timedelta(days=2), None, self.now + timedelta(days=1), self.now + timedelta(days=1), None, self.now + timedelta(days=3)]
+        self.tasks = [
+            Task.objects.create(person=self.person, name=f"Task {i}", due_date=due_date, priority=("high", "low")[i % 2], is_completed=i == 5)
+            for i, due_date in enumerate(due)
+        ]
+
+    def get(self, **params):
+        response = self.client.get("/api/get-events", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def ids(self, *indexes):
+        return [self.tasks[i].id for i in indexes]
+
+    def test_pages_follow_due_date_then_id(self):
+        seen, cursor, pages = [], None, 0
+        while True:
+            page = self.get(limit=2, **({"cursor": cursor} if cursor else {}))
+            seen += [task["task_id"] for task in page["tasks"]]
+            pages += 1
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, self.ids(2, 3, 0, 5, 1, 4))
+        self.assertEqual([task["task_id"] for task in self.get()["tasks"]], seen)
+
+    def test_filters(self):
+        listed = lambda **params: [task["task_id"] for task in self.get(**params)["tasks"]]
+        self.assertEqual(listed(completed="false"), self.ids(2, 3, 0, 1, 4))
+        self.assertEqual(listed(priority="low"), self.ids(3, 5, 1))
+        self.assertEqual(listed(due_after=(self.now + timedelta(days=2)).isoformat()), self.ids(0, 5))
+        self.assertEqual(listed(due_before=(self.now + timedelta(days=2)).isoformat()), self.ids(2, 3))
+
+    def test_fields_trim_each_task(self):
+        tasks = self.get(fields="task_id,name", limit=1)["tasks"]
+        self.assertEqual(tasks, [{"task_id": self.tasks[2].id, "name": "Task 2"}])
+
+    def test_bad_parameters_are_rejected(self):
+        for params in ({"fields": "name,owner"}, {"cursor": "not-a-cursor"}, {"limit": 0}):
+            self.assertEqual(self.client.get("/api/get-events", params).status_code, 400, params)
+
+
+class AvailabilitySaveTests(TestCase):
+    """
+    Saving the week only writes the slots that changed and re-plans only the days they are on.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.monday = Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+        self.tuesday = Availability.objects.create(person=self.person, day_of_week="Tuesday", start_time=time(9), end_time=time(12))
+
+    def save(self, *slots):
+        week = [{"day_of_week": day, "start_time": start, "end_time": end} for day, start, end in slots]
+        with mock.patch.object(SchedulePlanner, "replan_days") as replan_days:
+            response = self.client.post("/api/save-availabilities", {"availabilities": week}, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        replan_days.assert_called_once()
+        return replan_days.call_args.args[0]
+
+    def slots(self):
+        return {(avail.id, avail.day_of_week, avail.start_time) for avail in self.person.availabilities.all()}
+
+    def test_unchanged_week_writes_nothing(self):
+        before = self.slots()
+        with CaptureQueriesContext(connection) as queries:
+            changed_days = self.save(("Tuesday", "09:00", "12:00"), ("Monday", "09:00:00", "12:00"))
+        self.assertEqual(changed_days, set())
+        self.assertEqual(self.slots(), before)
+        self.assertFalse([query for query in queries if query["sql"].startswith(("INSERT", "UPDATE", "DELETE"))])
+
+    def test_moved_slot_reuses_its_row(self):
+        changed_days = self.save(("Monday", "09:00", "12:00"), ("Wednesday", "13:00", "15:00"))
+        self.assertEqual(changed_days, {"Tuesday", "Wednesday"})
+        self.assertEqual(self.slots(), {(self.monday.id, "Monday", time(9)), (self.tuesday.id, "Wednesday", time(13))})
+
+    def test_added_and_removed_slots(self):
+        changed_days = self.save(("Monday", "09:00", "12:00"), ("Monday", "14:00", "16:00"), ("Friday", "09:00", "10:00"))
+        self.assertEqual(changed_days, {"Tuesday", "Monday", "Friday"})
+        self.assertEqual(self.person.availabilities.count(), 3)
+        self.assertTrue(self.person.availabilities.filter(id=self.monday.id, start_time=time(9)).exists())
+
+        changed_days = self.save(("Monday", "09:00", "12:00"))
+        self.assertEqual(changed_days, {"Monday", "Friday"})
+        self.assertEqual(self.slots(), {(self.monday.id, "Monday", time(9))})
+
+
+class PromptContextTests(SimpleTestCase):
+    """
+    The model's context keeps the availabilities and the most important tasks that fit in the token budget.
+    """
+    def setUp(self):
+        self.now = timezone.make_aware(timezone.datetime(2026, 10, 19, 8))  # A Monday
+        self.availabilities = [AvailabilitySchema(avail_id=1, day_of_week="Monday", start_time=time(9), end_time=time(12))]
+
+    def user(self, *tasks):
+        return PersonSchema(
+            username="tester", email="tester@example.com",
+            tasks=[TaskSchema(task_id=i, name=name, is_completed=done, due_date=due, priority=priority) for i, (name, due, priority, done) in enumerate(tasks)],
+            availabilities=self.availabilities,
+        )
+
+    def test_budget_keeps_the_highest_ranked_tasks(self):
+        user = self.user(
+            ("Later", self.now + timedelta(days=5), "low", False),
+            ("Essay", self.now + timedelta(days=2), "high", False),
+            ("Overdue", self.now - timedelta(days=1), "low", False),
+            ("Email", self.now + timedelta(days=1), "high", False),
+            ("Done", self.now + timedelta(days=1), "high", True),
+            ("Next month", self.now + timedelta(days=30), "high", False),
+        )
+        everything = build_context(user, now=self.now, budget=10000, horizon_days=14)
+        self.assertEqual(everything.task_ids, {0, 1, 2, 3})
+        self.assertEqual(everything.omitted, 0)
+        self.assertEqual(everything.availabilities, "Mon 09:00-12:00")
+
+        rows = everything.tasks.split("\n")
+        self.assertEqual(rows[0], TASK_HEADER)
+        self.assertEqual([int(row.split("|")[0]) for row in rows[1:]], [2, 3, 1, 0])
+
+        # Just enough for the availabilities, the header and two rows
+        budget = estimate_tokens(everything.availabilities) + estimate_tokens(TASK_HEADER) + sum(estimate_tokens(row + "\n") for row in rows[1:3])
+        context = build_context(user, now=self.now, budget=budget, horizon_days=14)
+        self.assertEqual(context.task_ids, {2, 3})
+        self.assertEqual(context.omitted, 2)
+        self.assertEqual(context.tasks, "\n".join(rows[:3]))
+        self.assertLessEqual(context.tokens, budget)
+
+    def test_availabilities_are_kept_without_room_for_tasks(self):
+        context = build_context(self.user(("Essay", self.now + timedelta(days=1), "high", False)), now=self.now, budget=0, horizon_days=14)
+        self.assertEqual(context.availabilities, "Mon 09:00-12:00")
+        self.assertEqual(context.tasks, TASK_HEADER)
+        self.assertEqual((context.task_ids, context.omitted), (set(), 1))
+
+    def test_task_names_are_cleaned_and_cut(self):
+        context = build_context(self.user(("Read  a|b\n" + "x" * 100, None, "low", False)), now=self.now, budget=10000, horizon_days=14)
+        name = context.tasks.split("\n")[1].split("|")[1]
+        self.assertTrue(name.startswith("Read a/b x"))
+        self.assertEqual(len(name), MAX_NAME_LENGTH)
+        self.assertTrue(name.endswith("…"))
+
+
+class RecommendationPrecomputeTests(TestCase):
+    """
+    Precomputing skips people whose stored recommendation still applies and only includes recently active users.
+    """
+    def setUp(self):
+        self.recommendation = {"recs": [self.rec(2)]}
+        self.people = {name: self.person(name) for name in ("new", "fresh", "stale", "changed", "inactive", "away")}
+        CustomUser.objects.filter(username="inactive").update(is_active=False)
+        CustomUser.objects.filter(username="away").update(last_login=timezone.now() - timedelta(days=60))
+
+        for name in ("fresh", "stale", "changed"):
+            person_id, schema = load_person_schema(user_id=self.people[name].user_id)
+            StoredRecommendation.objects.create(person_id=person_id, engine="agent", digest=data_digest(schema, "agent"), result=self.recommendation)
+        StoredRecommendation.objects.filter(person=self.people["stale"]).update(
+            updated_at=timezone.now() - timedelta(hours=settings.RECOMMENDATION_PRECOMPUTED_MAX_AGE_HOURS + 1)
+        )
+        Task.objects.create(person=self.people["changed"], name="Email")
+
+    def rec(self, hours):
+        start = timezone.now() + timedelta(hours=hours)
+        return {"title": "Work on Essay", "start_time": start.isoformat(), "end_time": (start + timedelta(hours=1)).isoformat()}
+
+    def person(self, name):
+        user = CustomUser.objects.create_user(name, f"{name}@example.com", "password", last_login=timezone.now())
+        person = Person.objects.create(user=user)
+        Task.objects.create(person=person, name="Essay", due_date=timezone.now() + timedelta(days=1))
+        return person
+
+    async def test_only_missing_and_outdated_recommendations_are_made(self):
+        with mock.patch("api.precompute.generate", return_value=self.recommendation) as generate:
+            progress = await RecommendationPrecomputer(chunk_size=2).run()
+
+        made = {call.args[0] for call in generate.call_args_list}
+        self.assertEqual(made, {self.people[name].id for name in ("new", "stale", "changed")})
+        self.assertTrue(all(call.kwargs["allow_fallback"] is False for call in generate.call_args_list))
+        self.assertEqual((progress.total, progress.processed, progress.generated, progress.fresh, progress.failed), (4, 4, 3, 1, 0))
+        self.assertEqual(await StoredRecommendation.objects.filter(person_id__in=made).acount(), 3)
+
+        with mock.patch("api.precompute.generate", return_value=self.recommendation) as generate:
+            progress = await RecommendationPrecomputer().run()
+        generate.assert_not_called()
+        self.assertEqual(progress.fresh, 4)
+
+    async def test_failures_are_left_for_the_next_run(self):
+        with mock.patch("api.precompute.generate", side_effect=ModelUnavailable("down")):
+            progress = await RecommendationPrecomputer().run()
+        self.assertEqual((progress.generated, progress.fresh, progress.failed), (0, 1, 3))
+        self.assertFalse(await StoredRecommendation.objects.filter(person=self.people["new"]).aexists())
+
+    def test_stored_recommendation_is_served_while_it_applies(self):
+        self.client.force_login(self.people["fresh"].user)
+        with mock.patch("api.recommendations.generate") as generate:
+            response = self.client.get("/api/get-recommendation", {"engine": "agent"})
+        generate.assert_not_called()
+        self.assertEqual(response.json()["recommendation"], self.recommendation)
+
+        self.client.force_login(self.people["stale"].user)
+        with mock.patch("api.recommendations.generate", return_value={"recs": []}) as generate:
+            response = self.client.get("/api/get-recommendation", {"engine": "agent"})
+        generate.assert_called_once()
+        self.assertEqual(response.json()["recommendation"], {"recs": []})
+
+    def test_elapsed_recs_are_not_served(self):
+        self.client.force_login(self.people["fresh"].user)
+        stored = StoredRecommendation.objects.filter(person=self.people["fresh"])
+        ended, running, later = self.rec(-3), self.rec(-0.5), self.rec(2)
+        stored.update(result={"recs": [ended, running, later]})
+        with mock.patch("api.recommendations.generate") as generate:
+            response = self.client.get("/api/get-recommendation", {"engine": "agent"})
+        generate.assert_not_called()
+        # The Rec still running is kept
+        self.assertEqual(response.json()["recommendation"]["recs"], [running, later])
+
+        stored.update(result={"recs": [ended]})
+        with mock.patch("api.recommendations.generate", return_value=self.recommendation) as generate:
+            response = self.client.get("/api/get-recommendation", {"engine": "agent"})
+        generate.assert_called_once()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ModelGatewayTests(SimpleTestCase):
+    """
+    The gateway must limit, coalesce and retry model calls, and stop calling a failing provider.
+    """
+    def gateway(self, **kwargs):
+        return ModelGateway(**{"concurrency": 4, "user_concurrency": 1, "timeout": 1, "retries": 2, "backoff": 0, **kwargs})
+
+    async def test_identical_requests_share_one_call(self):
+        gateway = self.gateway()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*(gateway.run("same", "tester", call) for _ in range(5)))
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(len(calls), 1)
+
+    async def test_calls_are_limited_per_user_and_globally(self):
+        gateway = self.gateway(concurrency=2)
+        running = {"now": 0, "most": 0}
+
+        async def call():
+            running["now"] += 1
+            running["most"] = max(running["most"], running["now"])
+            await asyncio.sleep(0.01)
+            running["now"] -= 1
+
+        await asyncio.gather(*(gateway.run(f"request {i}", "tester", call) for i in range(3)))
+        self.assertEqual(running["most"], 1)
+
+        await asyncio.gather(*(gateway.run(f"request {i}", f"user {i}", call) for i in range(4)))
+        self.assertEqual(running["most"], 2)
+
+    async def test_timeouts_are_retried(self):
+        gateway = self.gateway(timeout=0.05)
+        attempts = []
+
+        async def call():
+            attempts.append(1)
+            if len(attempts) < 3:
+                await asyncio.sleep(1)
+            return "result"
+
+        self.assertEqual(await gateway.run("request", "tester", call), "result")
+        self.assertEqual(len(attempts), 3)
+
+    async def test_circuit_opens_and_recovers(self):
+        clock = FakeClock()
+        gateway = self.gateway(retries=0, breaker=CircuitBreaker(threshold=2, cooldown=30, clock=clock))
+
+        async def failing():
+            raise UnexpectedModelBehavior("Unexpected response from gemini 503")
+
+        async def working():
+            return "result"
+
+        for i in range(2):
+            with self.assertRaises(ModelUnavailable):
+                await gateway.run(f"request {i}", "tester", failing)
+        self.assertEqual(gateway.breaker.state, "open")
+
+        # Refused without calling the model
+        with self.assertRaises(ModelUnavailable):
+            await gateway.run("request", "tester", working)
+
+        clock.now = 30
+        self.assertEqual(await gateway.run("request", "tester", working), "result")
+        self.assertEqual(gateway.breaker.state, "closed")
+
+    async def test_agent_retries_a_failing_model(self):
+        turns = []
+
+        def respond(messages, info):
+            turns.append(1)
+            if len(turns) == 1:
+                raise UnexpectedModelBehavior("Unexpected response from gemini 500")
+            return ModelResponse(parts=[ToolCallPart.from_raw_args(info.result_tools[0].name, {"recs": []})])
+
+        agent = RecommendationAgent(gateway=self.gateway())
+        agent.agent.model = FunctionModel(respond)
+        user = mock.Mock(username="tester", tasks=[], availabilities=[])
+        user.model_dump_json.return_value = "{}"
+
+        self.assertEqual(await agent.makeRecommendations(user), {"recs": []})
+        self.assertEqual(len(turns), 2)
+
+
+class RecommendationFallbackTests(TestCase):
+    """
+    While the model's circuit is open, recommendations must still be answered, from the local scheduler.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+        Task.objects.create(person=self.person, name="Essay", due_date=timezone.now() + timedelta(days=3))
+
+    async def test_open_circuit_falls_back_to_local_plan(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=60)
+        breaker.failure()
+        person_id, schema = await aload_person_schema(user_id=self.user.id)
+        before = FALLBACKS.value(engine="agent", source="local")
+
+        with mock.patch.object(registry.get(), "gateway", ModelGateway(breaker=breaker)):
+            recommendation = await recommend(person_id, schema, "agent")
+
+        self.assertEqual(FALLBACKS.value(engine="agent", source="local"), before + 1)
+        self.assertEqual(recommendation["recs"][0]["title"], "Work on Essay")
+
+
+SCHEDULE_PROMPT = "The time is {now}.\n\nTasks:\nid|name|due|priority\n1|Essay|-|high\n2|Email|-|low\n\nAvailabilities:\nMon 09:00-12:00"
+
+
+class ModelBackendTests(SimpleTestCase):
+    """
+    The offline backends must answer the agent without a network, the same way every time.
+    """
+    def test_rules_schedule_into_availabilities(self):
+        recommendation = rule_based_recommendation(SCHEDULE_PROMPT.format(now="2026-10-19 08:00:00.123456"))
+        self.assertEqual(recommendation["recs"], [
+            {"title": "Work on Essay", "start_time": "2026-10-19T09:00:00", "end_time": "2026-10-19T10:00:00"},
+            {"title": "Work on Email", "start_time": "2026-10-19T10:00:00", "end_time": "2026-10-19T10:30:00"},
+        ])
+
+    def test_replay_ignores_the_time_of_the_prompt(self):
+        recorded = {"recs": [{"title": "Recorded", "start_time": "2026-10-19T09:00:00", "end_time": "2026-10-19T09:30:00"}]}
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "recordings.jsonl"
+            with override_settings(RECOMMENDATION_RECORD_FILE=str(path)):
+                record_response(SCHEDULE_PROMPT.format(now="2026-10-19 08:00:00"), recorded)
+                backend = ReplayBackend("replay", strict=True)
+
+                self.assertEqual(backend.answer(SCHEDULE_PROMPT.format(now="2026-10-20 17:45:12.5")), recorded)
+                with self.assertRaises(LookupError):
+                    backend.answer("The time is 2026-10-20 17:45:12. Something else")
+
+    @override_settings(RECOMMENDATION_BACKENDS={
+        "slow": {"BACKEND": "api.backends.RuleBasedBackend", "LATENCY_BUDGET": 20, "COST": 1},
+        "fast": {"BACKEND": "api.backends.RuleBasedBackend", "LATENCY_BUDGET": 5, "COST": 3},
+        "cheap": {"BACKEND": "api.backends.RuleBasedBackend", "LATENCY_BUDGET": 8, "COST": 2},
+        "fixture": {"BACKEND": "api.backends.ReplayBackend", "LATENCY_BUDGET": 0.01},
+    })
+    def test_cheapest_backend_within_sla_is_selected(self):
+        self.assertEqual(select_backend(30).name, "slow")
+        self.assertEqual(select_backend(10).name, "cheap")
+        self.assertEqual(select_backend(5).name, "fast")
+        with self.assertRaises(ImproperlyConfigured):
+            select_backend(1)
+
+    async def test_agent_runs_offline_on_rules(self):
+        user = PersonSchema(
+            username="tester", email="tester@example.com",
+            tasks=[TaskSchema(task_id=1, name="Essay", is_completed=False, due_date=None, priority="high")],
+            availabilities=[AvailabilitySchema(avail_id=1, day_of_week=day, start_time=time(9), end_time=time(12)) for day in ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")],
+        )
+        # Without the inlined context the model has to call the agent's tools for it
+        agent = RecommendationAgent(backend=load_backend("rules"), inline_context=False)
+
+        recommendation = await agent.makeRecommendations(user)
+        self.assertEqual([rec["title"] for rec in recommendation["recs"]], ["Work on Essay"])
+
+
+class RecommendationRepairTests(SimpleTestCase):
+    """
+    Model recommendations breaking the scheduling rules must be repaired locally where possible.
+    """
+    def setUp(self):
+        self.now = timezone.make_aware(timezone.datetime(2026, 10, 19, 8))  # A Monday
+        self.user = PersonSchema(
+            username="tester", email="tester@example.com",
+            tasks=[
+                TaskSchema(task_id=1, name="Essay", is_completed=False, due_date=self.now + timedelta(hours=3), priority="high"),
+                TaskSchema(task_id=2, name="Email", is_completed=False, due_date=None, priority="low"),
+            ],
+            availabilities=[AvailabilitySchema(avail_id=i, day_of_week=day, start_time=time(9), end_time=time(12)) for i, day in enumerate(("Monday", "Tuesday"))],
+        )
+
+    def repair(self, *recs):
+        return repair_recommendation(self.user, RecommendationOutput(recs=[Rec(start_time=start, end_time=end, title=title) for title, start, end in recs]), now=self.now)
+
+    def times(self, report):
+        return [(rec.title, rec.start_time, rec.end_time) for rec in report.output.recs]
+
+    def test_valid_recommendation_is_kept(self):
+        report = self.repair(("Work on Essay", "2026-10-19T09:00:00", "2026-10-19T10:00:00"))
+        self.assertEqual(self.times(report), [("Work on Essay", "2026-10-19T09:00:00", "2026-10-19T10:00:00")])
+        self.assertFalse(report.violations)
+
+    def test_overlap_and_unavailable_time_are_shifted_or_trimmed(self):
+        report = self.repair(
+            ("Work on Email", "2026-10-19T09:00:00", "2026-10-19T10:00:00"),
+            ("Write the Essay", "2026-10-19T09:30:00", "2026-10-19T10:30:00"),
+            ("Reading", "2026-10-19T13:00:00", "2026-10-19T16:00:00"),
+        )
+        self.assertEqual(self.times(report), [
+            ("Work on Email", "2026-10-19T09:00:00", "2026-10-19T10:00:00"),
+            ("Write the Essay", "2026-10-19T10:00:00", "2026-10-19T11:00:00"),
+            ("Reading", "2026-10-20T09:00:00", "2026-10-20T12:00:00"),
+        ])
+        self.assertEqual(report.violations, {"overlap": 1, "outside_availability": 1})
+        self.assertEqual(report.repairs, {"shift": 2})
+        self.assertFalse(report.unrecoverable)
+
+    def test_late_task_is_moved_before_its_due_date(self):
+        report = self.repair(("Work on Essay", "2026-10-20T09:00:00", "2026-10-20T10:00:00"))
+        self.assertEqual(self.times(report), [("Work on Essay", "2026-10-19T09:00:00", "2026-10-19T10:00:00")])
+        self.assertEqual(report.violations, {"past_due": 1})
+
+    def test_mostly_broken_recommendation_is_unrecoverable(self):
+        report = self.repair(
+            ("Work on Email", "tomorrow morning", "2026-10-19T10:00:00"),
+            ("Work on Essay", "2026-10-19T10:00:00", "2026-10-19T10:00:00"),
+            ("Reading", "2026-10-19T11:00:00", "2026-10-19T09:00:00"),
+        )
+        self.assertEqual(self.times(report), [("Reading", "2026-10-19T09:00:00", "2026-10-19T11:00:00")])
+        self.assertEqual(report.violations, {"unparseable": 1, "inverted": 2})
+        self.assertTrue(report.unrecoverable)
+
+    async def test_streamed_recs_out_of_order_are_kept(self):
+        answer = {"recs": [
+            {"title": "Work on Email", "start_time": "2026-10-19T11:00:00", "end_time": "2026-10-19T12:00:00"},
+            {"title": "Reading", "start_time": "2026-10-19T09:00:00", "end_time": "2026-10-19T10:00:00"},
+        ]}
+
+        async def stream(messages, info):
+            yield {0: DeltaToolCall(name=info.result_tools[0].name, json_args=json.dumps(answer))}
+
+        agent = RecommendationAgent(backend=load_backend("rules"), gateway=ModelGateway(retries=0))
+        agent.agent.model = FunctionModel(stream_function=stream)
+        with mock.patch("django.utils.timezone.now", return_value=self.now):
+            recs = [rec async for rec in agent.streamRecommendations(self.user)]
+
+        # The earlier Rec arriving second is not an overlap of the later one already sent
+        self.assertEqual([(rec.title, rec.start_time, rec.end_time) for rec in recs], [(rec["title"], rec["start_time"], rec["end_time"]) for rec in answer["recs"]])
+
+    async def test_model_is_asked_again_only_when_unrecoverable(self):
+        answers = [
+            {"recs": [{"title": "Work on Essay", "start_time": "soon", "end_time": "later"}]},
+            {"recs": [{"title": "Work on Essay", "start_time": "2026-10-19T09:00:00", "end_time": "2026-10-19T10:00:00"}]},
+        ]
+
+        def respond(messages, info):
+            return ModelResponse(parts=[ToolCallPart.from_raw_args(info.result_tools[0].name, answers.pop(0))])
+
+        agent = RecommendationAgent(backend=load_backend("rules"), gateway=ModelGateway(retries=0))
+        agent.agent.model = FunctionModel(respond)
+        with mock.patch("django.utils.timezone.now", return_value=self.now):
+            recommendation = await agent.makeRecommendations(self.user)
+
+        self.assertEqual(recommendation, {"recs": [{"title": "Work on Essay", "start_time": "2026-10-19T09:00:00", "end_time": "2026-10-19T10:00:00"}]})
+        self.assertEqual(answers, [])
+
+
+class AvailabilityRecurrenceTests(TestCase):
+    """
+    Weekly rules recur on their own schedule, with date-specific overrides and exceptions applied on top.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.start = datetime(2026, 10, 19, tzinfo=ZoneInfo("UTC"))
+
+    def slot(self, day_of_week, start, end, **kwargs):
+        return AvailabilitySchema(avail_id=0, day_of_week=day_of_week, start_time=start, end_time=end, **kwargs)
+
+    def windows(self, availabilities, days = 21):
+        return [(start.isoformat(), end.isoformat()) for start, end in expand_availabilities(availabilities, self.start, self.start + timedelta(days=days))]
+
+    def test_overrides_replace_and_exceptions_remove_time(self):
+        availabilities = [
+            self.slot("Monday", time(9), time(12)),
+            self.slot("Monday", time(10), time(11), kind="exception", date=date(2026, 10, 26)),
+            self.slot("Monday", time(14), time(15), kind="override", date=date(2026, 11, 2)),
+        ]
+        self.assertEqual(self.windows(availabilities), [
+            ("2026-10-19T09:00:00+00:00", "2026-10-19T12:00:00+00:00"),
+            ("2026-10-26T09:00:00+00:00", "2026-10-26T10:00:00+00:00"),
+            ("2026-10-26T11:00:00+00:00", "2026-10-26T12:00:00+00:00"),
+            ("2026-11-02T14:00:00+00:00", "2026-11-02T15:00:00+00:00"),
+        ])
+
+    def test_rules_recur_every_few_weeks_in_their_own_time_zone(self):
+        availabilities = [
+            self.slot("Tuesday", time(9), time(10), interval_weeks=2, starts_on=date(2026, 10, 13)),
+            self.slot("Wednesday", time(9), time(10), timezone="America/New_York", ends_on=date(2026, 10, 28)),
+        ]
+        self.assertEqual(self.windows(availabilities), [
+            ("2026-10-21T13:00:00+00:00", "2026-10-21T14:00:00+00:00"),
+            ("2026-10-27T09:00:00+00:00", "2026-10-27T10:00:00+00:00"),
+            ("2026-10-28T13:00:00+00:00", "2026-10-28T14:00:00+00:00"),
+        ])
+
+    def test_expansion_is_lazy(self):
+        windows = iter_windows([self.slot("Monday", time(9), time(12))], self.start, self.start + timedelta(days=365 * 100))
+        self.assertEqual(next(windows), (self.start.replace(hour=9), self.start.replace(hour=12)))
+
+    def test_whole_day_exception_is_added_without_resaving_the_week(self):
+        Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+        before = person_free_time(load_person_schema(id=self.person.id)[1].availabilities, self.start, self.start + timedelta(days=14))
+        self.assertEqual(len(before), 2)
+
+        response = self.client.post("/api/add-availability", {"kind": "exception", "date": "2026-10-26"}, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        exception = Availability.objects.get(id=response.json()["availability_id"])
+        self.assertEqual((exception.day_of_week, exception.start_time, exception.end_time), ("Monday", time.min, time.max))
+
+        # The cached weeks are keyed on the availabilities, so the holiday is seen at once
+        after = person_free_time(load_person_schema(id=self.person.id)[1].availabilities, self.start, self.start + timedelta(days=14))
+        self.assertEqual(after.windows(), [(self.start.replace(hour=9), self.start.replace(hour=12))])
+
+        response = self.client.post("/api/remove-availability", {"availability_id": exception.id}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Availability.objects.filter(person=self.person).count(), 1)
+
+    def test_saving_the_week_keeps_overrides_and_exceptions(self):
+        Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+        self.client.post("/api/add-availability", {"kind": "exception", "date": "2026-12-28"}, content_type="application/json")
+        self.client.post("/api/add-availability", {"kind": "override", "date": "2026-12-29", "start_time": "10:00", "end_time": "11:00"}, content_type="application/json")
+
+        # The week as the availability page sends it back, only the weekly slots it was given
+        listed = self.client.get("/api/get-availabilities").json()
+        self.assertEqual([(avail["day_of_week"], avail["start_time"]) for avail in listed["availabilities"]], [("Monday", "09:00:00")])
+        self.assertEqual([avail["kind"] for avail in listed["dates"]], ["exception", "override"])
+
+        week = [
+            {"day_of_week": "Monday", "start_time": "09:00", "end_time": "12:00"},
+            {"day_of_week": "Tuesday", "start_time": "13:00", "end_time": "14:00"},
+        ]
+        response = self.client.post("/api/save-availabilities", {"availabilities": week}, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+
+        rows = set(Availability.objects.filter(person=self.person).values_list("kind", "day_of_week", "date"))
+        self.assertEqual(rows, {
+            ("weekly", "Monday", None),
+            ("weekly", "Tuesday", None),
+            ("exception", "Monday", date(2026, 12, 28)),
+            ("override", "Tuesday", date(2026, 12, 29)),
+        })
+
+        response = self.client.post("/api/save-availabilities", {"availabilities": [{"kind": "exception", "date": "2026-12-30"}]}, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class SchedulePlannerTests(TestCase):
+    """
+    The persisted schedule is repaired in place and never holds two upcoming blocks for one task.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        Availability.objects.create(person=self.person, day_of_week="Tuesday", start_time=time(9), end_time=time(12))
+        self.task = Task.objects.create(person=self.person, name="Essay", priority="high", due_date=datetime(2026, 10, 30, tzinfo=ZoneInfo("UTC")))
+        # A Monday morning
+        self.now = datetime(2026, 10, 19, 8, tzinfo=ZoneInfo("UTC"))
+
+    def planner(self):
+        return SchedulePlanner(self.person.id, now=self.now)
+
+    def starts(self):
+        return list(ScheduledBlock.objects.filter(person=self.person).values_list("start_time", flat=True))
+
+    def test_missing_task_is_placed_once(self):
+        self.planner().recommendation()
+        self.assertEqual(self.starts(), [datetime(2026, 10, 20, 9, tzinfo=ZoneInfo("UTC"))])
+
+        # A request that read the schedule before another one placed the task re-reads it under the lock
+        planner = self.planner()
+        real_blocks = planner._blocks
+        reads = iter([[]])
+        with mock.patch.object(planner, "_blocks", side_effect=lambda: next(reads, None) or real_blocks()):
+            recommendation = planner.recommendation()
+
+        self.assertEqual(len(self.starts()), 1)
+        self.assertEqual([rec.title for rec in recommendation.recs], ["Work on Essay"])
+
+    def test_added_time_pulls_later_blocks_earlier(self):
+        self.planner().recommendation()
+        Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+
+        self.planner().replan_days({"Monday"})
+        self.assertEqual(self.starts(), [datetime(2026, 10, 19, 9, tzinfo=ZoneInfo("UTC"))])
+
+    def test_blocks_before_the_changed_day_stay(self):
+        self.planner().recommendation()
+        Availability.objects.create(person=self.person, day_of_week="Wednesday", start_time=time(9), end_time=time(12))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.planner().replan_days({"Wednesday"})
+        self.assertEqual(self.starts(), [datetime(2026, 10, 20, 9, tzinfo=ZoneInfo("UTC"))])
+        self.assertFalse([query for query in queries if query["sql"].startswith("DELETE")])
+
+    def fill_schedule(self):
+        # Six hours of urgent tasks use up both Tuesdays within the horizon
+        for i in range(5):
+            Task.objects.create(person=self.person, name=f"Urgent {i}", priority="high", due_date=datetime(2026, 10, 22, tzinfo=ZoneInfo("UTC")))
+        self.planner().replan()
+        self.assertEqual(len(self.starts()), 6)
+
+    def test_task_without_room_does_not_replan(self):
+        self.fill_schedule()
+        task = Task.objects.create(person=self.person, name="Someday", priority="low", due_date=datetime(2026, 11, 1, tzinfo=ZoneInfo("UTC")))
+        with CaptureQueriesContext(connection) as queries:
+            self.planner().add([task.id])
+        self.assertFalse([query for query in queries if query["sql"].startswith("DELETE")])
+        self.assertFalse(ScheduledBlock.objects.filter(task=task).exists())
+
+    def test_urgent_task_takes_the_time_of_a_less_urgent_one(self):
+        self.fill_schedule()
+        task = Task.objects.create(person=self.person, name="Tomorrow", priority="high", due_date=datetime(2026, 10, 21, tzinfo=ZoneInfo("UTC")))
+        self.planner().add([task.id])
+        self.assertEqual(ScheduledBlock.objects.get(task=task).start_time, datetime(2026, 10, 20, 9, tzinfo=ZoneInfo("UTC")))
+        self.assertFalse(ScheduledBlock.objects.filter(task=self.task).exists())
+
+    def exception(self, day):
+        return Availability.objects.create(person=self.person, kind=Availability.EXCEPTION, day_of_week=day.strftime("%A"), date=day, start_time=time.min, end_time=time.max)
+
+    def test_exception_moves_only_the_blocks_from_its_date(self):
+        self.planner().recommendation()
+        self.planner().replan_availability(self.exception(date(2026, 10, 20)))
+        self.assertEqual(self.starts(), [datetime(2026, 10, 27, 9, tzinfo=ZoneInfo("UTC"))])
+
+    def test_exception_past_the_horizon_keeps_the_schedule(self):
+        self.planner().recommendation()
+        with CaptureQueriesContext(connection) as queries:
+            self.planner().replan_availability(self.exception(date(2026, 12, 29)))
+        self.assertEqual(self.starts(), [datetime(2026, 10, 20, 9, tzinfo=ZoneInfo("UTC"))])
+        self.assertFalse([query for query in queries if query["sql"].startswith("DELETE")])
+
+
+class SnapshotTests(TestCase):
+    """
+    Read endpoints answer 304 while the client's copy is current and a new body once the user's data changes.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        caches["snapshots"].clear()
+
+    def get(self, etags = None):
+        headers = {"If-None-Match": etags} if etags else {}
+        return self.client.get("/api/get-events", headers=headers)
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.get()["ETag"]
+        self.assertEqual(self.get(etag).status_code, 304)
+        self.assertEqual(self.get(f'"other", W/{etag}').status_code, 304)
+        self.assertEqual(self.get("*").status_code, 304)
+
+    def test_etag_is_compared_whole(self):
+        etag = self.get()["ETag"]
+        self.assertEqual(self.get(f'"x{etag[1:-1]}x"').status_code, 200)
+
+    def test_write_bumps_the_version(self):
+        etag = self.get()["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/add-event", {"name": "Essay", "priority": "high"}, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn(b"Essay", response.content)
+
+    def test_saving_with_the_person_loaded_needs_no_owner_lookup(self):
+        person = Person.objects.select_related("user").get(id=self.person.id)
+        with self.assertNumQueries(1):
+            Task.objects.create(person=person, name="Essay")
+
+
+class FreeTimeIndexTests(SimpleTestCase):
+    """
+    Fit, capacity and take queries of the free time index, including stretches that start or end inside a window.
+    """
+    def at(self, day, hour, minute = 0):
+        return datetime(2026, 10, day, hour, minute, tzinfo=ZoneInfo("UTC"))
+
+    def setUp(self):
+        # Monday 9-12 and 14-15, Tuesday 9-10
+        self.free = FreeTimeIndex([(self.at(19, 9), self.at(19, 12)), (self.at(19, 14), self.at(19, 15)), (self.at(20, 9), self.at(20, 10))])
+
+    def test_earliest_fit(self):
+        self.assertEqual(self.free.earliest_fit(timedelta(hours=2)), self.at(19, 9))
+        self.assertEqual(self.free.earliest_fit(timedelta(hours=1), after=self.at(19, 10, 30)), self.at(19, 10, 30))
+        # Only the remainder of a window is free after `after`, too short here, and no later window is long enough
+        self.assertIsNone(self.free.earliest_fit(timedelta(hours=2), after=self.at(19, 10, 30)))
+        self.assertEqual(self.free.earliest_fit(timedelta(hours=1), after=self.at(19, 11, 30)), self.at(19, 14))
+        self.assertIsNone(self.free.earliest_fit(timedelta(hours=1), after=self.at(19, 11, 30), before=self.at(19, 14, 30)))
+
+    def test_capacity_of_partial_windows(self):
+        self.assertEqual(self.free.capacity(), timedelta(hours=5))
+        self.assertEqual(self.free.capacity(self.at(19, 10, 30), self.at(19, 14, 30)), timedelta(hours=2))
+        self.assertEqual(self.free.capacity(self.at(19, 9, 30), self.at(19, 9, 45)), timedelta(minutes=15))
+        self.assertEqual(self.free.capacity(self.at(19, 12), self.at(19, 14)), timedelta(0))
+
+    def test_take(self):
+        self.assertEqual(self.free.take(self.at(19, 9), timedelta(hours=1)), self.at(19, 10))
+        self.assertEqual(self.free.capacity(), timedelta(hours=4))
+        self.assertEqual(self.free.earliest_fit(timedelta(hours=2, minutes=30)), None)
+        self.assertEqual(self.free.earliest_fit(timedelta(hours=2)), self.at(19, 10))
+
+        # Taking more than the window has is trimmed to it
+        self.assertEqual(self.free.take(self.at(19, 14), timedelta(hours=3)), self.at(19, 15))
+        self.assertEqual(self.free.windows(), [(self.at(19, 10), self.at(19, 12)), (self.at(20, 9), self.at(20, 10))])
+        with self.assertRaises(ValueError):
+            self.free.take(self.at(19, 13), timedelta(hours=1))
+
+
+class RecommendationJobTests(TestCase):
+    """
+    Queued jobs run once per claim, keep their lease while running and are retried with backoff.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+
+    def test_pending_job_is_reused(self):
+        job = enqueue(self.person)
+        self.assertEqual(enqueue(self.person).id, job.id)
+        self.assertNotEqual(enqueue(self.person, engine="hybrid").id, job.id)
+
+        # What a racing request's insert runs into
+        with self.assertRaises(IntegrityError):
+            RecommendationJob.objects.create(person=self.person, engine="agent")
+
+    @override_settings(RECOMMENDATION_JOB_LEASE_SECONDS=0.3)
+    async def test_running_job_keeps_its_lease(self):
+        job = await RecommendationJob.objects.acreate(person=self.person, engine="local")
+
+        async def slow(person_id, schema, engine, allow_fallback):
+            await asyncio.sleep(0.6)
+            return {"recs": []}
+
+        worker = RecommendationWorker(concurrency=1)
+        with mock.patch("api.jobs.recommend", side_effect=slow):
+            self.assertEqual(await worker.run_once(), 1)
+            await asyncio.sleep(0.45)
+            # Past the lease since the claim, but the heartbeat renewed it
+            self.assertEqual(await RecommendationWorker().claim(1), [])
+            await asyncio.gather(*worker.running)
+
+        job = await RecommendationJob.objects.aget(id=job.id)
+        self.assertEqual((job.status, job.attempts, job.result), (RecommendationJob.DONE, 1, {"recs": []}))
+
+    async def test_reclaimed_job_is_left_to_its_new_worker(self):
+        job = await RecommendationJob.objects.acreate(person=self.person, engine="local")
+        worker = RecommendationWorker()
+        [claimed] = await worker.claim(1)
+        # Another worker took the job over, as after a lapsed lease
+        await RecommendationJob.objects.filter(id=job.id).aupdate(attempts=2)
+
+        with mock.patch("api.jobs.recommend", return_value={"recs": []}):
+            await worker.process(claimed)
+
+        job = await RecommendationJob.objects.aget(id=job.id)
+        self.assertEqual((job.status, job.result), (RecommendationJob.RUNNING, None))
+
+    async def test_failed_job_is_retried_later(self):
+        job = await RecommendationJob.objects.acreate(person=self.person, engine="agent")
+        worker = RecommendationWorker()
+        breaker = CircuitBreaker(threshold=1, cooldown=60)
+        breaker.failure()
+        # The open circuit would be answered with the fallback outside a job
+        with mock.patch.object(registry.get(), "gateway", ModelGateway(breaker=breaker)):
+            [claimed] = await worker.claim(1)
+            await worker.process(claimed)
+
+        job = await RecommendationJob.objects.aget(id=job.id)
+        self.assertEqual((job.status, job.attempts, job.result), (RecommendationJob.PENDING, 1, None))
+        self.assertTrue(job.error)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(await worker.claim(1), [])
+
+
+class RecommendationCacheTests(SimpleTestCase):
+    """
+    Cached recommendations are keyed on the user's data and time bucket, and a save drops all of a person's entries.
+    """
+    def setUp(self):
+        caches["recommendations"].clear()
+        self.cache = RecommendationCache()
+        self.user = PersonSchema(username="tester", email="tester@example.com", tasks=[], availabilities=[])
+        self.now = timezone.make_aware(timezone.datetime(2026, 10, 19, 8))
+
+    def test_key_changes_with_data_and_time_bucket(self):
+        key = snapshot_key(self.user, "agent", self.now)
+        self.assertEqual(snapshot_key(self.user, "agent", self.now + timedelta(minutes=1)), key)
+        self.assertNotEqual(snapshot_key(self.user, "agent", self.now + timedelta(minutes=15)), key)
+        self.assertNotEqual(snapshot_key(self.user, "hybrid", self.now), key)
+        changed = self.user.model_copy(update={"tasks": [TaskSchema(task_id=1, name="Essay", is_completed=False, due_date=None, priority="high")]})
+        self.assertNotEqual(snapshot_key(changed, "agent", self.now), key)
+
+    def test_invalidate_drops_only_that_person(self):
+        key = snapshot_key(self.user, "agent", self.now)
+        self.cache.set(1, key, {"recs": []})
+        self.cache.set(2, key, {"recs": [{"title": "Other"}]})
+        self.assertEqual(self.cache.get(1, key), {"recs": []})
+
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1, key))
+        self.assertEqual(self.cache.get(2, key), {"recs": [{"title": "Other"}]})
+
+    async def test_async_access_shares_entries(self):
+        key = snapshot_key(self.user, "agent", self.now)
+        await self.cache.aset(1, key, {"recs": []})
+        self.assertEqual(self.cache.get(1, key), {"recs": []})
+        self.cache.invalidate(1)
+        self.assertIsNone(await self.cache.aget(1, key))
+
+    def test_entries_need_no_per_person_index(self):
+        for minutes in range(0, 15 * 20, 15):
+            self.cache.set(1, snapshot_key(self.user, "agent", self.now + timedelta(minutes=minutes)), {"recs": []})
+        # Twenty entries and one version token, nothing that grows per person
+        self.assertEqual(len(caches["recommendations"]._cache), 21)
+
+
+class BatchTaskTests(TestCase):
+    """
+    A task batch is applied whole or not at all, and touches each task at most once.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.essay = Task.objects.create(person=self.person, name="Essay")
+        self.email = Task.objects.create(person=self.person, name="Email")
+
+    def batch(self, *operations):
+        return self.client.post("/api/batch-events", {"operations": list(operations)}, content_type="application/json")
+
+    def test_operations_are_applied(self):
+        response = self.batch(
+            {"op": "delete", "task_id": self.email.id},
+            {"op": "create", "task": {"name": "Reading", "priority": "low"}},
+            {"op": "update", "task_id": self.essay.id, "task": {"priority": "high"}},
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([result["op"] for result in results], ["delete", "create", "update"])
+        self.assertEqual(
+            set(Task.objects.filter(person=self.person).values_list("name", "priority")),
+            {("Essay", "high"), ("Reading", "low")},
+        )
+
+    def test_task_changed_twice_is_rejected(self):
+        response = self.batch(
+            {"op": "complete", "task_id": self.essay.id},
+            {"op": "update", "task_id": self.essay.id, "task": {"is_completed": False}},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("operation 0", response.json()["operations"][1]["task_id"])
+        self.assertFalse(Task.objects.get(id=self.essay.id).is_completed)
+
+    def test_other_users_task_is_rejected_without_writing(self):
+        other = Person.objects.create(user=CustomUser.objects.create_user("other", "other@example.com", "password"))
+        theirs = Task.objects.create(person=other, name="Theirs")
+        response = self.batch(
+            {"op": "delete", "task_id": self.essay.id},
+            {"op": "delete", "task_id": theirs.id},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Task.objects.filter(id__in=[self.essay.id, theirs.id]).count(), 2)
+
+
+class PerformanceMiddlewareTests(TestCase):
+    """
+    Only sampled requests are measured and logged, slow requests are always logged, and only requests served synchronously
+    are profiled.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+        self.profiles = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profiles.cleanup)
+
+    def test_unsampled_request_is_not_measured(self):
+        with override_settings(PERF_SAMPLE_RATE=0.0), mock.patch("api.middleware.log_event") as log:
+            response = self.client.get("/api/get-events")
+        self.assertNotIn("Server-Timing", response)
+        self.assertFalse(hasattr(response, "perf_stats"))
+        log.assert_not_called()
+
+    def test_unsampled_slow_request_is_logged(self):
+        with override_settings(PERF_SAMPLE_RATE=0.0, PERF_SLOW_REQUEST_MS=0), self.assertLogs("api.middleware", "WARNING") as logs:
+            response = self.client.get("/api/get-events")
+        self.assertNotIn("Server-Timing", response)
+        self.assertIn("Slow request GET /api/get-events", logs.output[0])
+
+    def test_sampled_request_is_measured(self):
+        with override_settings(PERF_SAMPLE_RATE=1.0), mock.patch("api.middleware.log_event") as log:
+            response = self.client.get("/api/get-events")
+        self.assertIn("Server-Timing", response)
+        self.assertGreater(response.perf_stats.queries, 0)
+        self.assertEqual(log.call_args.kwargs["queries"], response.perf_stats.queries)
+
+    def test_sync_request_is_profiled(self):
+        with override_settings(PERF_SAMPLE_RATE=0.0, PERF_PROFILING=True, PERF_PROFILE_DIR=self.profiles.name):
+            response = self.client.get("/api/get-events", headers={"X-Profile": "1"})
+        self.assertTrue((Path(self.profiles.name) / response["X-Profile-File"]).exists())
+
+    async def test_async_request_is_not_profiled(self):
+        with override_settings(PERF_SAMPLE_RATE=0.0, PERF_PROFILING=True, PERF_PROFILE_DIR=self.profiles.name), \
+                mock.patch("api.middleware.cProfile.Profile") as profile:
+            response = await self.async_client.get("/api/get-events", headers={"X-Profile": "1"})
+        profile.assert_not_called()
+        self.assertNotIn("X-Profile-File", response)
+        self.assertIn("Server-Timing", response)
+
+
+class StreamRecommendationTests(TestCase):
+    """
+    /api/stream-recommendation sends each Rec as a Server-Sent Event, then a closing done or error event.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        for day in ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"):
+            Availability.objects.create(person=self.person, day_of_week=day, start_time=time(9), end_time=time(17))
+        Task.objects.create(person=self.person, name="Essay", due_date=timezone.now() + timedelta(days=3))
+        self.async_client.force_login(self.user)
+
+    async def events(self, **params):
+        response = await self.async_client.get("/api/stream-recommendation", params)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        events = []
+        for message in body.strip().split("\n\n"):
+            event, data = message.split("\n")
+            events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+        return events
+
+    async def test_recs_are_streamed_then_done(self):
+        events = await self.events(engine="local")
+        self.assertEqual(events[-1], ("done", {}))
+        recs = [data for event, data in events[:-1]]
+        self.assertTrue(recs)
+        self.assertEqual({event for event, data in events[:-1]}, {"rec"})
+        self.assertTrue(all(rec["title"] == "Work on Essay" for rec in recs))
+
+    async def test_failure_is_sent_as_error_event(self):
+        async def failing(person_id, schema, engine):
+            yield {"start_time": "2026-10-19T09:00", "end_time": "2026-10-19T10:00", "title": "Essay"}
+            raise RuntimeError("model went away")
+
+        with mock.patch("api.views.stream_recommend", failing):
+            events = await self.events(engine="agent")
+        self.assertEqual([event for event, data in events], ["rec", "error"])
+        self.assertEqual(events[1][1], {"error": "model went away"})
+
+    async def test_unknown_engine_is_rejected(self):
+        response = await self.async_client.get("/api/stream-recommendation", {"engine": "oracle"})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(DATABASE_ROUTERS=["api.routers.ReadReplicaRouter"])
+class ReadReplicaRouterTests(TransactionTestCase):
+    """
+    With a read replica, writes and the reads they are based on never go to the replica.
+
+    No "replica" database is set up under the test runner, so a query sent to it fails the test.
+    """
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("tester", "tester@example.com", "password")
+        self.person = Person.objects.create(user=self.user)
+        self.monday = Availability.objects.create(person=self.person, day_of_week="Monday", start_time=time(9), end_time=time(12))
+        self.task = Task.objects.create(person=self.person, name="Essay", priority="high", due_date=timezone.now() + timedelta(days=10))
+        # Each check starts like a new request, before it has written anything
+        token = _wrote.set(False)
+        self.addCleanup(_wrote.reset, token)
+
+    def test_reads_go_to_the_replica_outside_transactions(self):
+        self.assertEqual(Task.objects.all().db, "replica")
+        with transaction.atomic():
+            self.assertEqual(Task.objects.all().db, "default")
+        self.assertEqual(Person.objects.select_for_update().filter(id=self.person.id).db, "default")
+
+    def test_planner_reads_and_locks_on_the_primary(self):
+        planner = SchedulePlanner(self.person.id, user=PersonSchema(
+            username="tester", email="tester@example.com",
+            tasks=[TaskSchema(task_id=self.task.id, name="Essay", is_completed=False, due_date=self.task.due_date, priority="high")],
+            availabilities=[AvailabilitySchema(avail_id=self.monday.id, day_of_week="Monday", start_time=time(9), end_time=time(12))],
+        ))
+        planner.add([self.task.id])
+        planner.replan_days({"Monday"})
+        self.assertEqual(ScheduledBlock.objects.filter(person=self.person).count(), 1)
+
+    def test_week_is_diffed_against_the_primary(self):
+        serializer = AvailabilitySerializer(
+            Availability.objects.filter(person=self.person),
+            data=[{"day_of_week": "Monday", "start_time": "09:00", "end_time": "12:00"}, {"day_of_week": "Friday", "start_time": "09:00", "end_time": "10:00"}],
+            many=True,
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save(person=self.person)
+        self.assertEqual(serializer.changed_days, {"Friday"})
+        self.assertEqual(Availability.objects.filter(person=self.person).count(), 2)
@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import CreatePersonView, CheckPersonExistenceView, LoginPersonView, CheckLoggedInView, LogoutPersonView, GetTasksView, AddTaskView, RemoveTaskView, GetAvailabilitiesView, SaveAvailabilitiesView, GetRecommendationView
+from .views import CreatePersonView, CheckPersonExistenceView, LoginPersonView, CheckLoggedInView, LogoutPersonView, GetTasksView, AddTaskView, RemoveTaskView, BatchTaskView, GetAvailabilitiesView, SaveAvailabilitiesView, AddAvailabilityView, RemoveAvailabilityView, GetRecommendationView, StreamRecommendationView, CreateRecommendationJobView, GetRecommendationJobView, MetricsView
 
 urlpatterns = [
     path('create-user', CreatePersonView.as_view()),
@@ -10,7 +10,14 @@ urlpatterns = [
     path('get-events', GetTasksView.as_view()),
     path('add-event', AddTaskView.as_view()),
     path('remove-event', RemoveTaskView.as_view()),
+    path('batch-events', BatchTaskView.as_view()),
     path('get-availabilities', GetAvailabilitiesView.as_view()),
     path('save-availabilities', SaveAvailabilitiesView.as_view()),
-    path('get-recommendation', GetRecommendationView.as_view())
+    path('add-availability', AddAvailabilityView.as_view()),
+    path('remove-availability', RemoveAvailabilityView.as_view()),
+    path('get-recommendation', GetRecommendationView.as_view()),
+    path('stream-recommendation', StreamRecommendationView.as_view()),
+    path('recommendations', CreateRecommendationJobView.as_view()),
+    path('recommendations/<int:job_id>', GetRecommendationJobView.as_view()),
+    path('metrics', MetricsView.as_view())
 ]
\ No newline at end of file
@@ -1,12 +1,23 @@
 from rest_framework import status
-from .serializers import PersonSerializer, CreatePersonSerializer, PersonExistenceSerializer, TaskSerializer, AvailabilitySerializer
+from .serializers import PersonSerializer, CreatePersonSerializer, PersonExistenceSerializer, TaskSerializer, TaskBatchSerializer, TaskListQuerySerializer, AvailabilitySerializer
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.contrib.auth import authenticate, login, logout
-from .schemas import PersonSchema
-from .models import Task
-from .agent import RecommendationAgent
-import asyncio
+from django.db.models import F
+from .models import Task, Availability, RecommendationJob
+from .loaders import aload_person_schema
+from .pagination import after_cursor, encode_cursor
+from .planner import SchedulePlanner
+from .jobs import enqueue
+from .cache import RecommendationCache
+from .snapshots import SnapshotCache
+from .recommendations import RECOMMENDATION_ENGINES, recommend, stream_recommend
+from .metrics import RECOMMENDATION_SECONDS, render as render_metrics, span
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+import json
+import time
 
 
 class CreatePersonView(APIView):
@@ -114,13 +125,13 @@ class CheckLoggedInView(APIView):
                 request (Request): The HTTP request object with the GET parameters.
         """
         if request.user.is_authenticated:
-            return Response({
+            return SnapshotCache().serve(request, "loggedin", lambda: {
                 "user": {
                     "id": request.user.id,
                     "username": request.user.username,
                     "email": request.user.email,
                 }
-            }, status=status.HTTP_200_OK)
+            })
         return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
     
 class LogoutPersonView(APIView):
@@ -155,33 +166,63 @@ class GetTasksView(APIView):
         If so, returns a Response containing the user's events.
         Otherwise, returns a Response stating that they are not logged in.
 
+        Optional parameters filter the tasks (completed, priority, due_after, due_before),
+        pick the returned fields (fields) and page through them (limit, cursor).
+        When limit is given, next_cursor holds the cursor of the following page or null on the last one.
+
         Args:
                 request (Request): The HTTP request object with the GET parameters.
         """
         if request.user.is_authenticated:
-            # Fetch the tasks directly from the database
-            person = request.user.person
-            tasks = person.tasks.all()  # Get all tasks associated with the person
-            
-            # Serialize the tasks into a JSON-friendly format
-            tasks_data = [
-                {
-                    "task_id": task.id,
-                    "name": task.name,
-                    "is_completed": task.is_completed,
-                    "due_date": task.due_date,
-                    "priority": task.priority,
-                }
-                for task in tasks
-            ]
+            query = TaskListQuerySerializer(data=request.GET)
+            if not query.is_valid():
+                return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+            params = query.validated_data
 
-            tasks_data = sorted(tasks_data, key = lambda x: x['due_date'])
-
-            return Response(
-                {"tasks": tasks_data},
-                status=status.HTTP_200_OK
-            )
+            return SnapshotCache().serve(request, "get-events", lambda: self.tasks(request.user, params))
         return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    def tasks(self, user, params):
+        """
+        Builds the filtered page of the user's tasks.
+
+        Args:
+            user (CustomUser): The logged in user
+            params (dict): The validated TaskListQuerySerializer data
+        """
+        tasks = Task.objects.filter(person__user=user)
+
+        if params['completed'] is not None:
+            tasks = tasks.filter(is_completed=params['completed'])
+        if 'priority' in params:
+            tasks = tasks.filter(priority__in=params['priority'])
+        if 'due_after' in params:
+            tasks = tasks.filter(due_date__gte=params['due_after'])
+        if 'due_before' in params:
+            tasks = tasks.filter(due_date__lt=params['due_before'])
+        if 'cursor' in params:
+            tasks = tasks.filter(after_cursor(*params['cursor']))
+
+        # Ordering is done by the database, tasks without a due date go last
+        tasks = tasks.order_by(F('due_date').asc(nulls_last=True), 'id')
+
+        fields = params.get('fields', TaskListQuerySerializer.FIELDS)
+        # The cursor needs the position of the last row even when those fields were not asked for
+        rows = tasks.values('id', 'due_date', *[field for field in fields if field not in ('task_id', 'due_date')])
+
+        next_cursor = None
+        if 'limit' in params:
+            rows = list(rows[:params['limit'] + 1])
+            if len(rows) > params['limit']:
+                rows = rows[:params['limit']]
+                next_cursor = encode_cursor(rows[-1]['due_date'], rows[-1]['id'])
+
+        tasks_data = [
+            {field: row['id'] if field == 'task_id' else row[field] for field in fields}
+            for row in rows
+        ]
+
+        return {"tasks": tasks_data, "next_cursor": next_cursor}
     
 class AddTaskView(APIView):
     def post(self, request):
@@ -204,6 +245,8 @@ class AddTaskView(APIView):
         serializer = TaskSerializer(data=request.data)
         if serializer.is_valid():
             task = serializer.save(person=person)  # Link the task to the person's model
+            SchedulePlanner(person.id).add([task.id])
+            RecommendationCache().invalidate(person.id)
             return Response({"message": "Task added successfully", "task": serializer.data}, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -231,17 +274,49 @@ class RemoveTaskView(APIView):
         if not task_id:
             return Response({"error": "Task ID is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Find the task to be removed
-        try:
-            task = Task.objects.get(id=task_id, person=person)
-        except Task.DoesNotExist:
+        # Delete the task in one query, nothing is deleted if it is not the user's
+        # Its scheduled blocks are deleted with it, which frees their slots
+        deleted, _ = Task.objects.filter(id=task_id, person=person).delete()
+        if not deleted:
             return Response({"error": "Task not found for the user"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Delete the task
-        task.delete()
+        RecommendationCache().invalidate(person.id)
 
         return Response({"message": "Task removed successfully"}, status=status.HTTP_200_OK)
     
+class BatchTaskView(APIView):
+    def post(self, request):
+        """
+        Handles POST requests for the REST API url /api/batch-events.
+
+        Applies a list of create, update, complete and delete operations to the user's tasks in one transaction.
+        Returns one result per operation, or one error entry per operation if any of them is invalid.
+        """
+        # Ensure the user is authenticated
+        if not request.user.is_authenticated:
+            return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        # Get the authenticated user's Person instance
+        try:
+            person = request.user.person
+        except AttributeError:
+            return Response({"error": "Person object not found for the user"}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = TaskBatchSerializer(data=request.data, context={'person': person})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        results = serializer.save()
+
+        # Deleted tasks free their blocks through the cascade, changed tasks are slotted in again
+        changed = lambda *ops: [result['task_id'] for result in results if result['op'] in ops]
+        planner = SchedulePlanner(person.id)
+        planner.release(changed('update', 'complete'))
+        planner.add(changed('create', 'update'))
+        RecommendationCache().invalidate(person.id)
+
+        return Response({"message": "Tasks updated successfully", "results": results}, status=status.HTTP_200_OK)
+    
 class GetAvailabilitiesView(APIView):
     """
     APIView to retrieve a user's availabilities.
@@ -258,34 +333,50 @@ class GetAvailabilitiesView(APIView):
                 request (Request): The HTTP request object with the GET parameters.
         """
         if request.user.is_authenticated:
-            # Fetch the tasks directly from the database
-            person = request.user.person
-            availabilities = person.availabilities.all()  # Get all tasks associated with the person
-            
-            # Serialize the tasks into a JSON-friendly format
-            availability_data = [
-                {
-                    "availability_id": availability.id,
-                    "day_of_week": availability.day_of_week,
-                    "start_time": availability.start_time,
-                    "end_time" : availability.end_time
-
-                }
-                for availability in availabilities
-            ]
-
-            return Response(
-                {"availabilities": availability_data},
-                status=status.HTTP_200_OK
-            )
+            return SnapshotCache().serve(request, "get-availabilities", lambda: self.availabilities(request.user))
         return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
     
+    def availabilities(self, user):
+        # Fetch the tasks directly from the database
+        person = user.person
+        availabilities = person.availabilities.all()  # Get all tasks associated with the person
+        
+        # Serialize the tasks into a JSON-friendly format
+        # The weekly slots are the list save-availabilities replaces, dated ones are listed apart so they are not saved back as weekly time
+        availability_data = [
+            {
+                "availability_id": availability.id,
+                "day_of_week": availability.day_of_week,
+                "start_time": availability.start_time,
+                "end_time" : availability.end_time,
+                "interval_weeks": availability.interval_weeks,
+                "starts_on": availability.starts_on,
+                "ends_on": availability.ends_on,
+                "timezone": availability.timezone
+
+            }
+            for availability in availabilities if availability.kind == Availability.WEEKLY
+        ]
+        date_data = [
+            {
+                "availability_id": availability.id,
+                "kind": availability.kind,
+                "date": availability.date,
+                "start_time": availability.start_time,
+                "end_time" : availability.end_time,
+                "timezone": availability.timezone
+            }
+            for availability in availabilities if availability.kind != Availability.WEEKLY
+        ]
+
+        return {"availabilities": availability_data, "dates": date_data}
+    
 class SaveAvailabilitiesView(APIView):
     def post(self, request):
         """
         Handles POST requests for the REST API url /api/save-availabilities.
 
-        Saves the list of availabilities for the user.
+        Saves the list of weekly availabilities for the user, keeping their overrides and exceptions.
         """
         # Ensure the user is authenticated
         if not request.user.is_authenticated:
@@ -297,28 +388,89 @@ class SaveAvailabilitiesView(APIView):
         except AttributeError:
             return Response({"error": "Person object not found for the user"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Validate and create the task
-        data_list = request.data["availabilities"]
+        data_list = request.data.get("availabilities")
 
         if not isinstance(data_list, list):
             return Response({"error": "Invalid data format. Expected a list of availabilities."}, status=status.HTTP_400_BAD_REQUEST)
 
-        
-        person.availabilities.all().delete()
-        
-        for avail in data_list:
-            serializer = AvailabilitySerializer(data=avail)
-            if serializer.is_valid():
-                avail = serializer.save(person=person)  # Link the task to the person's model
-            else:
-                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        # The whole list is validated before anything is written
+        serializer = AvailabilitySerializer(person.availabilities.all(), data=data_list, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer.save(person=person)  # Link the availabilities to the person's model
+        SchedulePlanner(person.id).replan_days(serializer.changed_days)
+        RecommendationCache().invalidate(person.id)
+
         return Response({"message": "Availabilities added successfully"}, status=status.HTTP_201_CREATED)
     
-class GetRecommendationView(APIView):
+class AddAvailabilityView(APIView):
+    def post(self, request):
+        """
+        Handles POST requests for the REST API url /api/add-availability.
+
+        Adds one availability for the user, such as a holiday exception or a one-off override,
+        without re-saving their whole week.
+        """
+        # Ensure the user is authenticated
+        if not request.user.is_authenticated:
+            return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        # Get the authenticated user's Person instance
+        try:
+            person = request.user.person
+        except AttributeError:
+            return Response({"error": "Person object not found for the user"}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = AvailabilitySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        availability = serializer.save(person=person)  # Link the availability to the person's model
+        SchedulePlanner(person.id).replan_availability(availability)
+        RecommendationCache().invalidate(person.id)
+
+        return Response({"message": "Availability added successfully", "availability_id": availability.id, "availability": serializer.data}, status=status.HTTP_201_CREATED)
+
+class RemoveAvailabilityView(APIView):
+    def post(self, request):
+        """
+        Handles POST requests for the REST API url /api/remove-availability.
+
+        Removes one of the user's availabilities.
+        """
+        # Ensure the user is authenticated
+        if not request.user.is_authenticated:
+            return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        # Get the authenticated user's Person instance
+        try:
+            person = request.user.person
+        except AttributeError:
+            return Response({"error": "Person object not found for the user"}, status=status.HTTP_404_NOT_FOUND)
+
+        availability_id = request.data.get("availability_id")
+
+        if not availability_id:
+            return Response({"error": "Availability ID is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        availability = Availability.objects.filter(id=availability_id, person=person).first()
+        if availability is None:
+            return Response({"error": "Availability not found for the user"}, status=status.HTTP_404_NOT_FOUND)
+
+        availability.delete()
+        SchedulePlanner(person.id).replan_availability(availability)
+        RecommendationCache().invalidate(person.id)
+
+        return Response({"message": "Availability removed successfully"}, status=status.HTTP_200_OK)
+    
+class GetRecommendationView(View):
     """
-    APIView to retrieve a user's recommendation.
+    Async view to retrieve a user's recommendation.
+
+    Runs natively on the event loop under webapp/asgi.py, so a slow model call does not hold a worker thread.
     """
-    def get(self, request):
+    async def get(self, request):
         """
         Handles GET requests for the REST API url /api/get-recommendation
 
@@ -326,16 +478,156 @@ class GetRecommendationView(APIView):
         If so, returns a Response containing the user's recommendation.
         Otherwise, returns a Response stating that they are not logged in.
 
+        The optional "engine" parameter picks how the recommendation is made:
+        "local" (default) runs the deterministic scheduler, "agent" asks the LLM
+        and "hybrid" schedules locally and has the LLM phrase the result.
+
         Args:
-                request (Request): The HTTP request object with the GET parameters.
+                request (HttpRequest): The HTTP request object with the GET parameters.
         """
-        if request.user.is_authenticated:
-            rec = RecommendationAgent()
-
-            schema = PersonSchema.model_validate(request.user.person)
-
-            return Response(
-                {"recommendation": asyncio.run(rec.makeRecommendations(user=schema))},
+        user = await request.auser()
+        if user.is_authenticated:
+            engine = request.GET.get('engine', 'local')
+
+            if engine not in RECOMMENDATION_ENGINES:
+                return JsonResponse({"error": f"Unknown engine. Expected one of {', '.join(RECOMMENDATION_ENGINES)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                with span("load"):
+                    person_id, schema = await aload_person_schema(user_id=user.id)
+
+                recommendation = await recommend(person_id, schema, engine)
+                outcome = "ok"
+            finally:
+                RECOMMENDATION_SECONDS.observe(time.perf_counter() - start, engine=engine, outcome=outcome)
+
+            return JsonResponse(
+                {"recommendation": recommendation},
                 status=status.HTTP_200_OK
             )
-        return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file
+        return JsonResponse({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+class StreamRecommendationView(View):
+    """
+    Async view to stream a user's recommendation as Server-Sent Events.
+
+    Events are only sent as they are made when the app is served through webapp/asgi.py. Under WSGI,
+    runserver included, Django has to read an async stream to the end before sending it, so the
+    events all arrive at once after the whole recommendation is made.
+    """
+    async def get(self, request):
+        """
+        Handles GET requests for the REST API url /api/stream-recommendation
+
+        Sends a "rec" event with each recommended work block as soon as it is made,
+        then a "done" event, or an "error" event if the recommendation failed.
+        Takes the same "engine" parameter as /api/get-recommendation.
+
+        Args:
+                request (HttpRequest): The HTTP request object with the GET parameters.
+        """
+        user = await request.auser()
+        if not user.is_authenticated:
+            return JsonResponse({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        engine = request.GET.get('engine', 'local')
+
+        if engine not in RECOMMENDATION_ENGINES:
+            return JsonResponse({"error": f"Unknown engine. Expected one of {', '.join(RECOMMENDATION_ENGINES)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        start = time.perf_counter()
+        with span("load"):
+            person_id, schema = await aload_person_schema(user_id=user.id)
+
+        async def events():
+            try:
+                async for rec in stream_recommend(person_id, schema, engine):
+                    yield f"event: rec\ndata: {json.dumps(rec)}\n\n"
+            except Exception as error:
+                RECOMMENDATION_SECONDS.observe(time.perf_counter() - start, engine=engine, outcome="error")
+                yield f"event: error\ndata: {json.dumps({'error': str(error)})}\n\n"
+                return
+            RECOMMENDATION_SECONDS.observe(time.perf_counter() - start, engine=engine, outcome="ok")
+            yield "event: done\ndata: {}\n\n"
+
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # Stops proxies from holding events back
+        return response
+
+class CreateRecommendationJobView(APIView):
+    """
+    APIView to queue a recommendation to be made in the background.
+    """
+    def post(self, request):
+        """
+        Handles POST requests for the REST API url /api/recommendations
+
+        Queues a recommendation job for the user, reusing an identical pending job if there is one.
+        Returns the job id to poll /api/recommendations/<job_id> with.
+
+        Args:
+            request (Request): The HTTP request object with the POST data.
+        """
+        if not request.user.is_authenticated:
+            return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        engine = request.data.get('engine', 'agent')
+
+        if engine not in RECOMMENDATION_ENGINES:
+            return Response({"error": f"Unknown engine. Expected one of {', '.join(RECOMMENDATION_ENGINES)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        job = enqueue(request.user.person, engine)
+
+        return Response({"job_id": job.id, "status": job.status}, status=status.HTTP_202_ACCEPTED)
+
+class GetRecommendationJobView(APIView):
+    """
+    APIView to check on a queued recommendation.
+    """
+    def get(self, request, job_id):
+        """
+        Handles GET requests for the REST API url /api/recommendations/<job_id>
+
+        Returns the job's status, and its recommendation once it is done.
+
+        Args:
+            request (Request): The HTTP request object with the GET parameters.
+            job_id (int): The id returned when the job was queued
+        """
+        if not request.user.is_authenticated:
+            return Response({"error": "Not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            job = RecommendationJob.objects.get(id=job_id, person__user=request.user)
+        except RecommendationJob.DoesNotExist:
+            return Response({"error": "Job not found for the user"}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            "job_id": job.id,
+            "status": job.status,
+            "attempts": job.attempts,
+            "recommendation": job.result,
+            "error": job.error,
+        }, status=status.HTTP_200_OK)
+
+class MetricsView(View):
+    """
+    View exposing the recommendation metrics to a local Prometheus scraper.
+    """
+    def get(self, request):
+        """
+        Handles GET requests for the url /api/metrics
+
+        Returns the metrics of this process in the Prometheus text format.
+        Only addresses in METRICS_ALLOWED_IPS may read them.
+
+        Args:
+                request (HttpRequest): The HTTP request object.
+        """
+        if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+            return JsonResponse({"error": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+
+        return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
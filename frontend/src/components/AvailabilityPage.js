@@ -68,10 +68,13 @@ export const AvailabilityPage = () => {
       let availability_data = [];
       for(let avail in availabilities)
       {
+        // Recurrence fields of loaded slots are sent back as they were, so saving does not reset them
+        const { interval_weeks, starts_on, ends_on, timezone } = availabilities[avail];
         availability_data.push({
           "day_of_week" : availabilities[avail]['day_of_week'],
           "start_time": availabilities[avail]['start_time'],
-          "end_time": availabilities[avail]['end_time']
+          "end_time": availabilities[avail]['end_time'],
+          ...(interval_weeks !== undefined && { interval_weeks, starts_on, ends_on, timezone })
         }
         );
       }
@@ -6,27 +6,29 @@ export const RecommendationPage = () => {
 
 
       /**
-       * Method will check at the page refresh to for the contents of the user's recommendation
+       * Method will check at the page refresh to for the contents of the user's recommendation.
+       * Recommendations are streamed, so each one is shown as soon as the server sends it.
        */
       useEffect(() => {
-        // Fetch the tasks from the API
-        const fetchTasks = async () => {
-          try {
-            const response = await fetch("/api/get-recommendation");
-            if (!response.ok) {
-              throw new Error("Failed to fetch recommendation");
-            }
-            const data = await response.json();
-            setRecs(data.recommendation.recs);
-            console.log(data);
-            setLoading(false); // Turn off loading state
-          } catch (error) {
-            console.error("Error fetching recommendation:", error);
-            setLoading(false); // Turn off loading state
-          }
-        };
+        const source = new EventSource("/api/stream-recommendation");
 
-        fetchTasks();
+        source.addEventListener("rec", (event) => {
+          setRecs((prevRecs) => [...prevRecs, JSON.parse(event.data)]);
+          setLoading(false); // Show the list as soon as the first recommendation arrives
+        });
+
+        source.addEventListener("done", () => {
+          source.close();
+          setLoading(false); // Turn off loading state
+        });
+
+        source.addEventListener("error", (event) => {
+          console.error("Error fetching recommendation:", event.data);
+          source.close(); // Stops the browser from reconnecting
+          setLoading(false); // Turn off loading state
+        });
+
+        return () => source.close();
       }, []); // Empty dependency array ensures this runs only once when the component mounts
 
       const formatDate = (isoDate) => {
@@ -19,7 +19,7 @@ export const ToDoListPage = () => {
     // Fetch the tasks from the API
     const fetchTasks = async () => {
       try {
-        const response = await fetch("/api/get-events");
+        const response = await fetch("/api/get-events?completed=false&fields=task_id,name,due_date,priority");
         if (!response.ok) {
           throw new Error("Failed to fetch tasks");
         }
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapp.settings')
+# Read by the settings, which then do not keep connections open across requests
+os.environ.setdefault('TEMPORA_ASGI', '1')
 
 application = get_asgi_application()
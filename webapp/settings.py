@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +47,7 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = "api.CustomUser"
 
 MIDDLEWARE = [
+    'api.middleware.PerformanceMiddleware',  # First, so its timings include the other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,13 +80,248 @@ WSGI_APPLICATION = 'webapp.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# TEMPORA_DB_PROFILE picks how SQLite is tuned, "production" suits concurrent requests and "basic" is
+# SQLite's stock behaviour. With TEMPORA_DB_REPLICA set to a copy of the database kept up to date
+# (for example by Litestream or LiteFS), reads are sent to it by api.routers.ReadReplicaRouter.
+
+# Under ASGI every sync query runs on a new thread with its own connection, so a persistent connection
+# is never reused and only piles up. webapp/asgi.py sets TEMPORA_ASGI before the settings are read.
+RUNNING_ASGI = os.environ.get('TEMPORA_ASGI') == '1'
+
+SQLITE_PROFILES = {
+    'basic': {
+        'CONN_MAX_AGE': 0,
+        'CONN_HEALTH_CHECKS': False,
+        'OPTIONS': {},
+    },
+    'production': {
+        'CONN_MAX_AGE': 0 if RUNNING_ASGI else 600,  # Under WSGI connections are reused across requests instead of opened for each one
+        'CONN_HEALTH_CHECKS': True,  # A reused connection is checked before the request that takes it
+        'OPTIONS': {
+            # Writers take the lock when their transaction starts, so they wait for each other
+            # instead of failing with "database is locked" when a read lock cannot be upgraded
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,  # Seconds a connection waits for the lock
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'  # Readers no longer block the writer or each other
+                'PRAGMA synchronous=NORMAL;'  # Safe with WAL, only the last commits can be lost on power loss
+                'PRAGMA cache_size=-64000;'  # 64 MB page cache per connection
+                'PRAGMA mmap_size=268435456;'  # Reads up to 256 MB straight from the mapped file
+                'PRAGMA temp_store=MEMORY;'
+            ),
+        },
+    },
+}
+
+DATABASE_PROFILE = os.environ.get('TEMPORA_DB_PROFILE', 'production')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        **SQLITE_PROFILES[DATABASE_PROFILE],
     }
 }
 
+if os.environ.get('TEMPORA_DB_REPLICA'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['TEMPORA_DB_REPLICA'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASES['replica']['OPTIONS'] = {
+        **DATABASES['default'].get('OPTIONS', {}),
+        'init_command': DATABASES['default'].get('OPTIONS', {}).get('init_command', '') + 'PRAGMA query_only=ON;',
+    }
+    DATABASE_ROUTERS = ['api.routers.ReadReplicaRouter']
+    MIDDLEWARE.insert(1, 'api.routers.PrimaryPinningMiddleware')
+
+
+# Caches
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+#
+# Recommendations are cached under their own alias. TEMPORA_RECOMMENDATION_CACHE picks the
+# backend: "memory" (default), "file" or "db". The db backend needs `python manage.py createcachetable`.
+
+RECOMMENDATION_CACHE_BACKENDS = {
+    'memory': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'recommendations',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'recommendation_cache',
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'recommendation_cache',
+    },
+}
+
+# Worker processes serving the app, read from WEB_CONCURRENCY like uvicorn and gunicorn do. Caches whose
+# entries must change in every process at once default to the database cache when there is more than one,
+# which needs `python manage.py createcachetable`.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '1'))
+SHARED_CACHE_DEFAULT = 'memory' if WEB_CONCURRENCY == 1 else 'db'
+
+# Rendered read endpoints are cached under "snapshots". Their version tokens live there too, so processes
+# only see each other's writes when TEMPORA_SNAPSHOT_CACHE picks a shared backend: "file" or "db".
+# In memory snapshots only live for seconds, in case more workers run than WEB_CONCURRENCY says.
+SNAPSHOT_CACHE = os.environ.get('TEMPORA_SNAPSHOT_CACHE', SHARED_CACHE_DEFAULT)
+
+SNAPSHOT_CACHE_BACKENDS = {
+    'memory': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'snapshots',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'snapshot_cache',
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'snapshot_cache',
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'snapshots': {
+        **SNAPSHOT_CACHE_BACKENDS[SNAPSHOT_CACHE],
+        'TIMEOUT': 30 if SNAPSHOT_CACHE == 'memory' else 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+    'recommendations': {
+        **RECOMMENDATION_CACHE_BACKENDS[os.environ.get('TEMPORA_RECOMMENDATION_CACHE', 'memory')],
+        'TIMEOUT': 60 * 60,  # Seconds before an entry expires
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,  # Entries are culled past this, least recently used first in memory
+        },
+    },
+}
+
+# Recommendations made within the same bucket of this many minutes share a cache entry
+RECOMMENDATION_TIME_BUCKET_MINUTES = 15
+
+
+# Recommendation agent
+# Set TEMPORA_AGENT_WARMUP=1 in servers to build the agent and authenticate with Vertex AI at startup
+
+RECOMMENDATION_AGENT_WARMUP = os.environ.get('TEMPORA_AGENT_WARMUP', '0') == '1'
+
+# Most tokens of tasks and availabilities put in front of the model, lowest ranked tasks are left out first
+RECOMMENDATION_CONTEXT_TOKEN_BUDGET = 2000
+# Tasks due further ahead than this are left out of the model's context
+RECOMMENDATION_CONTEXT_HORIZON_DAYS = 14
+# Put the context in the first prompt instead of waiting for the model to call its tools for it
+RECOMMENDATION_INLINE_CONTEXT = True
+# Model recommendations are repaired locally, the model is only asked again when more than this share of Recs had to be dropped
+RECOMMENDATION_REPAIR_MAX_DROPPED_SHARE = 0.5
+RECOMMENDATION_REPAIR_REPROMPTS = 1  # Times the model is asked again for one recommendation
+
+
+# Model backends
+# TEMPORA_MODEL_BACKEND picks the model the agent runs on: "vertex" calls Gemini, "rules" schedules
+# locally without a network, "replay" replays responses recorded to RECOMMENDATION_RECORD_FILE.
+# "auto" picks the lowest COST backend whose LATENCY_BUDGET is within RECOMMENDATION_LATENCY_SLA_SECONDS.
+# Only backends given a COST take part, rules and replay have none so "auto" never swaps the model for
+# them. With only vertex priced here "auto" is the same as "vertex", price another model backend to choose.
+# TIMEOUT bounds each call, calls slower than LATENCY_BUDGET are counted in tempora_model_budget_overruns_total.
+
+RECOMMENDATION_BACKENDS = {
+    'vertex': {
+        'BACKEND': 'api.backends.VertexBackend',
+        'TIMEOUT': 30,
+        'LATENCY_BUDGET': 10,
+        'COST': 1,
+        'OPTIONS': {
+            'MODEL': 'gemini-1.5-flash',
+            'PROJECT_ID': 'tempora-447602',
+        },
+    },
+    'rules': {
+        'BACKEND': 'api.backends.RuleBasedBackend',
+        'TIMEOUT': 5,
+        'LATENCY_BUDGET': 0.05,
+    },
+    'replay': {
+        'BACKEND': 'api.backends.ReplayBackend',
+        'TIMEOUT': 5,
+        'LATENCY_BUDGET': 0.05,
+    },
+}
+
+RECOMMENDATION_BACKEND = os.environ.get('TEMPORA_MODEL_BACKEND', 'vertex')
+RECOMMENDATION_LATENCY_SLA_SECONDS = 15
+# Set to a file to append every model answer to it, for the replay backend
+RECOMMENDATION_RECORD_FILE = os.environ.get('TEMPORA_RECORD_FILE')
+
+
+# Model gateway
+# Every model call goes through api.gateway.ModelGateway
+
+RECOMMENDATION_MODEL_CONCURRENCY = 16  # Model calls in flight at once per process
+RECOMMENDATION_MODEL_USER_CONCURRENCY = 1  # Model calls in flight at once for one user
+RECOMMENDATION_MODEL_TIMEOUT_SECONDS = 30  # For backends without a TIMEOUT
+RECOMMENDATION_MODEL_RETRIES = 2  # Attempts after a timeout or provider error
+RECOMMENDATION_MODEL_RETRY_BACKOFF_SECONDS = 0.5  # Most jitter before the first retry, doubled for each later one
+RECOMMENDATION_BREAKER_FAILURES = 5  # Failures in a row that stop calls to the provider
+RECOMMENDATION_BREAKER_COOLDOWN_SECONDS = 30  # How long calls stay stopped before one is tried again
+
+
+# Recommendation jobs
+# Queued through POST /api/recommendations and run by `python manage.py recommendation_worker`
+
+RECOMMENDATION_MAX_CONCURRENCY = 8  # Jobs a worker runs against the model provider at once
+RECOMMENDATION_JOB_MAX_ATTEMPTS = 3
+RECOMMENDATION_JOB_BACKOFF_SECONDS = 5  # Doubled after every failed attempt
+RECOMMENDATION_JOB_LEASE_SECONDS = 300  # Running jobs not updated for this long are picked up again
+
+# Recommendations stored by `python manage.py precompute_recommendations` are served for this long,
+# as long as the tasks and availabilities they were made from have not changed
+RECOMMENDATION_PRECOMPUTED_MAX_AGE_HOURS = 12
+
+
+# Metrics
+# GET /api/metrics serves Prometheus text metrics to these addresses, stage timings are also logged as JSON lines
+
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# Set TEMPORA_METRICS_LOG=0 to drop the JSON lines, they are off by default under `manage.py test`
+METRICS_LOG = os.environ.get('TEMPORA_METRICS_LOG', '0' if sys.argv[1:2] == ['test'] else '1') == '1'
+
+# Share of requests PerformanceMiddleware measures and logs, raise it while investigating
+PERF_SAMPLE_RATE = float(os.environ.get('TEMPORA_PERF_SAMPLE_RATE', '0.01'))
+# Requests slower than this are always logged, sampled ones with their slowest queries
+PERF_SLOW_REQUEST_MS = 500
+PERF_SLOW_REQUEST_QUERIES = 10
+PERF_MAX_CAPTURED_QUERIES = 200  # SQL kept per request for the slow request log
+# Set TEMPORA_PERF_PROFILING=1 to run requests sent with an X-Profile header under cProfile,
+# dumps are written to PERF_PROFILE_DIR. Only requests served under WSGI are profiled
+PERF_PROFILING = os.environ.get('TEMPORA_PERF_PROFILING', '0') == '1'
+PERF_PROFILE_DIR = BASE_DIR / 'profiles'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json_line': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'metrics': {'class': 'logging.StreamHandler' if METRICS_LOG else 'logging.NullHandler', 'formatter': 'json_line'},
+    },
+    'loggers': {
+        'tempora.metrics': {
+            'handlers': ['metrics'],
+            'level': os.environ.get('TEMPORA_METRICS_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators